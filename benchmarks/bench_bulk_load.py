@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Seeds a table from a CSV file with a bulk load changeset (split, gzip, PUT and COPY INTO) against the SQLite backed
+fake Snowflake connection and its in-memory stage, and compares it with seeding the same rows with multi-row INSERT
+statements. Reports the time to split and compress the file with one and with many threads, and checks the loaded
+rows against the file, including quoted fields with delimiters and newlines split across chunks.
+
+    python -m benchmarks.bench_bulk_load --size-mb 20 --chunk-mb 2 --workers 4
+"""
+from pathlib import Path
+import argparse
+import csv
+import logging
+import tempfile
+import time
+
+from benchmarks.synthetic_release import write_release
+from core import deploy_changes
+from hooks.connection_pool import SnowflakeConnectionPool
+from hooks.fake_snowflake_hook import FakeSnowflakeConnectionHook
+from operators.bulk_load import BulkLoader
+from operators.manifest_reader import LoadFile
+
+TARGET_DATABASE = 'BENCH'
+LOAD_INCLUDE = ('  <include file="seed/rows.csv" type="load" table="bench_0_0" id="seed-rows" author="bench" '
+                'skip_header="1" field_optionally_enclosed_by=\'"\'/>\n')
+
+
+def write_csv(path, size_mb: float):
+    """
+    Writes a CSV file with a header, every tenth label holds a quoted delimiter, quote and newline
+    :return: number of rows
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    rows = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['id', 'label'])
+        while f.tell() < size_mb * 1024 * 1024:
+            label = f'seed row {rows}, "quoted"\nsecond line' if rows % 10 == 0 else f'seed row {rows}'
+            writer.writerow([rows, label])
+            rows += 1
+    return rows
+
+
+def write_insert_file(path, csv_file, rows_per_statement: int = 1000):
+    """
+    Appends the rows of the CSV file to a change file as multi-row INSERT statements
+    """
+    with open(csv_file, newline='') as source, open(path, 'a') as f:
+        records = csv.reader(source)
+        next(records)
+        while True:
+            batch = [record for _, record in zip(range(rows_per_statement), records)]
+            if not batch:
+                break
+            values = ',\n'.join(f"({id}, '{label}')" for id, label in batch)
+            f.write(f'INSERT INTO bench_0_0 (id, label) VALUES\n{values};\n')
+
+
+def release(properties):
+    hook = FakeSnowflakeConnectionHook(database=TARGET_DATABASE, record=False)
+    hook.backend.execute(f'CREATE DATABASE {TARGET_DATABASE}')
+    start = time.perf_counter()
+    deployer = deploy_changes.DeployChanges(target_database=TARGET_DATABASE, cloning=False, properties=properties,
+                                            connection_pool=SnowflakeConnectionPool.from_properties(hook, properties))
+    report = deployer.run_release()
+    elapsed = time.perf_counter() - start
+    backend = hook.backend
+    rows = backend.execute(f'SELECT COUNT(*) FROM {TARGET_DATABASE}.PUBLIC.bench_0_0')[0][0]
+    multiline = backend.execute(f"SELECT COUNT(*) FROM {TARGET_DATABASE}.PUBLIC.bench_0_0 "
+                                f"WHERE label LIKE '%\"quoted\"' || char(10) || 'second line'")[0][0]
+    statuses = dict(backend.execute(f'SELECT id, status FROM {TARGET_DATABASE}.HISTORY_SCHEMA.HISTORY_TABLE'))
+    return elapsed, hook.round_trips, rows, multiline, statuses, len(report.failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=20, help='size of the CSV file')
+    parser.add_argument('--chunk-mb', type=float, default=2, help='bulk_load chunk_mb')
+    parser.add_argument('--workers', type=int, default=4, help='bulk_load workers')
+    parser.add_argument('--mode', choices=('threads', 'async'), default='threads', help='execution_mode')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        properties = write_release(directory, change_logs=1, files=1, statements=0)
+        properties.update(history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE',
+                          history_cache_directory=None, content_cache_file=None, execution_mode=args.mode,
+                          bulk_load={'workers': args.workers, 'chunk_mb': args.chunk_mb,
+                                     'work_directory': str(Path(directory, 'work'))})
+        csv_file = Path(properties['root_sql_directory'], 'seed', 'rows.csv')
+        expected = write_csv(csv_file, args.size_mb)
+        change_log = Path(properties['change_log_directory'], 'changelog_0.xml')
+        change_log.write_text(change_log.read_text().replace('</databaseChangeLog>',
+                                                             LOAD_INCLUDE + '</databaseChangeLog>'))
+        print(f'{args.size_mb:.0f}MB CSV file, {expected} rows')
+
+        load_file = LoadFile(file='seed/rows.csv', path=csv_file,
+                             attributes={'table': 'bench_0_0', 'id': 'seed-rows', 'skip_header': '1',
+                                         'field_optionally_enclosed_by': '"'})
+        for workers in sorted({1, args.workers}):
+            loader = BulkLoader(workers=workers, chunk_mb=args.chunk_mb)
+            with tempfile.TemporaryDirectory() as work_directory:
+                start = time.perf_counter()
+                chunks = loader.prepare(load_file, work_directory)
+                elapsed = time.perf_counter() - start
+            print(f'split and gzip, {workers} threads: {elapsed:6.2f}s, {chunks} chunks, '
+                  f'{loader.stats.bytes_read / elapsed / 1024 / 1024:6.1f}MB/s')
+
+        elapsed, round_trips, rows, multiline, statuses, release_failed = release(properties)
+        ok = rows == expected and multiline == (expected + 9) // 10 and not release_failed and \
+            statuses.get('seed-rows') == 'success'
+        failed = failed or not ok
+        print(f'bulk load  {elapsed:7.2f}s, {round_trips:5d} round trips, {rows} rows, history {statuses}'
+              f'{"" if ok else ", FAILED"}')
+
+        # the same rows seeded with INSERT statements
+        change_log.write_text(change_log.read_text().replace(LOAD_INCLUDE, ''))
+        write_insert_file(Path(properties['root_sql_directory'], '0', 'change_0.sql'), csv_file)
+        elapsed, round_trips, rows, _, _, release_failed = release(properties)
+        print(f'INSERTs    {elapsed:7.2f}s, {round_trips:5d} round trips, {rows} rows'
+              f'{", FAILED" if release_failed else ""}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
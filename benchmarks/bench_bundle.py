@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Reads a synthetic release from its manifests and SQL files and from a release bundle, and releases it from both
+against the SQLite backed fake Snowflake connection. Reports the time and the number of files opened, counted with
+an audit hook: read from the sources, every manifest and SQL file is opened, read from the bundle one file is.
+
+    python -m benchmarks.bench_bundle --change-logs 20 --files 50
+"""
+from pathlib import Path
+import argparse
+import logging
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic_release import write_release
+from core import deploy_changes
+from hooks.connection_pool import SnowflakeConnectionPool
+from hooks.fake_snowflake_hook import FakeSnowflakeConnectionHook
+from operators import release_bundle
+
+TARGET_DATABASE = 'BENCH'
+
+
+class OpenCounter:
+    """
+    Counts the files opened under a directory
+    """
+    def __init__(self, directory):
+        self.directory = str(Path(directory).resolve())
+        self.opened = 0
+        self.enabled = False
+        sys.addaudithook(self._hook)
+
+    def _hook(self, event, args):
+        if self.enabled and event == 'open' and isinstance(args[0], str) and \
+                str(Path(args[0]).resolve()).startswith(self.directory):
+            self.opened += 1
+
+    def count(self, function):
+        # a bundle is opened once per process, counted in each measurement
+        release_bundle.open_bundle.cache_clear()
+        self.opened = 0
+        self.enabled = True
+        start = time.perf_counter()
+        try:
+            result = function()
+        finally:
+            self.enabled = False
+        return result, time.perf_counter() - start, self.opened
+
+
+def read_all(properties):
+    release = release_bundle.read_release(properties)
+    return sum(len(change_file.read_sql()) for change_files in release.values() for change_file in change_files)
+
+
+def release(properties):
+    hook = FakeSnowflakeConnectionHook(database=TARGET_DATABASE, record=False)
+    hook.backend.execute(f'CREATE DATABASE {TARGET_DATABASE}')
+    deployer = deploy_changes.DeployChanges(target_database=TARGET_DATABASE, cloning=False, properties=properties,
+                                            connection_pool=SnowflakeConnectionPool.from_properties(hook, properties))
+    report = deployer.run_release()
+    return len(report.succeeded), len(report.failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--change-logs', type=int, default=20)
+    parser.add_argument('--files', type=int, default=50, help='SQL files per change log')
+    parser.add_argument('--statements', type=int, default=5, help='INSERT statements per SQL file')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    with tempfile.TemporaryDirectory() as directory:
+        properties = write_release(directory, change_logs=args.change_logs, files=args.files,
+                                   statements=args.statements)
+        properties.update(history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE',
+                          history_cache_directory=None, content_cache_file=None)
+        counter = OpenCounter(directory)
+        bundle_file = Path(directory, 'release.bundle')
+        changes, elapsed, opened = counter.count(lambda: release_bundle.write_bundle(properties, bundle_file))
+        print(f'bundle built in {elapsed:.3f}s: {changes} changesets, '
+              f'{bundle_file.stat().st_size / 1024:.0f}KB, {opened} files opened')
+
+        bundled = dict(properties, release_bundle=str(bundle_file))
+        for name, source in (('sources', properties), ('bundle', bundled)):
+            size, elapsed, opened = counter.count(lambda: read_all(source))
+            print(f'read from {name:<8} {elapsed:7.3f}s, {opened:5d} files opened, {size} bytes of SQL')
+        for name, source in (('sources', properties), ('bundle', bundled)):
+            (succeeded, failed), elapsed, opened = counter.count(lambda: release(source))
+            print(f'release from {name:<8} {elapsed:7.3f}s, {opened:5d} files opened, {succeeded} changesets'
+                  f'{f", {failed} FAILED" if failed else ""}')
+
+
+if __name__ == '__main__':
+    main()
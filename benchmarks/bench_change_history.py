@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Compares looking up changes in the change history by scanning the fetched rows against the ChangeHistory index.
+
+    python -m benchmarks.bench_change_history --rows 100000 --lookups 1000
+"""
+import argparse
+import datetime
+import timeit
+
+from operators.change_history import ChangeHistory
+
+
+def history_rows(rows: int):
+    released = datetime.datetime(2021, 1, 1)
+    return [(f'change-{i}', 'author', f'sql/change_{i}.sql', released, f'changelog_{i // 100}.xml',
+             'JIRA-1', '1.0', 'comment', 1, 'success')
+            for i in range(rows)]
+
+
+def linear_scan(rows, id):
+    is_valid = True
+    for x in rows:
+        if x[0] == id and x[9] == 'success':
+            is_valid = False
+    return is_valid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=1000)
+    args = parser.parse_args()
+
+    rows = history_rows(args.rows)
+    ids = [f'change-{i * (args.rows // args.lookups)}' for i in range(args.lookups)]
+
+    build = timeit.timeit(lambda: ChangeHistory(rows), number=1)
+    history = ChangeHistory(rows)
+    indexed = timeit.timeit(lambda: [not history.is_released(id) for id in ids], number=1)
+    scanned = timeit.timeit(lambda: [linear_scan(rows, id) for id in ids], number=1)
+
+    print(f'{args.rows} history rows, {args.lookups} lookups')
+    print(f'linear scan:   {scanned:.4f}s ({scanned / args.lookups * 1e6:.1f}us per lookup)')
+    print(f'index build:   {build:.4f}s')
+    print(f'index lookups: {indexed:.4f}s ({indexed / args.lookups * 1e6:.3f}us per lookup)')
+
+
+if __name__ == '__main__':
+    main()
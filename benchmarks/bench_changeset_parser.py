@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Compares parsing changeset headers by scanning every line of a SQL file with the header-only compiled parser.
+
+    python -m benchmarks.bench_changeset_parser --files 2000 --statements 500
+"""
+from pathlib import Path
+import argparse
+import tempfile
+import timeit
+
+from operators.changeset_parser import parse_file
+
+
+def write_change_files(directory, files: int, statements: int):
+    paths = []
+    body = ''.join(f"INSERT INTO seed_table (id, label) VALUES ({i}, 'comment: labels: value {i}');\n"
+                   for i in range(statements))
+    for i in range(files):
+        path = Path(directory, f'change_{i}.sql')
+        path.write_text(f'--liquibase formatted sql\n\n'
+                        f'--changeset bench:change-{i} context:r{i % 10}\n'
+                        f'--comment: seeds table {i}\n'
+                        f'--labels: JIRA-{i}\n\n' + body)
+        paths.append(path)
+    return paths
+
+
+def split_parse(sqlfile):
+    """
+    The line scanning parser get_change_details used before changeset_parser
+    """
+    with open(sqlfile) as f:
+        content = f.readlines()
+    content = [x.strip() for x in content]
+    change_details = {}
+    for line in content:
+        if '--changeset' in line:
+            change_details['author'] = line.split(" ")[1][:line.split(" ")[1].find(':')]
+            change_details['id'] = line.split(" ")[1][line.split(" ")[1].find(':') + 1:]
+            change_details['release_number'] = line.split(" ")[2][line.split(" ")[2].find(':') + 1:]
+        elif 'comment:' in line and len(line) > len('--comment:'):
+            change_details['comments'] = line.split(" ")[1]
+        elif 'labels:' in line:
+            change_details['jira_number'] = line.split(" ")[1]
+    return change_details
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--statements', type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_change_files(directory, args.files, args.statements)
+        size = sum(path.stat().st_size for path in paths)
+        scanned = timeit.timeit(lambda: [split_parse(path) for path in paths], number=1)
+        compiled = timeit.timeit(lambda: [parse_file(path) for path in paths], number=1)
+
+    print(f'{args.files} files, {size / 1024 / 1024:.1f}MB')
+    print(f'line scanning parser: {scanned:.3f}s ({scanned / args.files * 1e6:.0f}us per file)')
+    print(f'header parser:        {compiled:.3f}s ({compiled / args.files * 1e6:.0f}us per file)')
+
+
+if __name__ == '__main__':
+    main()
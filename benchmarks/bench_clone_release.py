@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Runs releases to clones against the SQLite backed fake Snowflake connection: the target is cloned, the release is
+deployed to the clone, the clone is validated (views compiled, tables counted, validation queries) and swapped with
+the target, then the backups and failed clones past their retention are dropped. Reports the time of each phase,
+compares validating on one and on many connections with a round-trip latency, and checks that a release breaking
+a view is not swapped and leaves the target unchanged.
+
+    python -m benchmarks.bench_clone_release --tables 100 --latency 0.005 --workers 8
+"""
+from pathlib import Path
+import argparse
+import logging
+import tempfile
+import time
+
+from benchmarks.synthetic_release import write_release
+from core import deploy_changes
+from hooks.connection_pool import SnowflakeConnectionPool
+from hooks.fake_snowflake_hook import FakeSnowflakeConnectionHook
+from operators.clone_release import CloneValidator, clone_prefix
+
+TARGET_DATABASE = 'BENCH'
+BREAKING_CHANGE = ('--liquibase formatted sql\n\n'
+                   '--changeset bench:drop-existing-0\n'
+                   'DROP TABLE existing_0;\n')
+
+
+def seed_target(backend, tables: int):
+    """
+    Creates the target with tables holding rows and a view over each table
+    """
+    backend.execute(f'CREATE DATABASE {TARGET_DATABASE}')
+    for i in range(tables):
+        table = f'{TARGET_DATABASE}.PUBLIC.existing_{i}'
+        backend.execute(f'CREATE TABLE {table} (id int, label varchar(100))')
+        backend.execute(f"INSERT INTO {table} VALUES (1, 'a'), (2, 'b'), (3, 'c')")
+        backend.execute(f'CREATE VIEW {table}_v AS SELECT id FROM {table}')
+
+
+def release(hook, properties):
+    deployer = deploy_changes.DeployChanges(target_database=TARGET_DATABASE, cloning=True, properties=properties,
+                                            connection_pool=SnowflakeConnectionPool.from_properties(hook, properties))
+    report = deployer.run_release()
+    return deployer.clone_release, report
+
+
+def tables_of(backend, database):
+    return {row[1] for row in backend.execute(f"SELECT table_schema, table_name, table_type FROM "
+                                              f"{database}.INFORMATION_SCHEMA.TABLES WHERE table_schema <> "
+                                              f"'INFORMATION_SCHEMA'")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tables', type=int, default=100, help='tables (and views) in the target')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds added to every round-trip')
+    parser.add_argument('--workers', type=int, default=8, help='clone_release validation_workers')
+    parser.add_argument('--mode', choices=('threads', 'async'), default='threads', help='execution_mode')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        properties = write_release(directory, change_logs=2, files=5, statements=2)
+        properties.update(history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE',
+                          history_cache_directory=None, content_cache_file=None, execution_mode=args.mode,
+                          connection_pool={'max_size': args.workers + 1},
+                          clone_release={'validation_workers': args.workers, 'max_row_loss': 0.5,
+                                         'validation_queries': ['SELECT id FROM existing_1 WHERE id IS NULL'],
+                                         'retain_backups': 1, 'retain_failed': 1})
+        hook = FakeSnowflakeConnectionHook(database=TARGET_DATABASE, latency=args.latency, record=False)
+        backend = hook.backend
+        seed_target(backend, args.tables)
+        print(f'{args.tables} tables and views, {args.latency * 1000:.1f}ms round-trips')
+
+        clone_release, report = release(hook, properties)
+        target_tables = tables_of(backend, TARGET_DATABASE)
+        backup_tables = tables_of(backend, clone_release.kept)
+        statuses = {status for status, in backend.execute(
+            f'SELECT status FROM {TARGET_DATABASE}.HISTORY_SCHEMA.HISTORY_TABLE')}
+        ok = clone_release.swapped and not report.failed and 'BENCH_0_0' in target_tables and \
+            'BENCH_0_0' not in backup_tables and statuses == {'success'} and len(clone_release.checks) > 2 * args.tables
+        failed = failed or not ok
+        print(f'release   {clone_release.summary()}, {len(clone_release.checks)} checks{"" if ok else ", FAILED"}')
+
+        for workers in sorted({1, args.workers}):
+            validator = CloneValidator(SnowflakeConnectionPool(hook, max_size=workers + 1), workers=workers)
+            conn = hook.get_conn()
+            start = time.perf_counter()
+            checks = validator.validate(conn, TARGET_DATABASE, clone_release.kept)
+            elapsed = time.perf_counter() - start
+            print(f'validate, {workers:2d} connections: {elapsed:6.2f}s, {len(checks)} checks, '
+                  f'{sum(1 for check in checks if not check.ok)} failed')
+
+        # a release dropping a table a view reads is deployed to the clone but not swapped
+        Path(properties['change_log_directory'], 'changelog_break.xml').write_text(
+            '<databaseChangeLog>\n  <include file="break/drop.sql"/>\n</databaseChangeLog>\n')
+        Path(properties['root_sql_directory'], 'break').mkdir()
+        Path(properties['root_sql_directory'], 'break', 'drop.sql').write_text(BREAKING_CHANGE)
+        master = Path(properties['change_log_directory'], properties['master_change_log_name'])
+        master.write_text(master.read_text().replace('</databaseChangeLog>',
+                                                     '  <include file="changelog_break.xml"/>\n</databaseChangeLog>'))
+        clone_release, report = release(hook, properties)
+        failed_checks = [check.name for check in clone_release.failed_checks]
+        ok = not clone_release.swapped and failed_checks == ['PUBLIC.EXISTING_0_V'] and \
+            'EXISTING_0' in tables_of(backend, TARGET_DATABASE) and clone_release.kept.endswith('_FAILED')
+        failed = failed or not ok
+        print(f'breaking  {clone_release.summary()}, failed checks {failed_checks}{"" if ok else ", FAILED"}')
+
+        # releases with nothing to deploy still swap, only the most recent backup and failed clone are kept
+        master.write_text(master.read_text().replace('  <include file="changelog_break.xml"/>\n', ''))
+        for _ in range(3):
+            clone_release, _ = release(hook, properties)
+        left = [database for database in backend.list_databases()
+                if database.startswith(clone_prefix(TARGET_DATABASE))]
+        ok = len(left) == 2 and sum(database.endswith('_BACKUP') for database in left) == 1 and \
+            clone_release.kept in left
+        failed = failed or not ok
+        print(f'retention {len(left)} databases left: {left}{"" if ok else ", FAILED"}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
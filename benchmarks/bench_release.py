@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Releases a synthetic release against the SQLite backed fake Snowflake connection and reports changesets/sec,
+round-trips per changeset, peak memory and startup time. Results are appended to a JSON file so runs can be
+compared over time.
+
+    python -m benchmarks.bench_release --change-logs 10 --files 50 --history-rows 10000 --latency 0.02
+    python -m benchmarks.bench_release --workers 4 --independent --output benchmark_results.json
+"""
+from pathlib import Path
+import argparse
+import datetime
+import json
+import logging
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic_release import change_id, seed_history, write_release
+from core import deploy_changes
+from hooks.connection_pool import SnowflakeConnectionPool
+from hooks.fake_snowflake_hook import FakeSnowflakeConnectionHook
+from operators.statement_cache import stats as statement_stats
+
+ROOT = Path(__file__).resolve().parent.parent
+TARGET_DATABASE = 'BENCH'
+
+
+def import_time():
+    """
+    Seconds a fresh interpreter takes to import the release tool
+    """
+    code = 'import time; start = time.perf_counter(); import core.deploy_changes; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', code], cwd=str(ROOT), check=True, capture_output=True, text=True)
+    return float(output.stdout)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(ROOT), check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def release(args, release_properties, trace_memory=False):
+    """
+    Seeds a fresh fake account and releases the synthetic release to it
+    :return: dict of metrics
+    """
+    properties = dict(release_properties,
+                      history_schema='HISTORY_SCHEMA',
+                      history_table='HISTORY_TABLE',
+                      history_cache_directory=None,
+                      content_cache_file=None,
+                      release_journal_directory=str(Path(release_properties['root_sql_directory']).parent / 'journal')
+                      if args.journal else None,
+                      parallel_workers=args.workers,
+                      execution_mode=args.mode,
+                      async_max_in_flight=args.max_in_flight)
+    hook = FakeSnowflakeConnectionHook(database=TARGET_DATABASE, latency=args.latency,
+                                       connect_latency=args.connect_latency, failure_rate=args.failure_rate,
+                                       query_duration=args.latency, seed=args.seed)
+    released = int(args.change_logs * args.files * args.released_fraction)
+    seed_history(hook.backend, TARGET_DATABASE, properties['history_schema'], properties['history_table'],
+                 rows=args.history_rows,
+                 released=[(change_id(n // args.files, n % args.files), f'changelog_{n // args.files}.xml')
+                           for n in range(released)])
+    statement_stats.reset()
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    deployer = deploy_changes.DeployChanges(target_database=TARGET_DATABASE, cloning=False, properties=properties,
+                                            connection_pool=SnowflakeConnectionPool.from_properties(hook, properties))
+    init_time = time.perf_counter() - start
+    try:
+        report = deployer.deploy_release()
+    except SystemExit:
+        report = None
+    elapsed = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    changesets = len(report.succeeded) + len(report.failed) if report is not None else 0
+    return {'elapsed': elapsed,
+            'init_time': init_time,
+            'changesets': changesets,
+            'failed': len(report.failed) if report is not None else None,
+            'changesets_per_second': changesets / elapsed if elapsed else None,
+            'round_trips': hook.round_trips,
+            'round_trips_per_changeset': hook.round_trips / changesets if changesets else None,
+            'connections': len(hook.connections),
+            'parallelism': report.parallelism if report is not None else None,
+            'peak_memory': peak_memory,
+            'statements': statement_stats.as_dict()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--change-logs', type=int, default=10)
+    parser.add_argument('--files', type=int, default=20, help='SQL files per change log')
+    parser.add_argument('--statements', type=int, default=2, help='INSERT statements per SQL file')
+    parser.add_argument('--independent', action='store_true', help='changesets declare no dependencies')
+    parser.add_argument('--history-rows', type=int, default=1000, help='unrelated rows in the history table')
+    parser.add_argument('--released-fraction', type=float, default=0.0,
+                        help='fraction of the release already recorded as released')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per round-trip')
+    parser.add_argument('--connect-latency', type=float, default=0.0, help='seconds to open a connection')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability a statement fails')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='parallel_workers')
+    parser.add_argument('--mode', choices=('threads', 'async'), default='threads', help='execution_mode')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='async_max_in_flight')
+    parser.add_argument('--repeat', type=int, default=3, help='timed releases, the best is reported')
+    parser.add_argument('--journal', action='store_true', help='journal every statement (release_journal_directory)')
+    parser.add_argument('--halt-on-fail', action='store_true', help='stop the release at the first failure')
+    parser.add_argument('--output', help='JSON file the results are appended to')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    deploy_changes.halt_release_on_fail = args.halt_on_fail
+
+    with tempfile.TemporaryDirectory() as directory:
+        release_properties = write_release(directory, args.change_logs, args.files, args.statements,
+                                           independent=args.independent)
+        runs = [release(args, release_properties) for _ in range(args.repeat)]
+        memory = release(args, release_properties, trace_memory=True)
+
+    best = max(runs, key=lambda run: run['changesets_per_second'] or 0)
+    imports = import_time()
+    result = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+              'commit': git_commit(),
+              'python': platform.python_version(),
+              'parameters': vars(args),
+              'import_time': imports,
+              'startup_time': imports + best['init_time'],
+              'peak_memory': memory['peak_memory'],
+              'best': best,
+              'runs': runs}
+
+    print(f"{best['changesets']} changesets ({best['failed']} failed) in {best['elapsed']:.3f}s: "
+          f"{best['changesets_per_second']:.1f} changesets/sec, "
+          f"{best['round_trips_per_changeset'] or 0:.1f} round-trips per changeset, "
+          f"parallelism {best['parallelism']:.2f}")
+    print(f"startup {result['startup_time'] * 1000:.0f}ms (imports {result['import_time'] * 1000:.0f}ms), "
+          f"peak memory {result['peak_memory'] / 1024 / 1024:.1f}MB")
+
+    if args.output:
+        path = Path(args.output)
+        results = json.loads(path.read_text()) if path.exists() else []
+        results.append(result)
+        path.write_text(json.dumps(results, indent=2, default=str))
+        print(f'Results appended to {path}')
+
+
+if __name__ == '__main__':
+    main()
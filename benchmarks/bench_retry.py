@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Releases a synthetic release against the SQLite backed fake Snowflake connection with transient errors injected
+and checks how they are retried: lock timeouts are retried until the statements succeed, a lost session fails a
+CREATE TABLE (it may have run) but is retried for idempotent statements, a history insert whose response was lost
+is retried without writing the records twice, and a warehouse running few queries at once lowers the async queries
+in flight. Prints the retry stats of each scenario.
+
+    python -m benchmarks.bench_retry --change-logs 4 --files 10 --latency 0.002
+    python -m benchmarks.bench_retry --warehouse-concurrency 2 --max-in-flight 16
+"""
+from collections import Counter
+import argparse
+import logging
+import tempfile
+import time
+
+from benchmarks.synthetic_release import change_id, write_release
+from core import deploy_changes
+from hooks.connection_pool import SnowflakeConnectionPool
+from hooks.fake_snowflake_hook import FakeSnowflakeConnectionHook
+from operators.retry_policy import stats as retry_stats
+
+TARGET_DATABASE = 'BENCH'
+HISTORY_TABLE = f'{TARGET_DATABASE}.HISTORY_SCHEMA.HISTORY_TABLE'
+
+
+def release(args, release_properties, mode='threads', workers=None, **hook_kwargs):
+    """
+    Releases the synthetic release to a fresh fake account
+    :param hook_kwargs: FakeSnowflakeConnection arguments, e.g. transient_errors
+    :return: SchedulerReport, the hook, seconds taken
+    """
+    properties = dict(release_properties, history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE',
+                      history_cache_directory=None, content_cache_file=None, release_journal_directory=None,
+                      execution_mode=mode, parallel_workers=workers or args.workers,
+                      async_max_in_flight=args.max_in_flight,
+                      retry=dict({'max_attempts': 5, 'base_delay': args.base_delay, 'max_delay': 1.0,
+                                  'congestion_cooldown': args.query_duration}, **release_properties.get('retry', {})))
+    hook = FakeSnowflakeConnectionHook(database=TARGET_DATABASE, latency=args.latency, record=False, **hook_kwargs)
+    hook.backend.execute(f'CREATE DATABASE {TARGET_DATABASE}')
+    retry_stats.reset()
+    start = time.perf_counter()
+    deployer = deploy_changes.DeployChanges(target_database=TARGET_DATABASE, cloning=False, properties=properties,
+                                            connection_pool=SnowflakeConnectionPool.from_properties(hook, properties))
+    report = deployer.run_release()
+    return report, hook, time.perf_counter() - start
+
+
+def history(hook):
+    """
+    :return: Counter of the history records by change id, and the statuses recorded
+    """
+    rows = hook.backend.execute(f'SELECT id, status FROM {HISTORY_TABLE}')
+    return Counter(change for change, _ in rows), {status for _, status in rows}
+
+
+def check(name, ok, elapsed, detail=''):
+    print(f'{name:<22} {elapsed:6.2f}s  {retry_stats.summary()}{detail}{"" if ok else ", FAILED"}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--change-logs', type=int, default=4)
+    parser.add_argument('--files', type=int, default=10, help='SQL files per change log')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds per round-trip')
+    parser.add_argument('--workers', type=int, default=4, help='parallel_workers')
+    parser.add_argument('--max-in-flight', type=int, default=16, help='async_max_in_flight')
+    parser.add_argument('--base-delay', type=float, default=0.01, help='retry base_delay')
+    parser.add_argument('--warehouse-concurrency', type=int, default=2, help='async queries the warehouse runs at once')
+    parser.add_argument('--query-duration', type=float, default=0.05, help='seconds an async query runs')
+    parser.add_argument('--queued-timeout', type=float, default=0.2, help='seconds a query waits in the queue')
+    parser.add_argument('--max-slowdown', type=float, default=1.15,
+                        help='time of the adaptive limit allowed, relative to the fixed limit')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    deploy_changes.halt_release_on_fail = False
+    changes = args.change_logs * args.files
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        release_properties = write_release(directory, args.change_logs, args.files, statements=2, independent=True)
+
+        # the first INSERT of a third of the changes waits too long for a lock, twice
+        for mode in ('threads', 'async'):
+            lock_errors = [[rf'^INSERT INTO bench_{i}_{j} .*VALUES \(0,', 625, 2]
+                           for i in range(args.change_logs) for j in range(0, args.files, 3)]
+            report, hook, elapsed = release(args, release_properties, mode=mode, transient_errors=lock_errors)
+            records, statuses = history(hook)
+            ok = not report.failed and len(report.succeeded) == changes and retry_stats.retries > 0 and \
+                retry_stats.recovered > 0 and statuses == {'success'} and set(records.values()) == {1}
+            results.append(check(f'lock timeouts ({mode})', ok, elapsed))
+
+        # the session is lost after a CREATE TABLE ran: it is not retried, it failed or it would fail when rerun.
+        # The history fetch is a query, it is retried
+        session_errors = [[r'^CREATE TABLE bench_0_0 ', 390114, 1, True], [r'^SELECT .*HISTORY_TABLE', 390114, 1]]
+        report, hook, elapsed = release(args, release_properties, transient_errors=session_errors)
+        failed = [node.id for node in report.failed]
+        ok = failed == [change_id(0, 0)] and retry_stats.not_retried == 1 and retry_stats.session == 1 and \
+            retry_stats.recovered == 1 and len(report.succeeded) == changes - 1
+        results.append(check('lost session', ok, elapsed, f', failed {failed}'))
+
+        # the first history insert runs and its response is lost, the retry inserts nothing twice
+        insert_errors = [[r'^INSERT INTO \S+HISTORY_TABLE', 250003, 1, True]]
+        report, hook, elapsed = release(args, release_properties, workers=1, transient_errors=insert_errors)
+        records, statuses = history(hook)
+        ok = not report.failed and retry_stats.recovered == 1 and len(records) == changes and \
+            set(records.values()) == {1} and statuses == {'success'}
+        results.append(check('lost history insert', ok, elapsed, f', {sum(records.values())} history records'))
+
+        # async queries wait in the warehouse queue and time out when queued too long. With a fixed limit the
+        # queries in flight keep timing out, the adaptive limit lowers them to what the warehouse runs plus a queue
+        # as deep, so its throughput stays close to the warehouse's
+        overload, elapsed_by_limit = {}, {}
+        statements = changes * 3
+        best_time = statements * args.query_duration / args.warehouse_concurrency
+        for adaptive in (False, True):
+            properties = dict(release_properties)
+            if not adaptive:
+                properties['retry'] = {'adaptive_concurrency': False}
+            report, hook, elapsed = release(args, properties, mode='async', query_duration=args.query_duration,
+                                            warehouse_concurrency=args.warehouse_concurrency,
+                                            queued_timeout=args.queued_timeout)
+            overload[adaptive], elapsed_by_limit[adaptive] = retry_stats.overload, elapsed
+            ok = (retry_stats.limit_decreases > 0) == adaptive
+            if adaptive:
+                ok = ok and not report.failed and overload[True] < overload[False] and \
+                    retry_stats.lowest_limit >= args.warehouse_concurrency and \
+                    elapsed <= elapsed_by_limit[False] * args.max_slowdown
+            results.append(check(f'queued, {"adaptive" if adaptive else "fixed"} limit', ok, elapsed,
+                                 f', {len(report.failed)} failed, {statements / elapsed:.1f} statements/sec '
+                                 f'({statements / best_time:.1f} at best), {hook.round_trips} round-trips'))
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Releases one large data seeding change file against the SQLite backed fake Snowflake connection, once read and split
+in memory and once streamed, and reports the peak memory of each. Streamed, the peak memory is bounded by the largest
+statement instead of the file size.
+
+    python -m benchmarks.bench_streaming --size-mb 5 --rows-per-statement 1000
+"""
+from pathlib import Path
+import argparse
+import logging
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic_release import write_release
+from core import deploy_changes
+from hooks.connection_pool import SnowflakeConnectionPool
+from hooks.fake_snowflake_hook import FakeSnowflakeConnectionHook
+
+TARGET_DATABASE = 'BENCH'
+
+
+def write_seed_file(path, size_mb: float, rows_per_statement: int):
+    """
+    Rewrites a synthetic change file as a data seeding file of multi-row INSERT statements
+    :return: number of statements
+    """
+    header = ''.join(line for line in Path(path).read_text().splitlines(keepends=True) if line.startswith('--'))
+    statements = 0
+    with open(path, 'w') as f:
+        f.write(header + '\nCREATE TABLE bench_0_0 (id int, label varchar(100));\n')
+        row = 0
+        while f.tell() < size_mb * 1024 * 1024:
+            values = ',\n'.join(f"({row + i}, 'seed row {row + i}; ''quoted''')" for i in range(rows_per_statement))
+            f.write(f'-- batch {statements}; of seed rows\nINSERT INTO bench_0_0 (id, label) VALUES\n{values};\n')
+            row += rows_per_statement
+            statements += 1
+    return statements + 1
+
+
+def release(properties, streaming_threshold_mb):
+    properties = dict(properties, streaming_threshold_mb=streaming_threshold_mb)
+    hook = FakeSnowflakeConnectionHook(database=TARGET_DATABASE, record=False)
+    hook.backend.execute(f'CREATE DATABASE {TARGET_DATABASE}')
+    tracemalloc.start()
+    start = time.perf_counter()
+    deployer = deploy_changes.DeployChanges(target_database=TARGET_DATABASE, cloning=False, properties=properties,
+                                            connection_pool=SnowflakeConnectionPool.from_properties(hook, properties))
+    report = deployer.run_release()
+    elapsed = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rows = hook.backend.execute(f'SELECT COUNT(*) FROM {TARGET_DATABASE}.PUBLIC.bench_0_0')[0][0]
+    return elapsed, peak_memory, rows, len(report.failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=5, help='size of the seeding file')
+    parser.add_argument('--rows-per-statement', type=int, default=1000)
+    parser.add_argument('--mode', choices=('threads', 'async'), default='threads', help='execution_mode')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    with tempfile.TemporaryDirectory() as directory:
+        properties = write_release(directory, change_logs=1, files=1)
+        properties.update(history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE',
+                          history_cache_directory=None, content_cache_file=None, execution_mode=args.mode)
+        statements = write_seed_file(Path(properties['root_sql_directory'], '0', 'change_0.sql'), args.size_mb,
+                                     args.rows_per_statement)
+        print(f'{args.size_mb:.0f}MB seeding file, {statements} statements')
+        for name, threshold in (('in memory', args.size_mb * 2), ('streamed', args.size_mb / 2)):
+            elapsed, peak_memory, rows, failed = release(properties, threshold)
+            print(f'{name:<10} {elapsed:7.2f}s, peak memory {peak_memory / 1024 / 1024:7.1f}MB, {rows} rows'
+                  f'{", FAILED" if failed else ""}')
+
+
+if __name__ == '__main__':
+    main()
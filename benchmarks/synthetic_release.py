@@ -0,0 +1,74 @@
+"""
+Generators of synthetic releases and history tables for the benchmarks
+"""
+from pathlib import Path
+import datetime
+
+from operators.sql_templates import get_rendered_template
+
+
+def change_id(change_log: int, file: int):
+    return f'change-{change_log}-{file}'
+
+
+def write_release(directory, change_logs: int, files: int, statements: int = 2, independent: bool = False):
+    """
+    Writes a master manifest including change_logs change logs of files SQL files each
+    :param directory: release root, gets changelog/ and sql/ sub directories
+    :param change_logs: number of change logs
+    :param files: number of SQL files per change log
+    :param statements: INSERT statements per SQL file, after the CREATE TABLE
+    :param independent: mark every changeset independent with an empty --depends: header
+    :return: properties pointing at the release
+    """
+    change_log_directory = Path(directory, 'changelog')
+    sql_directory = Path(directory, 'sql')
+    change_log_directory.mkdir(parents=True, exist_ok=True)
+    sql_directory.mkdir(parents=True, exist_ok=True)
+
+    includes = ''.join(f'  <include file="changelog_{i}.xml"/>\n' for i in range(change_logs))
+    Path(change_log_directory, 'master.xml').write_text(f'<databaseChangeLog>\n{includes}</databaseChangeLog>\n')
+    depends = '--depends:\n' if independent else ''
+    for i in range(change_logs):
+        includes = ''.join(f'  <include file="{i}/change_{j}.sql"/>\n' for j in range(files))
+        Path(change_log_directory, f'changelog_{i}.xml').write_text(
+            f'<databaseChangeLog>\n{includes}</databaseChangeLog>\n')
+        Path(sql_directory, str(i)).mkdir(exist_ok=True)
+        for j in range(files):
+            table = f'bench_{i}_{j}'
+            body = ''.join(f"INSERT INTO {table} (id, label) VALUES ({k}, 'row {k}');\n" for k in range(statements))
+            Path(sql_directory, str(i), f'change_{j}.sql').write_text(
+                f'--liquibase formatted sql\n\n'
+                f'--changeset bench:{change_id(i, j)} context:r{i}\n'
+                f'--comment: creates {table}\n'
+                f'--labels: BENCH-{i}\n'
+                f'{depends}\n'
+                f'CREATE TABLE {table} (id int, label varchar(100));\n' + body)
+
+    return {'change_log_directory': str(change_log_directory),
+            'master_change_log_name': 'master.xml',
+            'root_sql_directory': str(sql_directory)}
+
+
+def seed_history(backend, database: str, history_schema: str, history_table: str, rows: int,
+                 released=()):
+    """
+    Creates the history table in a FakeBackend and fills it with rows of unrelated released changes
+    :param backend: hooks.fake_snowflake_hook.FakeBackend
+    :param database: database holding the history table
+    :param history_schema: history schema
+    :param history_table: history table
+    :param rows: number of unrelated history rows
+    :param released: (id, change_log) of release changes to record as released
+    """
+    backend.execute(get_rendered_template('create_release_log_history_table.j2', database=database,
+                                          history_schema=history_schema, history_table=history_table))
+    insert = get_rendered_template('insert_into_release_log_history_table.j2',
+                                   history_table=f'{database}.{history_schema}.{history_table}')
+    date_released = datetime.datetime(2020, 1, 1)
+    for i in range(rows):
+        backend.execute(insert, (f'history-{i}', 'bench', f'history/{i}.sql', date_released, f'history_{i // 100}.xml',
+                                 None, None, None, 1, 'success', None))
+    for id, change_log in released:
+        backend.execute(insert, (id, 'bench', f'{id}.sql', date_released, change_log, None, None, None, 1, 'success',
+                                 None))
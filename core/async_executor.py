@@ -0,0 +1,354 @@
+from collections import deque
+import logging
+import re
+import time
+
+from snowflake.connector.errors import DatabaseError, ProgrammingError
+
+from core.scheduler import SchedulerReport
+from operators.instrumentation import instrumentation
+from operators.retry_policy import OVERLOAD, RetryPolicy, transaction_open
+from operators.snowflake_operator import STREAMED_QUERY_IDS
+
+logger = logging.getLogger(__name__)
+
+# statements that change the session, a changeset running them cannot share the session with other changesets
+SESSION_STATEMENT = re.compile(r'^\s*(USE\s|ALTER\s+SESSION\s|BEGIN|START\s+TRANSACTION|COMMIT|ROLLBACK)',
+                               re.IGNORECASE)
+# query statuses of a statement waiting for the warehouse or for a lock, the limiter lowers the queries in flight
+QUEUED_STATUSES = ('QUEUED', 'QUEUED_REPARING_WAREHOUSE', 'BLOCKED')
+
+
+class AsyncResult:
+    """
+    Outcome of the statements of one changeset
+    """
+    __slots__ = ('id', 'query_ids', 'statements', 'error', 'elapsed', 'skipped')
+
+    def __init__(self, id: str):
+        self.id = id
+        self.query_ids = []
+        # statements that completed, only the last query ids of a streamed changeset are kept
+        self.statements = 0
+        self.error = None
+        self.elapsed = 0.0
+        # prepared but never submitted, the release halted while it waited to run alone
+        self.skipped = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return f'AsyncResult({self.id}, ok={self.ok}, queries={len(self.query_ids)})'
+
+
+class _Job:
+    __slots__ = ('node', 'statements', 'statement', 'count', 'position', 'cursor', 'sfqid', 'submitted', 'result',
+                 'started', 'exclusive', 'attempt', 'retry_at', 'epoch', 'in_transaction')
+
+    def __init__(self, node, statements):
+        self.node = node
+        if isinstance(statements, (list, tuple)):
+            self.count = len(statements)
+            self.exclusive = any(SESSION_STATEMENT.match(statement) for statement in statements)
+        else:
+            # streamed from a large file, whether it changes the session is not known until it ran
+            self.count = None
+            self.exclusive = True
+        self.statements = iter(statements)
+        self.statement = next(self.statements, None)
+        self.position = 0
+        self.cursor = None
+        self.sfqid = None
+        self.submitted = None
+        self.result = AsyncResult(node.id)
+        if self.count is None:
+            self.result.query_ids = deque(maxlen=STREAMED_QUERY_IDS)
+        self.started = time.perf_counter()
+        # failed attempts of the current statement, and when it is submitted again
+        self.attempt = 0
+        self.retry_at = None
+        # limiter epoch the statement was submitted in, see AdaptiveLimiter.congested
+        self.epoch = None
+        # an explicit transaction of the changeset is open, its statements are not retried on their own
+        self.in_transaction = False
+
+    def advance(self):
+        """
+        Moves to the next statement
+        :return: False when all statements ran
+        """
+        self.in_transaction = transaction_open(self.statement, self.in_transaction)
+        self.position += 1
+        self.attempt = 0
+        self.statement = next(self.statements, None)
+        return self.statement is not None
+
+
+class AsyncStatementExecutor:
+    """
+    Releases changesets on a single connection with Snowflake asynchronous queries. The statements of a changeset
+    run in order, independent changesets (see scheduler.build_change_set_graph) have their statements in flight
+    at the same time. Running queries are polled with a backoff that grows while nothing completes. A statement
+    failing with a transient error is submitted again after the retry policy's backoff, without holding up the
+    other changesets, and fewer changesets are started while the warehouse queues their queries.
+    """
+    def __init__(self, conn, max_in_flight: int = 8, halt_on_fail: bool = True, min_poll_interval: float = 0.05,
+                 max_poll_interval: float = 2.0, poll_backoff: float = 1.5, retry_policy: RetryPolicy = None,
+                 limiter=None):
+        """
+        :param conn: snowflake connection supporting execute_async (snowflake-connector-python 2.5+)
+        :param max_in_flight: maximum number of queries running at once
+        :param halt_on_fail: stop submitting changesets after the first failure
+        :param min_poll_interval: seconds between polls while queries complete
+        :param max_poll_interval: upper bound of the poll interval while queries keep running
+        :param poll_backoff: factor the poll interval grows by after a poll where nothing completed
+        :param retry_policy: retries statements failing with transient errors, never retried if None
+        :param limiter: retry_policy.AdaptiveLimiter, its limit bounds the changesets in flight below max_in_flight
+        """
+        self.conn = conn
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=1)
+        self.limiter = limiter
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.halt_on_fail = halt_on_fail
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_backoff = poll_backoff
+        self.results = {}
+        self.polls = 0
+        self._statement_complete = None
+
+    def run(self, nodes, prepare, complete, statement_complete=None, restore_session=None):
+        """
+        Releases the changesets in dependency order
+        :param nodes: linked ChangeSetNode objects from build_change_set_graph
+        :param prepare: callable taking a node, returns the node's statements, a list or an iterator of statements
+                        streamed from a large file, or None if the node is not released (e.g. already in the history
+                        table). A ProgrammingError or DatabaseError raised fails the node.
+        :param complete: callable taking a node and its AsyncResult, called when the node's statements finished, or
+                         with a skipped result for a prepared node that was not run because the release halted
+        :param statement_complete: callable taking a node, the index of a statement in the statements returned by
+                                   prepare, the statement and its query id, called when the statement succeeded
+        :param restore_session: callable making the release context current again, called after a changeset that
+                                may have changed the session finished and before other statements are submitted.
+                                A ProgrammingError or DatabaseError raised halts the release.
+        :return: SchedulerReport, results by changeset id are in self.results
+        """
+        report = SchedulerReport()
+        start = time.perf_counter()
+        self._statement_complete = statement_complete
+        remaining = {id(node) for node in nodes}
+        ready = deque(node for node in nodes if node.pending == 0)
+        in_flight = []
+        waiting = None
+        halted = False
+        interval = self.min_poll_interval
+
+        while ready or in_flight or waiting:
+            # a changeset that changes the session waits until it can run alone
+            if waiting is not None and not in_flight:
+                self._submit(waiting)
+                in_flight.append(waiting)
+                waiting = None
+
+            while ready and waiting is None and not halted and len(in_flight) < self._max_in_flight() \
+                    and not any(job.exclusive for job in in_flight):
+                node = ready.popleft()
+                try:
+                    statements = prepare(node)
+                except (ProgrammingError, DatabaseError) as e:
+                    # e.g. the upload of a bulk load failed
+                    logger.error(f'Changeset {node.id} failed before its statements were submitted: {e}')
+                    result = AsyncResult(node.id)
+                    result.error = e
+                    self.results[node.id] = result
+                    complete(node, result)
+                    self._finish(node, False, report, remaining)
+                    if self.halt_on_fail and not halted:
+                        logger.error(f'Stopping async release: {node.id} failed and halt_release_on_fail is True, '
+                                     f'waiting for {len(in_flight)} changesets in flight')
+                        halted = True
+                    continue
+                job = _Job(node, statements) if statements is not None else None
+                if job is None or job.statement is None:
+                    result = AsyncResult(node.id)
+                    self.results[node.id] = result
+                    complete(node, result)
+                    ready.extend(self._finish(node, True, report, remaining))
+                    continue
+                if job.exclusive and in_flight:
+                    waiting = job
+                    break
+                self._submit(job)
+                in_flight.append(job)
+            report.max_in_flight = max(report.max_in_flight, len(in_flight))
+
+            if not in_flight:
+                if halted or waiting is None:
+                    break
+                continue
+
+            finished, completed = self._poll(in_flight)
+            for job in finished:
+                in_flight.remove(job)
+                job.result.elapsed = time.perf_counter() - job.started
+                report.busy_time += job.result.elapsed
+                self.results[job.node.id] = job.result
+                complete(job.node, job.result)
+                ready.extend(self._finish(job.node, job.result.ok, report, remaining))
+                if not job.result.ok and self.halt_on_fail and not halted:
+                    logger.error(f'Stopping async release: {job.node.id} failed and halt_release_on_fail is True, '
+                                 f'waiting for {len(in_flight)} changesets in flight')
+                    halted = True
+                if job.exclusive and restore_session is not None and not halted:
+                    # it ran alone, nothing is in flight on the session it may have changed
+                    try:
+                        restore_session()
+                    except (ProgrammingError, DatabaseError) as e:
+                        logger.error(f'Stopping async release: the session cannot be restored after {job.node.id}: '
+                                     f'{e}')
+                        halted = True
+            if halted and waiting is not None:
+                # prepared, e.g. tracked in the history table, but never submitted
+                waiting.result.skipped = True
+                self.results[waiting.node.id] = waiting.result
+                complete(waiting.node, waiting.result)
+                waiting = None
+
+            if completed:
+                # a statement of a multi-statement changeset completing is progress too, the next one was submitted
+                interval = self.min_poll_interval
+            else:
+                retry_at = min((job.retry_at for job in in_flight if job.retry_at is not None), default=None)
+                time.sleep(interval if retry_at is None else max(0.0, min(interval, retry_at - time.monotonic())))
+                interval = min(interval * self.poll_backoff, self.max_poll_interval)
+
+        report.skipped.extend(node for node in nodes if id(node) in remaining)
+        report.wall_time = time.perf_counter() - start
+        logger.info(f'Async release finished: {report.summary()}, {self.polls} status polls')
+        return report
+
+    def _max_in_flight(self):
+        if self.limiter is None:
+            return self.max_in_flight
+        return min(self.max_in_flight, self.limiter.limit)
+
+    def _retry(self, job):
+        """
+        Schedules the failed statement of a changeset to be submitted again when its error is transient
+        :return: True if the statement is retried
+        """
+        job.attempt += 1
+        error = job.result.error
+        delay = self.retry_policy.retry_delay(error, job.attempt, statement=job.statement,
+                                              description=f'Statement {job.position + 1} of change {job.node.id} '
+                                                          f'(query id {job.sfqid})',
+                                              in_transaction=job.in_transaction)
+        if delay is None:
+            return False
+        if self.limiter is not None and self.retry_policy.classify(error) == OVERLOAD:
+            self.limiter.congested(epoch=job.epoch)
+        job.result.error = None
+        job.sfqid = None
+        job.retry_at = time.monotonic() + delay
+        return True
+
+    @staticmethod
+    def _finish(node, ok, report, remaining):
+        remaining.discard(id(node))
+        if not ok:
+            report.failed.append(node)
+            return []
+        report.succeeded.append(node)
+        released = []
+        for dependant in node.dependants:
+            dependant.pending -= 1
+            if dependant.pending == 0:
+                released.append(dependant)
+        return released
+
+    def _submit(self, job):
+        """
+        Submits the next statement of a changeset
+        """
+        try:
+            job.cursor = job.cursor or self.conn.cursor()
+            job.submitted = time.time()
+            job.epoch = self.limiter.epoch if self.limiter is not None else None
+            job.sfqid = job.cursor.execute_async(job.statement)['queryId']
+            job.result.query_ids.append(job.sfqid)
+            logger.debug(f'Submitted {job.node.id} statement {job.position + 1}/{job.count or "?"}: {job.sfqid}')
+        except (ProgrammingError, DatabaseError) as e:
+            job.sfqid = None
+            job.result.error = e
+
+    def _poll(self, in_flight):
+        """
+        Checks the status of the running queries, submitting the next statement of changesets whose query finished
+        :return: jobs that completed all statements or failed, number of queries that completed or failed
+        """
+        finished = []
+        completed = 0
+        # statements waiting in the warehouse queue and running, latest limiter epoch of the queued statements
+        queued = running = 0
+        queued_epoch = None
+        for job in list(in_flight):
+            if job.retry_at is not None:
+                if time.monotonic() < job.retry_at:
+                    continue
+                job.retry_at = None
+                self._submit(job)
+                if job.result.error is not None and not self._retry(job):
+                    finished.append(job)
+                continue
+            if job.sfqid is not None:
+                self.polls += 1
+                try:
+                    status = self.conn.get_query_status(job.sfqid)
+                    if self.conn.is_still_running(status):
+                        if getattr(status, 'name', None) not in QUEUED_STATUSES:
+                            running += 1
+                        else:
+                            queued += 1
+                            if job.epoch is not None:
+                                queued_epoch = job.epoch if queued_epoch is None else max(queued_epoch, job.epoch)
+                        continue
+                    if self.conn.is_an_error(status):
+                        self.conn.get_query_status_throw_if_error(job.sfqid)
+                    job.cursor.get_results_from_sfqid(job.sfqid)
+                except (ProgrammingError, DatabaseError) as e:
+                    job.result.error = e
+                if instrumentation.enabled:
+                    instrumentation.record('statement', job.submitted, time.time(),
+                                           error=str(job.result.error) if job.result.error is not None else None,
+                                           changeset=job.node.id, position=job.position + 1, query_id=job.sfqid,
+                                           rows=job.cursor.rowcount if job.result.error is None else None)
+
+            completed += 1
+            if job.result.error is not None:
+                if self._retry(job):
+                    continue
+                logger.error(f'Changeset {job.node.id} failed on statement {job.position + 1} '
+                             f'(query id {job.sfqid}): {job.result.error}')
+                finished.append(job)
+                continue
+
+            if job.attempt:
+                self.retry_policy.stats.add(recovered=1)
+            if self.limiter is not None:
+                self.limiter.succeeded()
+            job.result.statements += 1
+            if self._statement_complete is not None and job.sfqid is not None:
+                self._statement_complete(job.node, job.position, job.statement, job.sfqid)
+            if job.advance():
+                self._submit(job)
+                if job.result.error is not None and not self._retry(job):
+                    finished.append(job)
+            else:
+                finished.append(job)
+        if queued_epoch is not None and queued > running:
+            # a queue as deep as what the warehouse runs keeps it busy between polls, a deeper queue only waits.
+            # Statements submitted before the last decrease were counted by it, see AdaptiveLimiter.congested
+            self.limiter.congested(epoch=queued_epoch, floor=2 * running)
+        return finished, completed
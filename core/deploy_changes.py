@@ -1,26 +1,26 @@
-from operators import manifest_reader as filereader, snowflake_operator as sfm
+from operators import manifest_reader as filereader, release_bundle, snowflake_operator as sfm
+from operators.bulk_load import BulkLoader
+from operators.clone_release import CloneRelease, CloneValidator, clone_prefix, expired_databases
+from operators.content_cache import ContentCache
+from operators.instrumentation import instrumentation
+from operators.release_journal import ReleaseJournal
+from operators.retry_policy import AdaptiveLimiter, RetryPolicy, RetryStats, stats as retry_stats
+from operators.statement_cache import StatementStats, stats as statement_stats, stream_statements
+from core.async_executor import AsyncStatementExecutor
+from core.scheduler import ChangeSetNode, ChangeSetScheduler, build_change_set_graph
 from pathlib import Path
+import contextlib
 import datetime
-import logging.config
-import yaml
+import itertools
+import logging
+import threading
+import time
 import sys
-
-
-def setup_logging(default_path='config/logging_config.yaml'):
-    """
-    Sets the logging for the application
-    :param default_path: Logging config location
-    """
-    path = default_path
-    with open(path, 'rt') as f:
-        log_cfg = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_cfg)
+from snowflake.connector.errors import DatabaseError, ProgrammingError
 
 
 logger = logging.getLogger(__name__)
 
-change_log_status = []
-
 halt_release_on_fail = True
 
 
@@ -29,29 +29,108 @@ class DeployChanges(object):
     Deploys changes found in the manifest files, according to the variables in the properties files and run time
     parameters
     """
-    def __init__(self, target_database, cloning, properties):
-        self.changes_deployed = []
+    def __init__(self, target_database, cloning, properties, connection_pool=None, parsed_release=None,
+                 content_cache=None):
+        """
+        :param target_database: Target database for release
+        :param cloning: release to a clone of the target database
+        :param properties: Dictionary of the properties yaml file
+        :param connection_pool: pool to release on, one is created from the properties if None
+        :param parsed_release: change files by change log from manifest_reader.read_release, shared by the targets
+                               of a fan-out release, read from the release_bundle of the properties or from the
+                               manifests if None
+        :param content_cache: ContentCache to use, one is loaded from the properties if None
+        """
+        # 1 for each change log that failed to release, 0 for each that was released
+        self.change_log_status = {}
         self.change_log_directory = properties.get('change_log_directory')
-        self.master_change_log_name = properties('master_change_log_name')
+        self.master_change_log_name = properties.get('master_change_log_name')
         self.master_change_log_file = Path(self.change_log_directory, self.master_change_log_name)
         self.root_sql_directory = properties.get('root_sql_directory')
         self.properties = properties
         self.target_database = target_database
         self.cloning = cloning
+        self.parallel_workers = int(properties.get('parallel_workers') or 1)
+        self.execution_mode = (properties.get('execution_mode') or 'threads').lower()
+        self.async_max_in_flight = int(properties.get('async_max_in_flight') or 8)
+        if parsed_release is None and properties.get('release_bundle'):
+            # the bundle holds the parsed manifests and headers, bodies are read from it when released
+            parsed_release = release_bundle.read_release(properties)
+        self.parsed_release = parsed_release
+        self.content_cache = content_cache or ContentCache(cache_file=properties.get('content_cache_file'))
+        self.checksum_mismatch = (properties.get('checksum_mismatch') or 'warn').lower()
+        self.journal_directory = properties.get('release_journal_directory')
+        # SQL files larger than this are streamed instead of read and split in memory
+        self.streaming_threshold = float(properties.get('streaming_threshold_mb') or 64) * 1024 * 1024
+        self.journal = None
+        # counters of this release, the targets of a fan-out release run at once and each reports its own
+        self.statement_stats = StatementStats(parent=statement_stats)
+        self.retry_stats = RetryStats(parent=retry_stats)
+        # splits, compresses and stages the data files of bulk load changesets
+        self.bulk_loader = BulkLoader.from_properties(properties)
+        # a fan-out release configures instrumentation once for all its targets
+        self._owns_instrumentation = not instrumentation.enabled
+        if self._owns_instrumentation:
+            instrumentation.configure_from_properties(properties)
+        self.connection_pool = connection_pool or sfm.SnowflakeOperator.get_connection_pool(**properties)
+        if 1 < self.parallel_workers >= self.connection_pool.max_size:
+            # the release connection is held for the whole release, each worker needs one more
+            logger.warning(f'connection_pool max_size {self.connection_pool.max_size} is too small for '
+                           f'{self.parallel_workers} parallel_workers, using {self.connection_pool.max_size - 1}')
+            self.parallel_workers = max(1, self.connection_pool.max_size - 1)
+        # statements in flight across the workers, or the async queries in flight, lowered when the warehouse queues
+        self.limiter = AdaptiveLimiter.from_properties(
+            properties, max_limit=self.async_max_in_flight if self.execution_mode == 'async' else self.parallel_workers,
+            stats=self.retry_stats)
+        # releases with cloning: validation of the clone before the swap and retention of the databases left over
+        self.clone_validator = CloneValidator.from_properties(self.connection_pool, properties)
+        clone_properties = properties.get('clone_release') or {}
+        retain_backups, retain_failed = clone_properties.get('retain_backups'), clone_properties.get('retain_failed')
+        self.retain_backups = 1 if retain_backups is None else int(retain_backups)
+        self.retain_failed = 1 if retain_failed is None else int(retain_failed)
+        # CloneRelease of the release when cloning
+        self.clone_release = None
         self.snowflake_manager = DeployChanges.get_snowflake_manager(target_database=target_database,
-                                                                     properties=properties)
+                                                                     properties=properties,
+                                                                     conn=self.connection_pool.acquire(),
+                                                                     statement_stats=self.statement_stats,
+                                                                     retry_stats=self.retry_stats)
+        # each scheduler worker thread deploys on its own connection
+        self.snowflake_manager.limiter = self.limiter
+        self._worker_state = threading.local()
+        self._worker_state.manager = self.snowflake_manager
+        self._worker_managers = []
+        self._worker_lock = threading.Lock()
 
     @staticmethod
-    def get_snowflake_manager(target_database, **properties):
+    def get_snowflake_manager(target_database, properties, conn=None, statement_stats=statement_stats,
+                              retry_stats=retry_stats):
         """
         Creates a Snowflake Manager instance based on the properties connection details
         :param target_database: Target database for release
         :param properties: Dictionary of teh properties yaml file
+        :param conn: connection to use, a new connection is opened if None
+        :param statement_stats: StatementStats of the release
+        :param retry_stats: RetryStats of the release
         """
-        sf = sfm.SnowflakeOperator(conn=sfm.get_conn(properties),
+        if conn is None:
+            conn = sfm.SnowflakeOperator.get_conn(**properties)
+        history_flush_seconds = properties.get('history_flush_seconds')
+        sf = sfm.SnowflakeOperator(conn=conn,
                                    target_database=target_database,
                                    history_schema=properties.get('history_schema'),
-                                   history_table=properties.get('history_table'))
+                                   history_table=properties.get('history_table'),
+                                   history_batch_size=int(properties.get('history_batch_size') or 50),
+                                   history_flush_interval=10.0 if history_flush_seconds is None
+                                   else float(history_flush_seconds),
+                                   history_cache_directory=properties.get('history_cache_directory'),
+                                   history_watermark_column=properties.get('history_watermark_column')
+                                   or 'date_released',
+                                   history_cache_overlap=datetime.timedelta(
+                                       hours=float(properties.get('history_cache_overlap_hours') or 24)),
+                                   history_fetch_size=int(properties.get('history_fetch_size') or 10000),
+                                   retry_policy=RetryPolicy.from_properties(properties, stats=retry_stats),
+                                   statement_stats=statement_stats)
         return sf
 
     def _deployable_changes(self):
@@ -59,89 +138,482 @@ class DeployChanges(object):
         Checks the changes in the change log file against changes in the database history tables
         changes that are not successfully released to teh history table are deployable changes
         """
-        for change_history in self.snowflake_manager.get_database_change_history():
-            self.changes_deployed.append(change_history[4]) \
-                if change_history[4] not in self.changes_deployed else self.changes_deployed
+        change_history = self.snowflake_manager.get_database_change_history()
+        self._open_journal(change_history)
 
-        change_log_files = filereader.read_xml_files(xml_file=self.master_change_log_file,
-                                                     source_file_directory=self.change_log_directory)
+        if self.parsed_release is not None:
+            return list(self.parsed_release)
+        change_log_files = filereader.read_manifest(xml_file=self.master_change_log_file,
+                                                    content_cache=self.content_cache)
         return change_log_files
 
+    def _open_journal(self, change_history):
+        """
+        Opens the release journal of the database released to and reconciles it with its history table
+        :param change_history: ChangeHistory of the database
+        """
+        if not self.journal_directory or self.cloning:
+            # every release to a clone starts from a new clone of the target, nothing released earlier is resumed
+            return
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = ReleaseJournal(journal_directory=self.journal_directory,
+                                      database=self.snowflake_manager.history_database)
+        self.journal.reconcile(change_history)
+        self.snowflake_manager.journal = self.journal
+
     def _clone_target(self):
         """
         If the cloning variable is true, will clone the target database and release to the clone
         """
         if self.cloning:
-            logger.info(f'Cloning {self.target_database}')
-            self.snowflake_manager.clone_database(target_database=self.target_database)
+            self.clone_release = CloneRelease(self.target_database)
+            with self.clone_release.phase('clone'):
+                self.clone_release.clone = self.snowflake_manager.clone_database(target_database=self.target_database)
         else:
-            logger.info((f'Deploying directly to {self.target_database}, clongin parameter set to {str(self.cloning)}'))
+            logger.info(f'Deploying directly to {self.target_database}, cloning parameter set to {str(self.cloning)}')
             self.snowflake_manager.deploy_database_name = self.target_database
 
-    def deploy_sql_change_set(self, change_log_file):
+    def _finish_clone_release(self, report):
+        """
+        Validates the clone a release was deployed to and swaps it with the target, then applies the retention
+        policy to the databases left over. The clone is not swapped when a changeset or a validation failed.
+        :param report: SchedulerReport of the release to the clone
+        """
+        clone_release = self.clone_release
+        manager = self.snowflake_manager
+        if report.failed:
+            logger.error(f'Not validating {clone_release.clone}: {len(report.failed)} changesets failed')
+        else:
+            with clone_release.phase('validate'):
+                clone_release.checks = self.clone_validator.validate(manager.conn, clone_release.clone,
+                                                                     self.target_database)
+        if report.failed or clone_release.failed_checks:
+            logger.error(f'Not swapping {clone_release.clone} with {self.target_database}: '
+                         f'{len(report.failed)} changesets and {len(clone_release.failed_checks)} validations failed')
+            self._mark_clone('failed')
+        else:
+            try:
+                with clone_release.phase('swap'):
+                    manager.swap_database(clone_release.clone, self.target_database)
+            except (ProgrammingError, DatabaseError) as e:
+                # the swap is atomic, the target is unchanged and the clone is kept as a failed release
+                logger.error(f'Could not swap {clone_release.clone} with {self.target_database}: {e}')
+                clone_release.error = str(e)
+                self._mark_clone('failed')
+            else:
+                clone_release.swapped = True
+                self._mark_clone('backup')
+
+        with clone_release.phase('cleanup'):
+            databases = manager.list_databases(clone_prefix(self.target_database))
+            for status, retain in (('backup', self.retain_backups), ('failed', self.retain_failed)):
+                for database in expired_databases(databases, self.target_database, status, retain):
+                    try:
+                        manager.drop_database(database)
+                    except (ProgrammingError, DatabaseError) as e:
+                        # the release is done, the database is dropped by the next release
+                        logger.error(f'Could not drop {database}: {e}')
+                        continue
+                    clone_release.dropped.append(database)
+            if clone_release.kept in clone_release.dropped:
+                clone_release.kept = None
+        logger.info(clone_release.summary())
+
+    def _mark_clone(self, status: str):
+        """
+        Renames the clone with its status, so the retention policy finds it. A clone that cannot be renamed keeps
+        its name and is left for housekeeping by hand
+        :param status: backup or failed
         """
-        Releases the SQL files in the change manifest file in the order listed within the file
+        clone_release = self.clone_release
+        try:
+            clone_release.kept = self.snowflake_manager.mark_database_release(status)
+        except (ProgrammingError, DatabaseError) as e:
+            logger.error(f'Could not mark {clone_release.clone} as {status.upper()}, it is kept as it is: {e}')
+            clone_release.error = clone_release.error or str(e)
+            clone_release.kept = self.snowflake_manager.deploy_database_name
+
+    def _worker_manager(self):
+        """
+        Returns the Snowflake Manager for the current scheduler worker, borrowing a pooled connection on first use
+        """
+        manager = getattr(self._worker_state, 'manager', None)
+        if manager is None:
+            manager = DeployChanges.get_snowflake_manager(target_database=self.target_database,
+                                                          properties=self.properties,
+                                                          conn=self.connection_pool.acquire(),
+                                                          statement_stats=self.statement_stats,
+                                                          retry_stats=self.retry_stats)
+            manager.deploy_database_name = self.snowflake_manager.deploy_database_name
+            manager.change_history = self.snowflake_manager.change_history
+            manager.journal = self.journal
+            manager.limiter = self.limiter
+            self._worker_state.manager = manager
+            with self._worker_lock:
+                self._worker_managers.append(manager)
+        return manager
+
+    def _close_worker_managers(self):
+        with self._worker_lock:
+            for manager in self._worker_managers:
+                manager.flush_history()
+                self.connection_pool.release(manager.conn, session_changed=manager.session_changed)
+            self._worker_managers = []
+        logger.debug(f'Connection pool stats: {self.connection_pool.stats.as_dict()}')
+
+    def close(self):
+        """
+        Writes buffered history records, returns the release connection and closes the connection pool
+        """
+        self._close_worker_managers()
+        self.snowflake_manager.flush_history()
+        if self.journal is not None:
+            # the history table records the released changes now, their journal records are no longer needed
+            self.journal.compact()
+            self.journal.close()
+        self.connection_pool.release(self.snowflake_manager.conn,
+                                     session_changed=self.snowflake_manager.session_changed)
+        self.connection_pool.close()
+        self.content_cache.save()
+        if self._owns_instrumentation:
+            if instrumentation.enabled:
+                logger.info(f'Slowest changesets:\n{instrumentation.summary()}')
+            instrumentation.reset()
+
+    def _is_released(self, id, checksum, sql_file):
+        """
+        Checks if a change is already released to the target, comparing the file checksum with the checksum
+        recorded when it was released
+        :param id: the unique id for the change
+        :param checksum: checksum of the SQL file content
+        :param sql_file: SQL file location for logging
+        :return: True if the change is released
+        """
+        record = self.snowflake_manager.change_history.get(id)
+        if record is None or record.status != 'success':
+            return False
+        if record.checksum is not None and record.checksum != checksum:
+            message = f'Change {id} in {sql_file} was edited after it was released to {self.target_database}'
+            if self.checksum_mismatch == 'fail':
+                raise ValueError(message)
+            logger.warning(message)
+        return True
+
+    def _change_set_nodes(self, change_log_file):
+        """
+        Streams the SQL files in a change manifest file and returns a changeset node per file in manifest order.
+        Only the comment headers are read here, SQL bodies are read when the changes are released. Files that are
+        unchanged since they were cached and whose change is already released are not read at all.
         :param change_log_file: File name containing a list of the sql files for release
         """
-        sql_files = filereader.read_xml_files(xml_file=Path(self.change_log_directory, change_log_file),
-                                              source_file_directory=self.root_sql_directory)
         logger.debug(f'Starting to extract sql files from {change_log_file}')
 
-        for key in sql_files:
-            # database error 0 for no error, 1 is an error
-            if self.snowflake_manager.database_error == 0:
-                change_metadata = self.snowflake_manager.get_change_details(sqlfile=f'{self.root_sql_directory}/{key}',
-                                                                            date_released=datetime.datetime.now(),
-                                                                            change_log=change_log_file)
-
-                # track_change_in_history_table returns true if successful, false if error
-                if self.snowflake_manager.track_change_in_history_table(**change_metadata):
-
-                    # deploy_change_to_target sets snowflake_manager.database_error
-                    self.snowflake_manager.deploy_change_to_target(sqlfile=f'{sql_files[key]}',
-                                                                   database=self.target_database,
-                                                                   author=change_metadata['author'],
-                                                                   id=change_metadata['id'])
-                    if self.snowflake_manager.database_error == 0:
-                        self.snowflake_manager.set_change_status(status='success',
-                                                                 id=f"{change_metadata['id']}")
-                    elif self.snowflake_manager.database_error == 1:
-                        self.snowflake_manager.set_change_status(status='failed',
-                                                                 id=f"{change_metadata['id']}")
-        # record the status of database_error for the sql file. this allows releases to stop or continue if a
+        if self.parsed_release is not None:
+            change_files = self.parsed_release[change_log_file]
+        else:
+            change_files = filereader.iter_change_files(xml_file=Path(self.change_log_directory, change_log_file),
+                                                        source_file_directory=self.root_sql_directory,
+                                                        content_cache=self.content_cache)
+        nodes = []
+        for change_file in change_files:
+            cached = self.content_cache.lookup(change_file.path) if self._cacheable(change_file) else None
+            if cached is not None and self._is_released(cached.get('id'), cached.get('checksum'), change_file.file):
+                logger.debug(f'Skipping {change_file.file}, change {cached.get("id")} is already released')
+                continue
+
+            with instrumentation.span('parse', file=change_file.file) as span:
+                change_metadata = self.snowflake_manager.get_change_details(
+                    sqlfile=f'{self.root_sql_directory}/{change_file.file}',
+                    date_released=datetime.datetime.now(),
+                    change_log=change_log_file,
+                    changeset=change_file.changeset)
+                span.set(changeset=change_metadata.get('id'))
+            if change_metadata.get('id') is None:
+                # the history table records a change by id, a change without one would run on every release
+                raise ValueError(f'{change_file.file} in {change_log_file} has no --changeset line with an id, '
+                                 f'every change needs a unique id')
+
+            if self.snowflake_manager.change_history.is_released(change_metadata.get('id')):
+                checksum = change_file.compute_checksum()
+                if self._cacheable(change_file):
+                    self.content_cache.update(change_file.path, id=change_metadata.get('id'), checksum=checksum)
+                self._is_released(change_metadata.get('id'), checksum, change_file.file)
+                logger.debug(f'Skipping {change_file.file}, change {change_metadata.get("id")} is already released')
+                continue
+
+            nodes.append(ChangeSetNode(id=change_metadata.get('id'),
+                                       change_log=change_log_file,
+                                       change_file=change_file,
+                                       change_details=change_metadata))
+        return nodes
+
+    @staticmethod
+    def _cacheable(change_file):
+        # the content cache tracks files by size and modification time, not the files of a directory
+        # a bundled file has no path, its checksum comes from the bundle
+        return change_file.path is not None and (change_file.kind == 'sql' or not change_file.path.is_dir())
+
+    def _read_change_set(self, node):
+        """
+        Reads the SQL body of a changeset and records its checksum. Files larger than streaming_threshold_mb are
+        not read here, their checksum is computed in chunks and their statements are streamed when released. The
+        data files of a bulk load are only hashed, they are read when they are prepared for loading.
+        :param node: ChangeSetNode to release
+        :return: SQL text, None for a file that is streamed or loaded
+        """
+        if node.change_file.kind == 'load':
+            sql = None
+            node.change_file.compute_checksum()
+        elif node.change_file.size > self.streaming_threshold:
+            logger.info(f'Streaming {node.change_file.file}, {node.change_file.size / 1024 / 1024:.0f}MB')
+            sql = None
+            node.change_file.compute_checksum()
+        else:
+            sql = node.change_file.read_sql()
+        node.change_details['checksum'] = node.change_file.checksum
+        if self._cacheable(node.change_file):
+            self.content_cache.update(node.change_file.path, id=node.id, checksum=node.change_file.checksum)
+        return sql
+
+    def _deploy_change_set_node(self, node):
+        """
+        Releases a single changeset on the worker's connection and records it in the history table
+        :param node: ChangeSetNode to release
+        :return: True if the change was released or was already released, False on error
+        """
+        with instrumentation.span('changeset', changeset=node.id, change_log=node.change_log,
+                                  database=self.target_database) as span:
+            snowflake_manager = self._worker_manager()
+            snowflake_manager.database_error = 0
+            change_metadata = node.change_details
+
+            sql = self._read_change_set(node)
+
+            # track_change_in_history_table returns true if successful, false if error
+            if snowflake_manager.track_change_in_history_table(**change_metadata):
+
+                # deploy_change_to_target and load_change_to_target set snowflake_manager.database_error
+                if node.change_file.kind == 'load':
+                    query_ids = snowflake_manager.load_change_to_target(
+                        load_file=node.change_file,
+                        database=snowflake_manager.deploy_database_name,
+                        author=change_metadata['author'],
+                        id=change_metadata['id'],
+                        loader=self.bulk_loader)
+                else:
+                    query_ids = snowflake_manager.deploy_change_to_target(
+                        sqlfile=sql,
+                        database=snowflake_manager.deploy_database_name,
+                        author=change_metadata['author'],
+                        id=change_metadata['id'],
+                        checksum=change_metadata.get('checksum'),
+                        statements=stream_statements(node.change_file.open_sql, self.statement_stats)
+                        if sql is None else None)
+                if snowflake_manager.database_error == 0:
+                    if self.journal is not None:
+                        self.journal.released(change_metadata['id'])
+                    snowflake_manager.set_change_status(status='success',
+                                                        id=f"{change_metadata['id']}")
+                elif snowflake_manager.database_error == 1:
+                    snowflake_manager.set_change_status(status='failed',
+                                                        id=f"{change_metadata['id']}")
+                span.set(statements=len(query_ids) if query_ids is not None else None)
+            span.set(status='success' if snowflake_manager.database_error == 0 else 'failed')
+        return snowflake_manager.database_error == 0
+
+    def _run_change_sets_async(self, nodes):
+        """
+        Releases changesets on the release connection with asynchronous queries, independent changesets have
+        statements in flight at the same time
+        :param nodes: linked ChangeSetNode objects
+        :return: SchedulerReport
+        """
+        snowflake_manager = self.snowflake_manager
+        # the target, or its clone
+        snowflake_manager.use_database(snowflake_manager.deploy_database_name)
+        tracked = set()
+        # position of the first statement executed and number of replayed session statements, by changeset id
+        prepared = {}
+        journal = self.journal
+
+        def prepare(node):
+            sql = self._read_change_set(node)
+            if not snowflake_manager.track_change_in_history_table(**node.change_details):
+                return None
+            tracked.add(node.id)
+            if node.change_file.kind == 'load':
+                # the files are uploaded here, PUT transfers files from this machine and cannot run asynchronously
+                try:
+                    return [snowflake_manager.stage_load_files(node.change_file, node.id, self.bulk_loader, [])]
+                except (OSError, ValueError) as e:
+                    raise ProgrammingError(f'Cannot prepare {node.change_file.file} for loading: {e}')
+            if sql is None:
+                statements = stream_statements(node.change_file.open_sql, self.statement_stats)
+            else:
+                statements = snowflake_manager.split_statements(sql, checksum=node.change_details.get('checksum'))
+            if journal is None:
+                return statements
+            position, session_statements, remaining = journal.resume(node.id, statements)
+            if position:
+                logger.info(f"Resuming change {node.change_details['author']}:{node.id} at statement "
+                            f"{position + 1}, the statements before it were released by a previous run")
+            prepared[node.id] = (position, len(session_statements))
+            if sql is None:
+                return itertools.chain(session_statements, remaining)
+            return session_statements + list(remaining)
+
+        def statement_complete(node, index, statement, query_id):
+            if node.id not in prepared:
+                # a bulk load, not journaled
+                return
+            position, replayed = prepared[node.id]
+            if index >= replayed:
+                journal.statement(node.id, position + index - replayed + 1, statement, query_id)
+
+        def complete(node, result):
+            if node.id not in tracked:
+                return
+            if result.skipped:
+                logger.info(f"Change {node.change_details['author']}:{node.id} was not run, the release halted")
+                snowflake_manager.set_change_status(status='skipped', id=node.id)
+                return
+            self.statement_stats.add(statements_executed=result.statements, execute_time=result.elapsed)
+            if instrumentation.enabled:
+                end = time.time()
+                instrumentation.record('changeset', end - result.elapsed, end, changeset=node.id,
+                                       change_log=node.change_log, database=self.target_database,
+                                       statements=result.statements, status='success' if result.ok else 'failed')
+            if result.ok:
+                logger.info(f"Released change {node.change_details['author']}:{node.id} "
+                            f"in {result.elapsed:.2f}s, {result.statements} statements, "
+                            f"query ids {', '.join(result.query_ids)}")
+            else:
+                logger.info(f"Failed to release change {node.change_details['author']}:{node.id}, check errors")
+            if result.ok and journal is not None:
+                journal.released(node.id)
+            snowflake_manager.set_change_status(status='success' if result.ok else 'failed', id=node.id)
+
+        executor = AsyncStatementExecutor(conn=snowflake_manager.conn,
+                                          max_in_flight=self.async_max_in_flight,
+                                          halt_on_fail=halt_release_on_fail,
+                                          retry_policy=snowflake_manager.retry_policy,
+                                          limiter=self.limiter)
+        return executor.run(nodes, prepare=prepare, complete=complete,
+                            statement_complete=statement_complete if journal is not None else None,
+                            restore_session=lambda: snowflake_manager.restore_session(
+                                snowflake_manager.deploy_database_name, self.connection_pool.session_parameters))
+
+    def _change_set_graph(self, nodes):
+        """
+        Links the changeset nodes, a changeset depending on one that is listed after it or that is neither in the
+        release nor released fails the release before anything runs
+        :param nodes: ChangeSetNode objects in manifest order
+        :return: the nodes, linked
+        """
+        return build_change_set_graph(nodes, is_released=self.snowflake_manager.change_history.is_released)
+
+    def _run_change_sets(self, nodes):
+        """
+        Releases changesets through the scheduler and records the status of each change log
+        :param nodes: linked ChangeSetNode objects from _change_set_graph, in manifest order
+        :return: SchedulerReport
+        """
+        try:
+            if self.execution_mode == 'async':
+                report = self._run_change_sets_async(nodes)
+            else:
+                scheduler = ChangeSetScheduler(max_workers=self.parallel_workers, halt_on_fail=halt_release_on_fail)
+                report = scheduler.run(nodes, self._deploy_change_set_node)
+        finally:
+            self._close_worker_managers()
+            self.snowflake_manager.flush_history()
+
+        # record the status of database_error for the change logs. this allows releases to stop or continue if a
         # sql file fails.
-        change_log_status.append((int(self.snowflake_manager.database_error)))
+        failed_logs = {node.change_log for node in report.failed}
+        for change_log in dict.fromkeys(node.change_log for node in nodes):
+            self.change_log_status[change_log] = int(change_log in failed_logs)
+            if change_log in failed_logs:
+                logger.info(f'Failed to release: {change_log} to {self.target_database}')
+            else:
+                logger.info(f'Finished: {change_log} on {self.target_database}')
+        if report.failed:
+            self.snowflake_manager.database_error = 1
+        return report
 
-    def deploy_release(self):
+    def deploy_sql_change_set(self, change_log_file):
         """
-        Reads the feature manifest file and releases the changes in the order listed.
+        Releases the SQL files in the change manifest file in the order listed within the file, unless the
+        changesets declare their own dependencies with --depends:
+        :param change_log_file: File name containing a list of the sql files for release
         """
-        setup_logging()
+        return self._run_change_sets(self._change_set_graph(self._change_set_nodes(change_log_file)))
 
+    def run_release(self):
+        """
+        Reads the feature manifest file and releases the changes. Changes are released in the order listed unless
+        they declare dependencies, independent changes are released concurrently on parallel_workers connections.
+        The status of each change log is recorded in change_log_status.
+        :return: SchedulerReport
+        """
         logger.info(f'Starting to deploy changes for database {self.target_database}')
 
-        # Will clone the target database if the clone parameter is True
-        self._clone_target()
+        try:
+            # Get changes from file not already released to the database. A clone starts with the history of the
+            # target, which is read through the target's history cache before the target is cloned
+            deployable_change_files = self._deployable_changes()
 
-        changes_deployed = []
+            nodes = []
+            for log_file in deployable_change_files:
+                logger.info(f'Changelog {log_file} found..')
+                nodes.extend(self._change_set_nodes(change_log_file=log_file))
+            # broken dependencies fail the release before the target is cloned
+            nodes = self._change_set_graph(nodes)
 
-        # Get changes from file not already released to the database
-        deployable_change_files = self._deployable_changes()
+            # Will clone the target database if the clone parameter is True
+            self._clone_target()
 
-        for log_file in deployable_change_files:
-            if log_file not in changes_deployed and self.snowflake_manager.database_error == 0:
-                logger.info(f'Changelog {log_file} found..')
+            try:
+                with self.clone_release.phase('deploy') if self.cloning else contextlib.nullcontext():
+                    report = self._run_change_sets(nodes)
+            except BaseException as e:
+                if self.cloning:
+                    # the clone is marked FAILED for the retention policy instead of being left under its plain name
+                    logger.error(f'Release to {self.clone_release.clone} raised, not swapping it with '
+                                 f'{self.target_database}')
+                    self.clone_release.error = f'{type(e).__name__}: {e}'
+                    self._mark_clone('failed')
+                    logger.info(self.clone_release.summary())
+                raise
 
-                self.deploy_sql_change_set(change_log_file=log_file)
+            if self.cloning:
+                self._finish_clone_release(report)
+        finally:
+            self.close()
+        logger.info(f'Release finished with parallelism {report.parallelism:.2f} '
+                    f'({self.execution_mode} execution, max {report.max_in_flight} changesets in flight)')
+        logger.info(f'Statements: {self.statement_stats.summary()}')
+        if self.retry_stats.retries or self.retry_stats.not_retried or self.retry_stats.limit_decreases:
+            logger.info(f'Retries: {self.retry_stats.summary()}')
+        return report
 
-                if self.snowflake_manager.database_error == 1:
-                    logger.info(f'Failed to release: {log_file}')
-                else:
-                    logger.info(f'Finished: {log_file}')
+    def deploy_release(self):
+        """
+        Releases the changes, exiting the process when a change log failed, or a clone was not swapped, and
+        halt_release_on_fail is True
+        :return: SchedulerReport
+        """
+        report = self.run_release()
 
-            if halt_release_on_fail and 1 in change_log_status:
-                logger.error('Stopping release: halt_release_on_fail is True')
-                sys.exit(1)
+        if halt_release_on_fail and 1 in self.change_log_status.values():
+            logger.error('Stopping release: halt_release_on_fail is True')
+            sys.exit(1)
 
-        if 1 in change_log_status:
-            logger.info('ATTENTION: Databases not swapped because of errors')
+        if self.clone_release is not None and not self.clone_release.swapped:
+            kept = self.clone_release.kept
+            logger.info(f'ATTENTION: Databases not swapped because of errors, the clone is '
+                        f'{"kept as " + kept if kept else "dropped"}')
+            if halt_release_on_fail:
+                sys.exit(1)
+        return report
@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from fnmatch import fnmatchcase
+import logging
+import time
+
+from core import deploy_changes
+from hooks.connection_pool import SnowflakeConnectionPool
+from hooks.snowflake_hook import SnowflakeConnection
+from operators import release_bundle
+from operators.content_cache import ContentCache
+from operators.instrumentation import instrumentation
+
+logger = logging.getLogger(__name__)
+
+GLOB_CHARACTERS = ('*', '?', '[')
+
+
+def is_pattern(target: str):
+    return any(character in target for character in GLOB_CHARACTERS)
+
+
+def resolve_targets(targets, conn=None):
+    """
+    Expands database name patterns (fnmatch style, e.g. TENANT_*, matched case-insensitively) against the databases
+    of the account. Database names are kept as given
+    :param targets: database names and patterns
+    :param conn: snowflake connection used to list the databases, only needed for patterns
+    :return: list of database names in the order given, without duplicates
+    """
+    databases = None
+    resolved = {}
+    for target in targets:
+        if not is_pattern(target):
+            resolved[target] = None
+            continue
+        if databases is None:
+            # SHOW TERSE DATABASES returns created_on, name, kind, database_name, schema_name
+            databases = sorted(row[1] for row in conn.cursor().execute('SHOW TERSE DATABASES').fetchall())
+        matches = [database for database in databases if fnmatchcase(database.upper(), target.upper())]
+        if not matches:
+            logger.warning(f'No databases match {target}')
+        for database in matches:
+            resolved[database] = None
+    return list(resolved)
+
+
+def share_release(parsed_release):
+    """
+    Reads the changeset header and the checksum of every change file once, before the targets read them at the
+    same time. They are set lazily on the change files, which are shared by the target threads without a lock.
+    :param parsed_release: change files by change log, see release_bundle.read_release
+    :return: parsed_release
+    """
+    for change_files in parsed_release.values():
+        for change_file in change_files:
+            change_file.changeset
+            change_file.compute_checksum()
+    return parsed_release
+
+
+class TargetResult:
+    """
+    Outcome of the release to one target database
+    """
+    __slots__ = ('database', 'status', 'change_logs', 'succeeded', 'failed', 'skipped', 'elapsed', 'error')
+
+    def __init__(self, database: str):
+        self.database = database
+        # success, failed (changes failed), error (the release could not run) or cancelled (fail_fast)
+        self.status = 'cancelled'
+        self.change_logs = {}
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.elapsed = 0.0
+        self.error = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class FanOutReport:
+    """
+    Per target results of a fan-out release
+    """
+    def __init__(self, targets):
+        self.results = {database: TargetResult(database) for database in targets}
+        self.change_logs = []
+        self.wall_time = 0.0
+
+    @property
+    def ok(self):
+        return all(result.status == 'success' for result in self.results.values())
+
+    def as_dict(self):
+        return {'wall_time': self.wall_time, 'change_logs': self.change_logs,
+                'targets': [result.as_dict() for result in self.results.values()]}
+
+    def matrix(self):
+        """
+        Table of targets by change log: ok, FAILED, or - when the change log had nothing to release
+        :return: text table
+        """
+        width = max([len('database')] + [len(database) for database in self.results])
+        header = f'{"database":<{width}}  {"status":<9}  {"ok":>5}  {"failed":>6}  {"skipped":>7}  {"seconds":>8}'
+        lines = [header + ''.join(f'  {change_log}' for change_log in self.change_logs)]
+        for result in self.results.values():
+            line = f'{result.database:<{width}}  {result.status:<9}  {result.succeeded:>5}  {result.failed:>6}  ' \
+                   f'{result.skipped:>7}  {result.elapsed:>8.2f}'
+            for change_log in self.change_logs:
+                status = result.change_logs.get(change_log)
+                cell = '-' if status is None else ('FAILED' if status else 'ok')
+                line += f'  {cell:<{len(change_log)}}'
+            if result.error:
+                line += f'  {result.error}'
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+class FanOutDeployment:
+    """
+    Releases one release to many target databases. The manifests and changeset headers are read once and shared,
+    each target is released by its own DeployChanges with its own connection pool and history state, up to
+    max_concurrency targets at a time.
+    """
+    def __init__(self, targets, cloning, properties, max_concurrency: int = None, fail_fast: bool = None,
+                 hook=None):
+        """
+        :param targets: target database names or fnmatch patterns (e.g. TENANT_*)
+        :param cloning: release to clones of the target databases
+        :param properties: Dictionary of the properties yaml file
+        :param max_concurrency: targets released at once, fan_out.max_concurrency in the properties if None
+        :param fail_fast: cancel targets not started yet once a target fails, fan_out.fail_fast if None
+        :param hook: SnowflakeConnection hook the connections are opened with, created from the properties if None
+        """
+        fan_out_properties = properties.get('fan_out') or {}
+        self.targets = list(targets)
+        self.cloning = cloning
+        self.properties = properties
+        self.max_concurrency = max(1, int(max_concurrency or fan_out_properties.get('max_concurrency') or 4))
+        self.fail_fast = fan_out_properties.get('fail_fast', False) if fail_fast is None else fail_fast
+        self.hook = hook or SnowflakeConnection(**properties)
+
+    def resolve_targets(self):
+        """
+        :return: target database names, patterns are expanded with SHOW TERSE DATABASES
+        """
+        if not any(is_pattern(target) for target in self.targets):
+            return resolve_targets(self.targets)
+        conn = self.hook.get_conn()
+        try:
+            return resolve_targets(self.targets, conn)
+        finally:
+            conn.close()
+
+    def run(self):
+        """
+        Releases to all targets
+        :return: FanOutReport
+        """
+        start = time.perf_counter()
+        instrumentation.configure_from_properties(self.properties)
+        content_cache = ContentCache(cache_file=self.properties.get('content_cache_file'))
+        try:
+            targets = self.resolve_targets()
+            report = FanOutReport(targets)
+            parsed_release = share_release(release_bundle.read_release(self.properties, content_cache=content_cache))
+            report.change_logs = list(parsed_release)
+            logger.info(f'Releasing {sum(len(files) for files in parsed_release.values())} changes in '
+                        f'{len(parsed_release)} change logs to {len(targets)} databases, '
+                        f'{self.max_concurrency} at a time')
+
+            queue = iter(targets)
+            with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='fan-out') as executor:
+                # targets are submitted as others finish, so fail_fast stops the targets not started yet
+                pending = set()
+                halted = False
+                while True:
+                    while not halted and len(pending) < self.max_concurrency:
+                        database = next(queue, None)
+                        if database is None:
+                            break
+                        pending.add(executor.submit(self._release_target, report.results[database],
+                                                    parsed_release, content_cache))
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        if result.status != 'success' and self.fail_fast and not halted:
+                            logger.error(f'Release to {result.database} {result.status}, fail_fast is set: '
+                                         f'not starting the remaining targets')
+                            halted = True
+        finally:
+            content_cache.save()
+            if instrumentation.enabled:
+                logger.info(f'Slowest changesets:\n{instrumentation.summary()}')
+            instrumentation.reset()
+
+        report.wall_time = time.perf_counter() - start
+        logger.info(f'Fan-out release finished in {report.wall_time:.2f}s:\n{report.matrix()}')
+        return report
+
+    def _release_target(self, result, parsed_release, content_cache):
+        """
+        Releases to one target on its own connection pool
+        :param result: TargetResult to fill
+        """
+        start = time.perf_counter()
+        try:
+            deployer = deploy_changes.DeployChanges(
+                target_database=result.database,
+                cloning=self.cloning,
+                properties=self.properties,
+                connection_pool=SnowflakeConnectionPool.from_properties(self.hook, self.properties,
+                                                                        instrumentation=instrumentation),
+                parsed_release=parsed_release,
+                content_cache=content_cache)
+            scheduler_report = deployer.run_release()
+        except Exception as e:
+            logger.exception(f'Release to {result.database} failed')
+            result.status = 'error'
+            result.error = f'{type(e).__name__}: {e}'
+        else:
+            result.change_logs = dict(deployer.change_log_status)
+            result.succeeded = len(scheduler_report.succeeded)
+            result.failed = len(scheduler_report.failed)
+            result.skipped = len(scheduler_report.skipped)
+            # a release to a clone that was not swapped left the target unchanged
+            not_swapped = deployer.clone_release is not None and not deployer.clone_release.swapped
+            result.status = 'failed' if scheduler_report.failed or not_swapped else 'success'
+        result.elapsed = time.perf_counter() - start
+        return result
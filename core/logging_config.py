@@ -0,0 +1,22 @@
+from pathlib import Path
+import logging.config
+
+# the logging config ships with the properties, independent of the working directory
+LOGGING_CONFIG_FILE = Path(__file__).resolve().parent.parent / 'conf' / 'logging_config.yaml'
+
+
+def setup_logging(default_path=LOGGING_CONFIG_FILE):
+    """
+    Sets the logging for the application
+    :param default_path: Logging config location
+    """
+    import yaml
+
+    path = default_path
+    with open(path, 'rt') as f:
+        log_cfg = yaml.safe_load(f.read())
+    # file handlers fail to open their log file when its directory does not exist yet
+    for handler in log_cfg.get('handlers', {}).values():
+        if handler.get('filename'):
+            Path(handler['filename']).parent.mkdir(parents=True, exist_ok=True)
+    logging.config.dictConfig(log_cfg)
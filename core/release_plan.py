@@ -0,0 +1,194 @@
+from pathlib import Path
+from typing import NamedTuple
+import datetime
+import logging
+import xml.etree.ElementTree as ET
+
+from core.scheduler import ChangeSetNode, build_change_set_graph
+from operators import manifest_reader as filereader, release_bundle
+from operators.change_history import ChangeHistory
+from operators.history_cache import HistoryCache
+
+logger = logging.getLogger(__name__)
+
+
+class PlannedChange:
+    """
+    A changeset of the release and what a release to the target would do with it
+    """
+    __slots__ = ('change_log', 'file', 'id', 'author', 'state', 'wave')
+
+    def __init__(self, change_log: str, file: str, id: str, author: str, state: str):
+        self.change_log = change_log
+        self.file = file
+        self.id = id
+        self.author = author
+        # pending, released, or edited (released, but the file changed since)
+        self.state = state
+        # pending changes in the same wave have no dependencies between them and can be released concurrently
+        self.wave = None
+
+
+class LintIssue(NamedTuple):
+    level: str
+    location: str
+    message: str
+
+    def __str__(self):
+        return f'{self.level.upper()}: {self.location}: {self.message}'
+
+
+def load_cached_history(properties: dict, target_database: str):
+    """
+    Reads the change history of a target from the local history cache, never connects to Snowflake
+    :param properties: Dictionary of the properties yaml file
+    :param target_database: database holding the history table
+    :return: ChangeHistory, None if there is no cache for the target
+    """
+    cache_directory = properties.get('history_cache_directory')
+    if not cache_directory:
+        return None
+    history_table = f'{target_database}.{properties.get("history_schema")}.{properties.get("history_table")}'
+    cache = HistoryCache(cache_directory=cache_directory,
+                         history_table=history_table,
+                         watermark_column=properties.get('history_watermark_column') or 'date_released',
+                         overlap=datetime.timedelta(
+                             hours=float(properties.get('history_cache_overlap_hours') or 24)))
+    cached = cache.load()
+    if cached is None:
+        return None
+    change_history = ChangeHistory()
+    change_history.extend(cached[0])
+    return change_history
+
+
+def _read_release(properties: dict):
+    return release_bundle.read_release(properties)
+
+
+def plan_release(properties: dict, change_history: ChangeHistory = None):
+    """
+    Lists the changesets of the release with their state against a change history and the wave each pending
+    changeset would be released in
+    :param properties: Dictionary of the properties yaml file
+    :param change_history: history of the target, every changeset is pending if None
+    :return: list of PlannedChange in manifest order
+    """
+    planned = []
+    nodes = []
+    for change_log, change_files in _read_release(properties).items():
+        for change_file in change_files:
+            changeset = change_file.changeset
+            change = PlannedChange(change_log, change_file.file, changeset.id, changeset.author, 'pending')
+            record = change_history.get(changeset.id) if change_history is not None else None
+            if record is not None and record.status == 'success':
+                edited = record.checksum is not None and record.checksum != change_file.compute_checksum()
+                change.state = 'edited' if edited else 'released'
+            else:
+                node = ChangeSetNode(id=changeset.id, change_log=change_log, change_file=change_file,
+                                     change_details=changeset.to_change_details())
+                nodes.append((node, change))
+            planned.append(change)
+
+    waves = {}
+    build_change_set_graph((node for node, _ in nodes),
+                           is_released=change_history.is_released if change_history is not None else None)
+    for node, change in nodes:
+        change.wave = waves[id(node)] = 1 + max((waves[id(parent)] for parent in node.depends), default=0)
+    return planned
+
+
+def format_plan(planned):
+    """
+    :param planned: PlannedChange list from plan_release
+    :return: text table
+    """
+    width = max([len('changeset')] + [len(str(change.id)) for change in planned])
+    lines = [f'{"wave":>4}  {"state":<8}  {"changeset":<{width}}  file']
+    for change in planned:
+        lines.append(f'{change.wave or "":>4}  {change.state:<8}  {str(change.id):<{width}}  '
+                     f'{change.change_log}/{change.file}')
+    pending = [change for change in planned if change.state == 'pending']
+    waves = max((change.wave for change in pending), default=0)
+    lines.append(f'{len(pending)} of {len(planned)} changesets to release in {waves} waves')
+    return '\n'.join(lines)
+
+
+def _lint_load_file(location: str, load_file):
+    """
+    Checks the include attributes and the data files of a bulk load changeset
+    :return: list of LintIssue
+    """
+    issues = []
+    if load_file.changeset.id is None or load_file.changeset.author is None:
+        issues.append(LintIssue('error', location, 'no id and author attributes on the load include'))
+    if not load_file.table:
+        issues.append(LintIssue('error', location, 'no table attribute on the load include'))
+    if load_file.format not in filereader.LOAD_FORMATS:
+        issues.append(LintIssue('error', location, f'unsupported load format {load_file.format}, use one of '
+                                                   f'{", ".join(filereader.LOAD_FORMATS)}'))
+    elif not load_file.path.exists():
+        issues.append(LintIssue('error', location, 'cannot read the data file: it does not exist'))
+    elif not load_file.data_files():
+        issues.append(LintIssue('warning', location, f'no .{load_file.format} files to load'))
+    return issues
+
+
+def lint_release(properties: dict):
+    """
+    Checks the manifests and changeset headers of the release without connecting to Snowflake
+    :param properties: Dictionary of the properties yaml file
+    :return: list of LintIssue
+    """
+    issues = []
+    change_log_directory = properties.get('change_log_directory')
+    master = Path(change_log_directory, properties.get('master_change_log_name'))
+    try:
+        change_logs = filereader.read_manifest(master)
+    except (OSError, ET.ParseError) as e:
+        return [LintIssue('error', str(master), f'cannot read the master manifest: {e}')]
+
+    changesets = []
+    for change_log in change_logs:
+        try:
+            files = filereader.read_manifest(Path(change_log_directory, change_log))
+        except (OSError, ET.ParseError) as e:
+            issues.append(LintIssue('error', change_log, f'cannot read the change log: {e}'))
+            continue
+        for include in files:
+            change_file = filereader.make_change_file(include, properties.get('root_sql_directory'))
+            location = f'{change_log}/{change_file.file}'
+            if change_file.kind == 'load':
+                issues.extend(_lint_load_file(location, change_file))
+                if change_file.changeset.id is not None:
+                    changesets.append((location, change_file.changeset))
+                continue
+            try:
+                changeset = change_file.changeset
+                body = change_file.read_sql()
+            except (OSError, UnicodeDecodeError) as e:
+                issues.append(LintIssue('error', location, f'cannot read the SQL file: {e}'))
+                continue
+            if changeset.id is None:
+                issues.append(LintIssue('error', location, 'no --changeset author:id header'))
+                continue
+            if not body.strip():
+                issues.append(LintIssue('warning', location, 'no SQL statements'))
+            changesets.append((location, changeset))
+
+    positions = {}
+    for position, (location, changeset) in enumerate(changesets):
+        if changeset.id in positions:
+            issues.append(LintIssue('error', location, f'duplicate changeset id {changeset.id}, also in '
+                                                       f'{changesets[positions[changeset.id]][0]}'))
+        else:
+            positions[changeset.id] = position
+    for position, (location, changeset) in enumerate(changesets):
+        for depend_id in changeset.depends or ():
+            if depend_id == changeset.id:
+                issues.append(LintIssue('error', location, 'depends on itself'))
+            elif positions.get(depend_id, -1) > position:
+                # a release fails on a dependency listed after its dependant, see scheduler.build_change_set_graph
+                issues.append(LintIssue('error', location, f'depends on {depend_id}, which is listed later in '
+                                                           f'the release, it must be listed before its dependants'))
+    return issues
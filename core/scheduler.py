@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeSetNode:
+    """
+    A single changeset (SQL file) in the release DAG, change_file is the manifest_reader.ChangeFile to release
+    """
+    __slots__ = ('id', 'change_log', 'change_file', 'change_details', 'depends', 'dependants', 'pending')
+
+    def __init__(self, id: str, change_log: str, change_file, change_details: dict):
+        self.id = id
+        self.change_log = change_log
+        self.change_file = change_file
+        self.change_details = change_details
+        self.depends = []
+        self.dependants = []
+        self.pending = 0
+
+    def __repr__(self):
+        return f'ChangeSetNode({self.change_log}:{self.id})'
+
+
+def build_change_set_graph(nodes, is_released=None):
+    """
+    Links changeset nodes into a DAG. A changeset without a --depends: header depends on the changeset listed
+    before it in the manifests, so a release without headers runs exactly in manifest order. A changeset with a
+    --depends: header depends only on the ids listed, an empty header makes it independent. A dependency must be
+    listed before its dependant, or be released already.
+    :param nodes: ChangeSetNode objects in manifest order
+    :param is_released: callable taking a changeset id, True if the change is released. Dependencies outside the
+                        nodes are not checked if None
+    :return: the nodes, linked
+    :raises ValueError: two changesets have the same id, a changeset depends on one listed after it, or on an id
+                        neither in the release nor released
+    """
+    nodes = list(nodes)
+    # every id is indexed before linking, so a dependency listed later is found and reported instead of ignored
+    positions = {}
+    for position, node in enumerate(nodes):
+        first = positions.setdefault(node.id, position)
+        if first != position:
+            # the history table records a change by id, the second change would never be recorded
+            raise ValueError(f'Changeset {node.id} ({node.change_log}) has the id of a changeset listed before it '
+                             f'({nodes[first].change_log}), changeset ids must be unique')
+    previous = None
+    for position, node in enumerate(nodes):
+        depends = node.change_details.get('depends')
+        if depends is None:
+            parents = [previous] if previous is not None else []
+        else:
+            parents = []
+            for depend_id in dict.fromkeys(depends):
+                parent_position = positions.get(depend_id)
+                if parent_position is not None and parent_position < position:
+                    parents.append(nodes[parent_position])
+                elif parent_position is not None:
+                    raise ValueError(f'Changeset {node.id} ({node.change_log}) depends on {depend_id}, which is '
+                                     f'listed {"as itself" if parent_position == position else "after it"} in the '
+                                     f'release, a dependency must be listed before its dependants')
+                elif is_released is not None and not is_released(depend_id):
+                    raise ValueError(f'Changeset {node.id} ({node.change_log}) depends on {depend_id}, which is '
+                                     f'neither part of this release nor released')
+                else:
+                    # ids outside the release were deployed by an earlier release
+                    logger.debug(f'Dependency {depend_id} of {node.id} is not part of this release')
+        for parent in parents:
+            node.depends.append(parent)
+            parent.dependants.append(node)
+        node.pending = len(node.depends)
+        previous = node
+    return nodes
+
+
+class SchedulerReport:
+    """
+    Outcome of a scheduler run, including the parallelism that was achieved
+    """
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+        self.skipped = []
+        self.wall_time = 0.0
+        self.busy_time = 0.0
+        self.max_in_flight = 0
+
+    @property
+    def parallelism(self):
+        """
+        Average number of changesets in flight, total worker busy time over wall clock time
+        """
+        return self.busy_time / self.wall_time if self.wall_time else 0.0
+
+    def summary(self):
+        return f'{len(self.succeeded)} succeeded, {len(self.failed)} failed, {len(self.skipped)} skipped ' \
+               f'in {self.wall_time:.2f}s, parallelism {self.parallelism:.2f} (max {self.max_in_flight} in flight)'
+
+
+class ChangeSetScheduler:
+    """
+    Runs changesets on a bounded pool of workers, starting a changeset once all of its dependencies have succeeded
+    """
+    def __init__(self, max_workers: int = 1, halt_on_fail: bool = True):
+        self.max_workers = max(1, int(max_workers or 1))
+        self.halt_on_fail = halt_on_fail
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def run(self, nodes, deploy):
+        """
+        Deploys the changesets in dependency order
+        :param nodes: linked ChangeSetNode objects from build_change_set_graph
+        :param deploy: callable taking a ChangeSetNode, returns True if the changeset was released successfully
+        :return: SchedulerReport
+        """
+        report = SchedulerReport()
+        start = time.perf_counter()
+        ready = [node for node in nodes if node.pending == 0]
+        remaining = {id(node) for node in nodes}
+
+        if self.max_workers == 1:
+            self._run_inline(ready, deploy, report, remaining)
+        else:
+            self._run_pool(ready, deploy, report, remaining)
+
+        report.skipped.extend(node for node in nodes if id(node) in remaining)
+        report.wall_time = time.perf_counter() - start
+        logger.info(f'Scheduler finished: {report.summary()}')
+        return report
+
+    def _timed(self, deploy, node, report):
+        with self._lock:
+            self._in_flight += 1
+            report.max_in_flight = max(report.max_in_flight, self._in_flight)
+        start = time.perf_counter()
+        try:
+            return bool(deploy(node))
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._in_flight -= 1
+                report.busy_time += elapsed
+
+    def _complete(self, node, ok, report, remaining):
+        """
+        Records a finished changeset and returns the dependants that became ready
+        """
+        remaining.discard(id(node))
+        if not ok:
+            report.failed.append(node)
+            return []
+        report.succeeded.append(node)
+        released = []
+        for dependant in node.dependants:
+            dependant.pending -= 1
+            if dependant.pending == 0:
+                released.append(dependant)
+        return released
+
+    def _run_inline(self, ready, deploy, report, remaining):
+        while ready:
+            node = ready.pop(0)
+            ok = self._timed(deploy, node, report)
+            ready[:0] = self._complete(node, ok, report, remaining)
+            if not ok and self.halt_on_fail:
+                logger.error(f'Stopping scheduler: {node.id} failed and halt_release_on_fail is True')
+                return
+
+    def _run_pool(self, ready, deploy, report, remaining):
+        halted = False
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='changeset') as pool:
+            futures = {}
+            while ready or futures:
+                while ready and not halted and len(futures) < self.max_workers:
+                    node = ready.pop(0)
+                    futures[pool.submit(self._timed, deploy, node, report)] = node
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = futures.pop(future)
+                    ok = future.result()
+                    ready.extend(self._complete(node, ok, report, remaining))
+                    if not ok and self.halt_on_fail and not halted:
+                        logger.error(f'Stopping scheduler: {node.id} failed and halt_release_on_fail is True, '
+                                     f'waiting for {len(futures)} changesets in flight')
+                        halted = True
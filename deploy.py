@@ -1,5 +1,187 @@
 #!/usr/bin/env python
+from pathlib import Path
+import argparse
+import logging
+import sys
 
-def main(argv):
-    help = "-t, --tgt      Target Database Name\n" \
-           "-c, --clone    "
\ No newline at end of file
+# only the standard library is imported here, each command imports what it needs so --help, lint and plan start
+# without loading the Snowflake connector, cryptography or jinja2
+
+DEFAULT_PROPERTIES = Path(__file__).resolve().parent / 'conf' / 'properties.yaml'
+
+logger = logging.getLogger('deploy')
+
+
+def _properties(args):
+    from operators.properties_reader import get_properties
+
+    properties = get_properties(args.properties or DEFAULT_PROPERTIES)
+    if args.bundle and args.properties is None:
+        # a bundle carries the release settings it was built with, the connection settings are never bundled and
+        # come from the default properties file
+        from operators.release_bundle import open_bundle
+
+        properties.update(open_bundle(args.bundle).properties)
+    if args.bundle:
+        properties['release_bundle'] = args.bundle
+    for name in ('parallel_workers', 'execution_mode'):
+        if getattr(args, name, None) is not None:
+            properties[name] = getattr(args, name)
+    return properties
+
+
+def _setup_logging(args):
+    # logging.config is only needed by the commands writing release logs
+    from core.logging_config import setup_logging
+
+    if args.log_config:
+        setup_logging(args.log_config)
+    else:
+        setup_logging()
+
+
+def deploy(args):
+    """
+    Releases the changes to one target database, or to many when several targets or patterns are given
+    """
+    from core import deploy_changes
+    from core.fan_out import FanOutDeployment, is_pattern
+
+    _setup_logging(args)
+    properties = _properties(args)
+    deploy_changes.halt_release_on_fail = not args.continue_on_fail
+
+    if len(args.tgt) == 1 and not is_pattern(args.tgt[0]):
+        deployer = deploy_changes.DeployChanges(target_database=args.tgt[0], cloning=args.clone,
+                                                properties=properties)
+        deployer.deploy_release()
+        # with --continue-on-fail deploy_release returns after changes failed, the exit status still reports them
+        failed = 1 in deployer.change_log_status.values()
+        not_swapped = deployer.clone_release is not None and not deployer.clone_release.swapped
+        return 1 if failed or not_swapped else 0
+
+    report = FanOutDeployment(targets=args.tgt, cloning=args.clone, properties=properties,
+                              max_concurrency=args.max_concurrency, fail_fast=args.fail_fast).run()
+    return 0 if report.ok else 1
+
+
+def plan(args):
+    """
+    Shows what a release to the target would do, using the local history cache, never connects to Snowflake
+    """
+    from core.release_plan import format_plan, load_cached_history, plan_release
+
+    properties = _properties(args)
+    change_history = load_cached_history(properties, args.tgt)
+    if change_history is None:
+        print(f'No history cache for {args.tgt}, every changeset is shown as pending. '
+              f'Run the status command to refresh the cache.', file=sys.stderr)
+    try:
+        planned = plan_release(properties, change_history)
+    except ValueError as e:
+        # a changeset depends on one listed after it, or on one that is not released
+        print(e, file=sys.stderr)
+        return 1
+    print(format_plan(planned))
+    return 0
+
+
+def lint(args):
+    """
+    Checks the manifests and changeset headers, never connects to Snowflake
+    """
+    from core.release_plan import lint_release
+
+    issues = lint_release(_properties(args))
+    for issue in issues:
+        print(issue)
+    errors = sum(1 for issue in issues if issue.level == 'error')
+    print(f'{errors} errors, {len(issues) - errors} warnings')
+    return 1 if errors else 0
+
+
+def bundle(args):
+    """
+    Compiles the manifests, changeset headers and SQL bodies of the release into one file, for deploy --bundle
+    """
+    from operators.properties_reader import get_properties
+    from operators.release_bundle import write_bundle
+
+    properties = get_properties(args.properties or DEFAULT_PROPERTIES)
+    changes = write_bundle(properties, args.output)
+    print(f'{changes} changesets bundled into {args.output}')
+    return 0
+
+
+def status(args):
+    """
+    Compares the release with the history table of the target, refreshing the local history cache
+    """
+    from core.deploy_changes import DeployChanges
+    from core.release_plan import format_plan, plan_release
+
+    _setup_logging(args)
+    properties = _properties(args)
+    snowflake_manager = DeployChanges.get_snowflake_manager(target_database=args.tgt, properties=properties)
+    try:
+        change_history = snowflake_manager.get_database_change_history()
+    finally:
+        snowflake_manager.close()
+    print(format_plan(plan_release(properties, change_history)))
+    return 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='deploy.py', description='Releases SQL change files to Snowflake')
+    parser.add_argument('-p', '--properties', default=None, help='properties yaml file, conf/properties.yaml by '
+                                                                 'default, only its connection settings are used '
+                                                                 'with --bundle unless given')
+    parser.add_argument('-b', '--bundle', default=None, help='release bundle built by the bundle command, the '
+                                                             'release and its release settings are read from it')
+    parser.add_argument('--log-config', default=None, help='logging config yaml file, conf/logging_config.yaml '
+                                                           'by default')
+    parser.add_argument('-v', '--verbose', action='store_true', help='debug logging for lint and plan')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    command = commands.add_parser('deploy', help='release the changes to one or more target databases')
+    command.add_argument('-t', '--tgt', nargs='+', required=True,
+                         help='Target Database Name, several names or patterns such as TENANT_* release to each')
+    command.add_argument('-c', '--clone', action='store_true', help='release to a clone of the target database')
+    command.add_argument('--workers', dest='parallel_workers', type=int, help='overrides parallel_workers')
+    command.add_argument('--mode', dest='execution_mode', choices=('threads', 'async'),
+                         help='overrides execution_mode')
+    command.add_argument('--continue-on-fail', action='store_true',
+                         help='release the remaining changes after a change fails')
+    command.add_argument('--max-concurrency', type=int, help='targets released at once, overrides fan_out')
+    command.add_argument('--fail-fast', action='store_true', default=None,
+                         help='stop starting targets after one fails, overrides fan_out')
+    command.set_defaults(func=deploy)
+
+    command = commands.add_parser('plan', help='show the changes a release would run, offline')
+    command.add_argument('-t', '--tgt', required=True, help='Target Database Name')
+    command.set_defaults(func=plan)
+
+    command = commands.add_parser('lint', help='check the manifests and changeset headers, offline')
+    command.set_defaults(func=lint)
+
+    command = commands.add_parser('bundle', help='compile the release into one bundle file, offline')
+    command.add_argument('-o', '--output', required=True, help='bundle file to write')
+    command.set_defaults(func=bundle)
+
+    command = commands.add_parser('status', help='compare the release with the history table of the target')
+    command.add_argument('-t', '--tgt', required=True, help='Target Database Name')
+    command.set_defaults(func=status)
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    if args.command in ('plan', 'lint', 'bundle'):
+        logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                            format='%(levelname)s :: %(name)s :: %(message)s')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
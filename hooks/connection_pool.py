@@ -0,0 +1,267 @@
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def alter_session_statements(session_parameters: dict):
+    """
+    :param session_parameters: session parameter values by name
+    :return: ALTER SESSION statements setting the parameters
+    """
+    return [f'ALTER SESSION SET {name} = {value!r}' if isinstance(value, str)
+            else f'ALTER SESSION SET {name} = {value}' for name, value in session_parameters.items()]
+
+
+class PoolStats:
+    """
+    Counters used to size the connection pool
+    """
+    __slots__ = ('hits', 'misses', 'waits', 'wait_time', 'created', 'closed', 'failed_health_checks')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.created = 0
+        self.closed = 0
+        self.failed_health_checks = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class SnowflakeConnectionPool:
+    """
+    Thread safe pool of Snowflake connections created from a SnowflakeConnection hook.
+    Connections are health checked when borrowed and have their session reset when returned. A connection whose
+    borrower changed the session (USE ROLE/WAREHOUSE/SCHEMA, ALTER SESSION) is closed instead, its session cannot be
+    restored. min_size connections are opened with the pool, idle connections above min_size are closed after
+    idle_timeout seconds.
+    """
+    def __init__(self, hook, min_size: int = 0, max_size: int = 4, idle_timeout: float = 300,
+                 session_parameters: dict = None, health_check: bool = True, instrumentation=None):
+        """
+        :param hook: SnowflakeConnection hook used to open new connections
+        :param min_size: connections opened with the pool and kept open when idle
+        :param max_size: maximum connections open at once, borrowers wait when all are in use
+        :param idle_timeout: seconds an idle connection is kept before being closed, never closed if 0 or None
+        :param session_parameters: session parameters restored on every returned connection
+        :param health_check: run a trivial query on borrowed connections
+        :param instrumentation: times opening connections, an object whose span(name) returns a context manager
+        """
+        if max_size < 1 or min_size > max_size:
+            raise ValueError(f'Invalid pool size min_size={min_size} max_size={max_size}')
+        self.hook = hook
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.session_parameters = session_parameters or {}
+        self.health_check = health_check
+        self.instrumentation = instrumentation
+        self.stats = PoolStats()
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._available = threading.Condition(threading.Lock())
+        # set when the pool closes, wakes the thread closing idle connections
+        self._closing = threading.Event()
+        for _ in range(min_size):
+            with self._available:
+                self._open += 1
+            conn = self._open_connection()
+            with self._available:
+                self._idle.append((conn, time.monotonic()))
+        if idle_timeout:
+            threading.Thread(target=self._close_expired, name='connection-pool-idle', daemon=True).start()
+
+    @classmethod
+    def from_properties(cls, hook, properties: dict, instrumentation=None):
+        """
+        Creates a pool from the connection_pool section of the properties file
+        :param hook: SnowflakeConnection hook
+        :param properties: Dictionary of the properties yaml file
+        :param instrumentation: times opening connections
+        """
+        pool_properties = properties.get('connection_pool') or {}
+        # the release connection and one per worker unless set, an empty max_size is not set
+        max_size = pool_properties.get('max_size') or int(properties.get('parallel_workers') or 1) + 1
+        return cls(hook,
+                   min_size=int(pool_properties.get('min_size', 0)),
+                   max_size=int(max_size),
+                   idle_timeout=float(pool_properties.get('idle_timeout', 300)),
+                   session_parameters=pool_properties.get('session_parameters'),
+                   health_check=pool_properties.get('health_check', True),
+                   instrumentation=instrumentation)
+
+    def acquire(self, timeout: float = None):
+        """
+        Borrows a connection, opening a new one if none are idle and the pool is not full
+        :param timeout: seconds to wait for a connection, waits forever if None
+        :return: snowflake connection
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            conn = self._take(deadline)
+            if conn is None:
+                return self._open_connection()
+            if self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn, session_changed: bool = False):
+        """
+        Returns a borrowed connection to the pool
+        :param conn: connection from acquire
+        :param session_changed: the borrower ran statements changing the session, the connection is closed
+        """
+        if session_changed:
+            logger.debug('Closing pooled connection, its session was changed')
+        if self._closed or session_changed or not self._reset_session(conn):
+            self._discard(conn)
+            return
+        with self._available:
+            self._idle.append((conn, time.monotonic()))
+            self._available.notify()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """
+        Borrows a connection for the duration of a with block
+        """
+        conn = self.acquire(timeout=timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Closes all idle connections, connections still borrowed are closed when released
+        """
+        with self._available:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+            self._available.notify_all()
+        self._closing.set()
+        for conn in idle:
+            self._discard(conn)
+        logger.debug(f'Connection pool closed: {self.stats.as_dict()}')
+
+    def _take(self, deadline):
+        """
+        Pops an idle connection or reserves a slot for a new one (returns None)
+        """
+        with self._available:
+            waited = None
+            while True:
+                if self._closed:
+                    raise RuntimeError('Connection pool is closed')
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                    break
+                if self._open < self.max_size:
+                    self._open += 1
+                    conn = None
+                    break
+                if waited is None:
+                    waited = time.monotonic()
+                    self.stats.waits += 1
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'No Snowflake connection available after waiting for {self.max_size} '
+                                       f'connections')
+                self._available.wait(remaining)
+
+            if waited is not None:
+                self.stats.wait_time += time.monotonic() - waited
+            if conn is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+            return conn
+
+    def _open_connection(self):
+        try:
+            if self.instrumentation is None:
+                conn = self.hook.get_conn()
+            else:
+                with self.instrumentation.span('connect', pooled=True):
+                    conn = self.hook.get_conn()
+        except Exception:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+        with self._available:
+            self.stats.created += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._available:
+            self._open -= 1
+            self.stats.closed += 1
+            self._available.notify()
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug(f'Error closing pooled connection: {e}')
+
+    def _expired_idle(self):
+        """
+        Removes connections idle for longer than idle_timeout, oldest first, keeping min_size open
+        :return: the expired connections, seconds until the next idle connection expires or None
+        """
+        now = time.monotonic()
+        expired = []
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.pop(0)[0])
+        next_expiry = self._idle[0][1] + self.idle_timeout - now if len(self._idle) > self.min_size else None
+        return expired, next_expiry
+
+    def _close_expired(self):
+        """
+        Closes idle connections as they expire, until the pool is closed
+        """
+        while not self._closed:
+            with self._available:
+                expired, next_expiry = self._expired_idle()
+            for conn in expired:
+                self._discard(conn)
+            # a connection returned now expires after idle_timeout at the earliest
+            self._closing.wait(max(self.idle_timeout if next_expiry is None else next_expiry, 0.01))
+
+    def _is_healthy(self, conn):
+        if not self.health_check:
+            return True
+        try:
+            if conn.is_closed():
+                raise ConnectionError('connection is closed')
+            conn.cursor().execute('SELECT 1').fetchone()
+            return True
+        except Exception as e:
+            logger.info(f'Discarding unhealthy pooled connection: {e}')
+            with self._available:
+                self.stats.failed_health_checks += 1
+            return False
+
+    def _reset_session(self, conn):
+        """
+        Restores the session parameters and default database so the next borrower gets a clean session
+        """
+        try:
+            if conn.is_closed():
+                return False
+            cursor = conn.cursor()
+            for statement in alter_session_statements(self.session_parameters):
+                cursor.execute(statement)
+            if self.hook.database:
+                cursor.execute(f'USE DATABASE {self.hook.database}')
+            return True
+        except Exception as e:
+            logger.info(f'Discarding pooled connection, session reset failed: {e}')
+            return False
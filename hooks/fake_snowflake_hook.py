@@ -0,0 +1,670 @@
+from enum import Enum
+import csv
+import datetime
+import glob
+import gzip
+import hashlib
+import io
+import itertools
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from snowflake.connector.errors import DatabaseError, ProgrammingError
+from snowflake.connector.util_text import split_statements
+
+logger = logging.getLogger(__name__)
+
+QUALIFIED_NAME = re.compile(r'\b([A-Za-z_]\w*)\.([A-Za-z_]\w*)\.([A-Za-z_]\w*)\b')
+TABLE_EXISTS = re.compile(r"INFORMATION_SCHEMA\.TABLES\s+WHERE\s+table_catalog\s*=\s*'(\w+)'\s+"
+                          r"AND\s+table_schema\s*=\s*'(\w+)'\s+AND\s+table_name\s*=\s*'(\w+)'", re.IGNORECASE)
+ADD_COLUMN = re.compile(r'^ALTER\s+TABLE\s+(\S+)\s+ADD\s+COLUMN\s+IF\s+NOT\s+EXISTS\s+(\w+)\s+(.+)$',
+                        re.IGNORECASE | re.DOTALL)
+STATUS_MERGE = re.compile(r'^MERGE\s+INTO\s+(\S+)\s+AS\s+history\b.*\bSET\s+status\s*=\s*changes\.status\s*$',
+                          re.IGNORECASE | re.DOTALL)
+CREATE_DATABASE = re.compile(r'^CREATE\s+(?:OR\s+REPLACE\s+)?DATABASE\s+(?:IF\s+NOT\s+EXISTS\s+)?([A-Za-z_]\w*)',
+                             re.IGNORECASE)
+CLONE_DATABASE = re.compile(r'^CREATE\s+DATABASE\s+([A-Za-z_]\w*)\s+CLONE\s+([A-Za-z_]\w*)$', re.IGNORECASE)
+ALTER_DATABASE = re.compile(r'^ALTER\s+DATABASE\s+(?:IF\s+EXISTS\s+)?([A-Za-z_]\w*)\s+(SWAP\s+WITH|RENAME\s+TO)\s+'
+                            r'([A-Za-z_]\w*)$', re.IGNORECASE)
+DROP_DATABASE = re.compile(r'^DROP\s+DATABASE\s+(IF\s+EXISTS\s+)?([A-Za-z_]\w*)$', re.IGNORECASE)
+DATABASE_OBJECTS = re.compile(r'\bFROM\s+([A-Za-z_]\w*)\.INFORMATION_SCHEMA\.TABLES\s+WHERE\s+table_schema\s*<>',
+                              re.IGNORECASE)
+SHOW_DATABASES = re.compile(r'^SHOW\s+(?:TERSE\s+)?DATABASES\b', re.IGNORECASE)
+IGNORED = re.compile(r'^(USE|CREATE\s+SCHEMA|ALTER\s+SESSION|SHOW|COMMIT|ROLLBACK|BEGIN)\b', re.IGNORECASE)
+# a table name without database and schema after a keyword that takes a table name
+UNQUALIFIED_TABLE = re.compile(r'\b(TABLE\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?|INTO\s+|FROM\s+|JOIN\s+|UPDATE\s+)'
+                               r'([A-Za-z_]\w*)\b(?![.(])', re.IGNORECASE)
+USE_DATABASE = re.compile(r'^USE\s+(?:DATABASE\s+)?([A-Za-z_]\w*)\s*;?\s*$', re.IGNORECASE)
+# MAX of a timestamp column, SQLite returns the ISO text of an aggregate without converting it
+MAX_TIMESTAMP = re.compile(r'\bMAX\(date_released\)', re.IGNORECASE)
+COLUMN_COMMENT = re.compile(r"\s+comment\s+'[^']*'", re.IGNORECASE)
+PUT_FILES = re.compile(r"^PUT\s+'?file://(?P<source>.+?)'?\s+@(?P<stage>\S+)", re.IGNORECASE)
+COPY_INTO = re.compile(r'^COPY\s+INTO\s+(?P<table>\S+)\s+FROM\s+@(?P<stage>\S+)\s+FILE_FORMAT\s*=\s*\((?P<format>.*)\)'
+                       r'(?P<options>[^)]*)$', re.IGNORECASE | re.DOTALL)
+COPY_OPTION = re.compile(r"(\w+)\s*=\s*('(?:[^'\\]|\\.)*'|\([^)]*\)|\S+)")
+
+# query ids are unique across the fake connections of a process, like Snowflake query ids
+_query_ids = itertools.count(1)
+# messages of the Snowflake errors a fake connection can inject, by error code
+TRANSIENT_MESSAGES = {
+    625: 'Statement has locked table and this lock has not yet been released',
+    630: 'Statement reached its statement or warehouse timeout and was canceled',
+    603: 'SQL execution internal error: Processing aborted due to error 300010',
+    390114: 'Authentication token has expired. The user must authenticate again.',
+    250003: 'Failed to get the response. Hanging?',
+}
+# error 630 of a statement canceled while queued, a statement timeout has the message of TRANSIENT_MESSAGES
+QUEUED_TIMEOUT_MESSAGE = 'Statement reached its queued timeout in the warehouse queue and was canceled'
+_transient_lock = threading.Lock()
+
+# timestamps are stored as ISO text and read back as datetimes, like the connector returns them
+sqlite3.register_converter('timestamp_ntz', lambda value: datetime.datetime.fromisoformat(value.decode()))
+
+
+class QueryStatus(Enum):
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    SUCCESS = 'SUCCESS'
+    FAILED_WITH_ERROR = 'FAILED_WITH_ERROR'
+
+
+class FakeQuery:
+    __slots__ = ('sfqid', 'sql', 'rows', 'error', 'starts_at', 'finishes_at')
+
+    def __init__(self, sfqid, sql, rows, error, finishes_at, starts_at=None):
+        self.sfqid = sfqid
+        self.sql = sql
+        self.rows = rows
+        self.error = error
+        self.starts_at = finishes_at if starts_at is None else starts_at
+        self.finishes_at = finishes_at
+
+
+class FakeBackend:
+    """
+    SQLite database standing in for a Snowflake account, shared by all fake connections of a hook.
+    Fully qualified DATABASE.SCHEMA.TABLE names become quoted SQLite table names, unqualified names are qualified
+    with the connection's current database and the PUBLIC schema. The statements the release tool
+    issues that SQLite has no equivalent for (information schema lookups, ADD COLUMN IF NOT EXISTS, the history
+    status MERGE, USE, MAX of a timestamp) are emulated. Stages are emulated in memory: PUT copies local files to
+    a stage and COPY INTO loads staged CSV files, keeping load metadata so a file is loaded into a table once.
+    CLONE copies the tables and views of a database, SWAP WITH and RENAME TO rename them and DROP DATABASE drops
+    them. Views are stored with fully qualified names and follow their database, like views naming objects of their
+    own database in Snowflake.
+    """
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None,
+                                  detect_types=sqlite3.PARSE_DECLTYPES)
+        self.lock = threading.RLock()
+        self.databases = set()
+        # staged file content by stage path
+        self.stages = {}
+        # (stage path, md5) of the files loaded, by table
+        self.load_history = {}
+
+    @staticmethod
+    def _translate(sql, database=None):
+        if database is not None:
+            sql = UNQUALIFIED_TABLE.sub(lambda m: f'{m.group(1)}{database}.PUBLIC.{m.group(2)}', sql)
+        sql = QUALIFIED_NAME.sub(lambda m: '"' + '.'.join(m.groups()).upper() + '"', sql)
+        sql = COLUMN_COMMENT.sub('', sql)
+        return sql.rstrip().rstrip(';')
+
+    @staticmethod
+    def _param(value):
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat(sep=' ') if isinstance(value, datetime.datetime) else value.isoformat()
+        return value
+
+    def list_databases(self):
+        """
+        Databases created with CREATE DATABASE or holding tables
+        """
+        with self.lock:
+            tables = self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+            return sorted(self.databases | {name.split('.')[0] for name, in tables if '.' in name})
+
+    def table_exists(self, name):
+        with self.lock:
+            return self.db.execute("SELECT count(1) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                   (name.strip('"').upper(),)).fetchone()[0]
+
+    @staticmethod
+    def _qualify(name, database):
+        parts = name.strip('"').upper().split('.')
+        if len(parts) < 3:
+            parts = [database or 'PUBLIC', 'PUBLIC'][:3 - len(parts)] + parts
+        return '"' + '.'.join(parts) + '"'
+
+    @staticmethod
+    def _option_value(value):
+        if len(value) >= 2 and value[0] == value[-1] == "'":
+            return value[1:-1].encode('utf-8').decode('unicode_escape')
+        return value
+
+    def _put(self, match):
+        stage = match.group('stage').rstrip('/')
+        files = sorted(glob.glob(match.group('source')))
+        if not files:
+            raise sqlite3.OperationalError(f"File doesn't exist: {match.group('source')}")
+        rows = []
+        for path in files:
+            with open(path, 'rb') as f:
+                content = f.read()
+            name = os.path.basename(path)
+            compression = 'GZIP' if name.endswith('.gz') else 'NONE'
+            with self.lock:
+                self.stages[f'{stage}/{name}'] = content
+            # source, target, source_size, target_size, source_compression, target_compression, status, message
+            rows.append((name, name, len(content), len(content), compression, compression, 'UPLOADED', ''))
+        return rows
+
+    def _copy(self, match, database):
+        table = self._qualify(match.group('table'), database)
+        stage = match.group('stage').rstrip('/')
+        file_format = {name.lower(): self._option_value(value)
+                       for name, value in COPY_OPTION.findall(match.group('format'))}
+        options = {name.lower(): value.upper() for name, value in COPY_OPTION.findall(match.group('options'))}
+        if file_format.get('type', 'CSV').upper() != 'CSV':
+            raise sqlite3.NotSupportedError(f"{file_format['type']} files are not supported by the fake stage")
+        quote = file_format.get('field_optionally_enclosed_by', 'NONE')
+        skip_header = int(file_format.get('skip_header', 0))
+        results = []
+        with self.lock:
+            columns = len(self.db.execute(f'PRAGMA table_info({table})').fetchall())
+            if not columns:
+                raise sqlite3.OperationalError(f'Table {table} does not exist')
+            loaded = self.load_history.setdefault(table, set())
+            staged = [(path, hashlib.md5(content).hexdigest()) for path, content in sorted(self.stages.items())
+                      if path.startswith(f'{stage}/')]
+            staged = [(path, digest) for path, digest in staged if (path, digest) not in loaded]
+            self.db.execute('BEGIN')
+            try:
+                for path, _ in staged:
+                    content = self.stages[path]
+                    if file_format.get('compression', 'AUTO').upper() == 'GZIP' or path.endswith('.gz'):
+                        content = gzip.decompress(content)
+                    reader = csv.reader(io.StringIO(content.decode('utf-8'), newline=''),
+                                        delimiter=file_format.get('field_delimiter', ','),
+                                        quotechar=quote if quote.upper() != 'NONE' else None,
+                                        quoting=csv.QUOTE_MINIMAL if quote.upper() != 'NONE' else csv.QUOTE_NONE)
+                    records = [[value if value != '' else None for value in record]
+                               for record in itertools.islice(reader, skip_header, None) if record]
+                    self.db.executemany(f'INSERT INTO {table} VALUES ({", ".join("?" * columns)})', records)
+                    # file, status, rows_parsed, rows_loaded, error_limit, errors_seen, first_error, ...
+                    results.append((path, 'LOADED', len(records), len(records), 1, 0, None, None, None, None))
+                self.db.execute('COMMIT')
+            except (sqlite3.Error, csv.Error, OSError, UnicodeDecodeError) as e:
+                self.db.execute('ROLLBACK')
+                raise sqlite3.DataError(f'COPY INTO {table} aborted: {e}')
+            loaded.update(staged)
+            if options.get('purge') == 'TRUE':
+                for path, _ in staged:
+                    del self.stages[path]
+        return results or [('Copy executed with 0 files processed.',)]
+
+    def _objects(self, database):
+        """
+        Tables and views of a database
+        :return: list of (name, type, sql), tables first
+        """
+        prefix = f'{database.upper()}.'
+        rows = self.db.execute("SELECT name, type, sql FROM sqlite_master WHERE type IN ('table', 'view') "
+                               "ORDER BY type, name").fetchall()
+        return [row for row in rows if row[0].startswith(prefix)]
+
+    def _require_database(self, database):
+        if database.upper() not in self.list_databases():
+            raise sqlite3.OperationalError(f"Database '{database.upper()}' does not exist or not authorized.")
+
+    @staticmethod
+    def _rename_references(sql, names):
+        pattern = re.compile('"(' + '|'.join(re.escape(name) for name in names) + r')\.')
+        return pattern.sub(lambda m: f'"{names[m.group(1)]}.', sql)
+
+    def _clone(self, clone, source):
+        clone, source = clone.upper(), source.upper()
+        with self.lock:
+            self._require_database(source)
+            if clone in self.list_databases():
+                raise sqlite3.OperationalError(f"Object '{clone}' already exists.")
+            self.db.execute('BEGIN')
+            try:
+                for name, kind, sql in self._objects(source):
+                    self.db.execute(self._rename_references(sql, {source: clone}))
+                    if kind == 'table':
+                        cloned = self._rename_references(f'"{name}"', {source: clone})
+                        self.db.execute(f'INSERT INTO {cloned} SELECT * FROM "{name}"')
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                self.db.execute('ROLLBACK')
+                raise
+            # a cloned table has no load metadata, its source's files can be loaded into it again
+            self.databases.add(clone)
+
+    def _move(self, names):
+        """
+        Renames databases, in one transaction
+        :param names: new name by database name, a swap renames each database to the other
+        """
+        with self.lock:
+            objects = [row for database in names for row in self._objects(database)]
+            # tables are renamed without rewriting or checking the views reading them, like Snowflake
+            self.db.execute('PRAGMA legacy_alter_table = ON')
+            self.db.execute('BEGIN')
+            try:
+                # views are recreated once their tables have their new names
+                for name, kind, _ in objects:
+                    if kind == 'view':
+                        self.db.execute(f'DROP VIEW "{name}"')
+                tables = [name for name, kind, _ in objects if kind == 'table']
+                for index, name in enumerate(tables):
+                    self.db.execute(f'ALTER TABLE "{name}" RENAME TO "~moving.{index}"')
+                for index, name in enumerate(tables):
+                    moved = self._rename_references(f'"{name}"', names)
+                    self.db.execute(f'ALTER TABLE "~moving.{index}" RENAME TO {moved}')
+                for _, kind, sql in objects:
+                    if kind == 'view':
+                        self.db.execute(self._rename_references(sql, names))
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                self.db.execute('ROLLBACK')
+                raise
+            finally:
+                self.db.execute('PRAGMA legacy_alter_table = OFF')
+            self.databases -= set(names)
+            self.databases |= set(names.values())
+            self.load_history = {self._rename_references(table, names): loaded
+                                 for table, loaded in self.load_history.items()}
+
+    def _alter_database(self, match):
+        database, action, other = match.group(1).upper(), match.group(2).upper(), match.group(3).upper()
+        with self.lock:
+            self._require_database(database)
+            if action.startswith('SWAP'):
+                self._require_database(other)
+                self._move({database: other, other: database})
+            else:
+                if other in self.list_databases():
+                    raise sqlite3.OperationalError(f"Object '{other}' already exists.")
+                self._move({database: other})
+
+    def _drop_database(self, match):
+        database = match.group(2).upper()
+        with self.lock:
+            if database not in self.list_databases():
+                if match.group(1):
+                    return
+                self._require_database(database)
+            objects = self._objects(database)
+            for name, kind, _ in sorted(objects, key=lambda row: row[1] != 'view'):
+                self.db.execute(f'DROP {kind.upper()} "{name}"')
+            self.databases.discard(database)
+            self.load_history = {table: loaded for table, loaded in self.load_history.items()
+                                 if not table.startswith(f'"{database}.')}
+
+    def _database_objects(self, database):
+        # table_schema, table_name, table_type like INFORMATION_SCHEMA.TABLES
+        with self.lock:
+            self._require_database(database)
+            return [tuple(name.split('.')[1:]) + ('VIEW' if kind == 'view' else 'BASE TABLE',)
+                    for name, kind, _ in sorted(self._objects(database))]
+
+    def execute(self, sql, params=None, database=None):
+        """
+        Runs a statement
+        :param sql: statement
+        :param params: qmark bind parameters
+        :param database: current database of the session, qualifies unqualified table names
+        :return: result rows
+        """
+        sql = sql.strip().rstrip(';').strip()
+        params = [self._param(value) for value in params] if params else []
+
+        match = CLONE_DATABASE.match(sql)
+        if match:
+            self._clone(match.group(1), match.group(2))
+            return [(f'Database {match.group(1).upper()} successfully created.',)]
+        match = ALTER_DATABASE.match(sql)
+        if match:
+            self._alter_database(match)
+            return [('Statement executed successfully.',)]
+        match = DROP_DATABASE.match(sql)
+        if match:
+            self._drop_database(match)
+            return [(f'{match.group(2).upper()} successfully dropped.',)]
+        match = DATABASE_OBJECTS.search(sql)
+        if match:
+            return self._database_objects(match.group(1))
+        match = CREATE_DATABASE.match(sql)
+        if match:
+            self.databases.add(match.group(1).upper())
+            return []
+        if SHOW_DATABASES.match(sql):
+            # created_on, name, kind, database_name, schema_name like SHOW TERSE DATABASES
+            return [(None, database, 'STANDARD', None, None) for database in self.list_databases()]
+        if IGNORED.match(sql):
+            return []
+        match = PUT_FILES.match(sql)
+        if match:
+            return self._put(match)
+        match = COPY_INTO.match(sql)
+        if match:
+            return self._copy(match, database)
+        match = TABLE_EXISTS.search(sql)
+        if match:
+            return [(self.table_exists('.'.join(match.groups())),)]
+        match = ADD_COLUMN.match(sql)
+        if match:
+            table = self._translate(match.group(1))
+            with self.lock:
+                columns = [row[1].lower() for row in self.db.execute(f'PRAGMA table_info({table})')]
+                if match.group(2).lower() not in columns:
+                    self.db.execute(f'ALTER TABLE {table} ADD COLUMN {match.group(2)} {match.group(3)}')
+            return []
+        match = STATUS_MERGE.match(sql)
+        if match:
+            table = self._translate(match.group(1))
+            with self.lock:
+                for i in range(0, len(params), 2):
+                    self.db.execute(f'UPDATE {table} SET status = ? WHERE id = ?', (params[i + 1], params[i]))
+            return []
+
+        with self.lock:
+            rows = self.db.execute(self._translate(sql, database), params).fetchall()
+        if MAX_TIMESTAMP.search(sql):
+            rows = [tuple(datetime.datetime.fromisoformat(value) if isinstance(value, str) else value for value in row)
+                    for row in rows]
+        return rows
+
+
+class FakeCursor:
+    """
+    Cursor of a FakeSnowflakeConnection
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.sfqid = None
+        self.rowcount = None
+        self._rows = []
+
+    def _load(self, query):
+        self.sfqid = query.sfqid
+        self._rows = list(query.rows)
+        self.rowcount = len(self._rows)
+
+    def execute(self, sql, params=None, **kwargs):
+        query = self.connection._run(sql, params, asynchronous=False)
+        if query.error is not None:
+            raise query.error
+        self._load(query)
+        return self
+
+    def executemany(self, sql, seq_params, **kwargs):
+        query = self.connection._run(sql, list(seq_params), asynchronous=False, many=True)
+        if query.error is not None:
+            raise query.error
+        self._load(query)
+        return self
+
+    def execute_async(self, sql, params=None, **kwargs):
+        query = self.connection._run(sql, params, asynchronous=True)
+        self.sfqid = query.sfqid
+        return {'queryId': query.sfqid}
+
+    def get_results_from_sfqid(self, sfqid):
+        query = self.connection._query(sfqid)
+        self.connection._round_trip()
+        while time.monotonic() < query.finishes_at:
+            time.sleep(query.finishes_at - time.monotonic())
+        if query.error is not None:
+            raise query.error
+        self._load(query)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchmany(self, size=1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeSnowflakeConnection:
+    """
+    Stand-in for a snowflake.connector connection, for running releases without a Snowflake account.
+    Statements run against a SQLite FakeBackend. Every statement is recorded in executed and every call that would
+    be a network request counts as a round-trip, with optional latency and random failures injected.
+    Canned results, failures and the time async queries stay RUNNING can be configured per statement with
+    regular expressions. Transient errors can be injected a number of times per statement, and a warehouse running
+    at most warehouse_concurrency async queries at once keeps the others QUEUED, failing those queued for longer
+    than queued_timeout with error 630.
+    """
+    def __init__(self, backend: FakeBackend = None, responses=None, failures=None, query_duration: float = 0.0,
+                 latency: float = 0.0, failure_rate: float = 0.0, seed=None, record: bool = True,
+                 transient_errors=None, warehouse_concurrency: int = None, queued_timeout: float = None):
+        """
+        :param backend: SQLite backend, shared by connections to the same fake account
+        :param responses: list of (pattern, rows), the rows of the first pattern matching a statement are returned
+                          instead of running it
+        :param failures: list of patterns, matching statements fail with a ProgrammingError
+        :param query_duration: seconds an async query reports RUNNING, or a callable taking the sql
+        :param latency: seconds added to every round-trip
+        :param failure_rate: probability a statement fails with a DatabaseError
+        :param seed: seed for the random failures
+        :param record: record the statements in executed, off when measuring the memory of large releases
+        :param transient_errors: list of [pattern, errno, times, executed], the first times statements matching a
+                                 pattern fail with the Snowflake error errno, after running if executed is true like
+                                 a response lost on the way back. The lists are shared by the connections of a hook,
+                                 times counts down across them
+        :param warehouse_concurrency: async queries of the connection running at once, later queries are QUEUED
+                                      until one finishes
+        :param queued_timeout: seconds a query stays QUEUED before failing with error 630
+        """
+        self.backend = backend or FakeBackend()
+        self.responses = [(re.compile(pattern, re.IGNORECASE | re.DOTALL), rows) for pattern, rows in responses or []]
+        self.failures = [re.compile(pattern, re.IGNORECASE | re.DOTALL) for pattern in failures or []]
+        self.query_duration = query_duration
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.database = None
+        self.executed = []
+        self.record = record
+        self.transient_errors = transient_errors if transient_errors is not None else []
+        self.warehouse_concurrency = warehouse_concurrency
+        self.queued_timeout = queued_timeout
+        self.queries = {}
+        self.round_trips = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _duration(self, sql):
+        return self.query_duration(sql) if callable(self.query_duration) else self.query_duration
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _run(self, sql, params, asynchronous, many=False):
+        if self._closed:
+            raise DatabaseError(msg='Connection is closed')
+        self._round_trip()
+        sql = sql.strip()
+        with self._lock:
+            sfqid = f'fake-{next(_query_ids):08d}'
+            if self.record:
+                self.executed.append((sql, params))
+
+        error = None
+        rows = []
+        transient = self._transient_error(sql, sfqid)
+        # the statement runs and its response is lost, or it fails before it runs
+        lost_response = transient is not None and transient[1]
+        starts_at = time.monotonic()
+        if transient is not None and not lost_response:
+            error = transient[0]
+        elif asynchronous and self.warehouse_concurrency:
+            starts_at = self._queued_until(starts_at)
+            if self.queued_timeout is not None and starts_at - time.monotonic() > self.queued_timeout:
+                # canceled while queued, the statement never runs
+                error = ProgrammingError(msg=f'{QUEUED_TIMEOUT_MESSAGE}: {sql[:80]}', errno=630, sqlstate='57014',
+                                         sfqid=sfqid)
+                starts_at = time.monotonic() + self.queued_timeout
+        if error is not None:
+            rows = []
+        elif any(pattern.search(sql) for pattern in self.failures):
+            error = ProgrammingError(msg=f'SQL compilation error: {sql[:80]}', errno=1003, sfqid=sfqid)
+        elif self.failure_rate and self.random.random() < self.failure_rate:
+            error = DatabaseError(msg='Injected failure', errno=390114, sfqid=sfqid)
+        else:
+            canned = next((rows for pattern, rows in self.responses if pattern.search(sql)), None)
+            if canned is not None:
+                rows = canned
+            else:
+                use = USE_DATABASE.match(sql)
+                if use:
+                    self.database = use.group(1).upper()
+                try:
+                    for params_row in (params if many else [params]):
+                        rows = self.backend.execute(sql, params_row, database=self.database)
+                except sqlite3.Error as e:
+                    error = ProgrammingError(msg=f'{e}: {sql[:80]}', errno=1003, sfqid=sfqid)
+        if lost_response and error is None:
+            error = transient[0]
+
+        duration = self._duration(sql) if asynchronous and error is None else 0.0
+        query = FakeQuery(sfqid, sql if self.record else None, rows, error, max(starts_at, time.monotonic()) + duration,
+                          starts_at=starts_at)
+        with self._lock:
+            self.queries[sfqid] = query
+            self.max_running = max(self.max_running, self.running_queries())
+        logger.debug(f'{sfqid}: {sql}')
+        return query
+
+    def _transient_error(self, sql, sfqid):
+        """
+        :return: (error, executed) of the first injected transient error matching the statement, None if none
+        """
+        with _transient_lock:
+            for rule in self.transient_errors:
+                pattern, errno, times = rule[:3]
+                if times > 0 and re.search(pattern, sql, re.IGNORECASE | re.DOTALL):
+                    rule[2] -= 1
+                    message = TRANSIENT_MESSAGES.get(errno, 'Transient error')
+                    return (ProgrammingError(msg=f'{message}: {sql[:80]}', errno=errno, sfqid=sfqid),
+                            len(rule) > 3 and bool(rule[3]))
+        return None
+
+    def _queued_until(self, now):
+        """
+        :return: when a query submitted now starts, once fewer than warehouse_concurrency queries are ahead of it
+        """
+        with self._lock:
+            ahead = sorted(query.finishes_at for query in self.queries.values()
+                           if query.finishes_at > now and query.error is None)
+        if len(ahead) < self.warehouse_concurrency:
+            return now
+        return ahead[len(ahead) - self.warehouse_concurrency]
+
+    def _query(self, sfqid):
+        try:
+            return self.queries[sfqid]
+        except KeyError:
+            raise ProgrammingError(msg=f'Unknown query id {sfqid}')
+
+    def running_queries(self):
+        now = time.monotonic()
+        return sum(1 for query in self.queries.values() if query.finishes_at > now)
+
+    @property
+    def executed_sql(self):
+        return [sql for sql, _ in self.executed]
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def execute_string(self, sql_text, remove_comments=False, return_cursors=True, **kwargs):
+        cursors = []
+        for statement, _ in split_statements(io.StringIO(sql_text), remove_comments=remove_comments):
+            cursors.append(self.cursor().execute(statement))
+        return cursors if return_cursors else []
+
+    def get_query_status(self, sfqid):
+        self._round_trip()
+        query = self._query(sfqid)
+        if time.monotonic() < query.starts_at:
+            return QueryStatus.QUEUED
+        if time.monotonic() < query.finishes_at:
+            return QueryStatus.RUNNING
+        return QueryStatus.FAILED_WITH_ERROR if query.error is not None else QueryStatus.SUCCESS
+
+    def get_query_status_throw_if_error(self, sfqid):
+        status = self.get_query_status(sfqid)
+        if status == QueryStatus.FAILED_WITH_ERROR:
+            raise self._query(sfqid).error
+        return status
+
+    @staticmethod
+    def is_still_running(status):
+        return status in (QueryStatus.QUEUED, QueryStatus.RUNNING)
+
+    @staticmethod
+    def is_an_error(status):
+        return status == QueryStatus.FAILED_WITH_ERROR
+
+    def autocommit(self, mode):
+        pass
+
+    def is_closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+
+class FakeSnowflakeConnectionHook:
+    """
+    Drop in for hooks.snowflake_hook.SnowflakeConnection returning fake connections to one shared backend,
+    e.g. for a connection pool
+    """
+    def __init__(self, database=None, connect_latency: float = 0.0, **kwargs):
+        """
+        :param database: default database, restored on connections returned to a pool
+        :param connect_latency: seconds opening a connection takes
+        :param kwargs: FakeSnowflakeConnection arguments
+        """
+        self.database = database
+        self.connect_latency = connect_latency
+        self.kwargs = kwargs
+        self.kwargs.setdefault('backend', FakeBackend())
+        self.connections = []
+
+    @property
+    def backend(self):
+        return self.kwargs['backend']
+
+    def get_conn(self):
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        conn = FakeSnowflakeConnection(**self.kwargs)
+        self.connections.append(conn)
+        return conn
+
+    @property
+    def round_trips(self):
+        return sum(conn.round_trips for conn in self.connections)
@@ -1,8 +1,9 @@
-import snowflake.connector
 import os
+import threading
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
+# DER private keys decrypted in this process, keyed by key file path and modification time
+_private_key_cache = {}
+_private_key_lock = threading.Lock()
 
 
 class SnowflakeConnection:
@@ -31,7 +32,9 @@ class SnowflakeConnection:
             "account": self.account or '',
             "warehouse": self.warehouse or '',
             "role": self.role or '',
-            "authenticator": self.authenticator or ''
+            "authenticator": self.authenticator or '',
+            # server side binding, statements are sent with ? placeholders and compiled once
+            "paramstyle": "qmark"
         }
 
         if self.private_key_file:
@@ -40,22 +43,45 @@ class SnowflakeConnection:
         return conn_config
 
     def _get_private_key(self):
+        """
+        Returns the DER private key, the PEM file is only read and decrypted once per process
+        :return: private key
+        """
+        if self.private_key:
+            return self.private_key
+
+        key_path = os.path.abspath(self.private_key_file)
+        cache_key = (key_path, os.path.getmtime(key_path))
+        with _private_key_lock:
+            private_key = _private_key_cache.get(cache_key)
+            if private_key is None:
+                private_key = self._decrypt_private_key()
+                _private_key_cache[cache_key] = private_key
+
+        self.private_key = private_key
+        return private_key
+
+    def _decrypt_private_key(self):
         """
         Uses the environment variable SNOWFLAKE_PRIVATE_KEY to get the passphrase
         THis can be customised or overloaded to pick up the passphase from somewhere different
         :return: private key
         """
+        # only key pair authentication needs cryptography
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+
         with open(self.private_key_file, "rb") as key:
             p_key = serialization.load_pem_private_key(
                 key.read(),
-                password=os.environment['SNOWFLAKE_PRIVATE_KEY'].encode(),
+                password=os.environ['SNOWFLAKE_PRIVATE_KEY'].encode(),
                 backend=default_backend()
             )
 
         private_key = p_key.private_bytes(
             encoding=serialization.Encoding.DER,
             format=serialization.PrivateFormat.PKCS8,
-            encrytion_algorithm=serialization.NoEncryption())
+            encryption_algorithm=serialization.NoEncryption())
 
         return private_key
 
@@ -63,6 +89,8 @@ class SnowflakeConnection:
         """
         Returns a snowflake.connection object
         """
+        import snowflake.connector
+
         conn_config = self._get_conn_params()
         conn = snowflake.connector.connect(**conn_config)
         return conn
@@ -0,0 +1,301 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+import gzip
+import logging
+import os
+import re
+import tempfile
+import time
+
+from operators.instrumentation import instrumentation
+from operators.manifest_reader import LOAD_FORMATS
+from operators.sql_templates import get_rendered_template
+
+logger = logging.getLogger(__name__)
+
+# bytes read per block when chunk boundaries are scanned and chunks are compressed
+BLOCK_SIZE = 1024 * 1024
+# file format options taking a string, quoted in the COPY unless NONE or AUTO, other options are written as given
+STRING_OPTIONS = ('field_delimiter', 'record_delimiter', 'field_optionally_enclosed_by', 'escape',
+                  'escape_unenclosed_field', 'date_format', 'time_format', 'timestamp_format', 'binary_format',
+                  'encoding', 'file_extension')
+UNSAFE_NAME_CHARACTERS = re.compile(r'[^\w.-]+')
+
+
+def format_option(name: str, value: str):
+    """
+    :param name: file format option name, lower case
+    :param value: option value from a manifest include, e.g. 1, TRUE, GZIP, | or '|'
+    :return: the value as written in a COPY statement
+    """
+    value = str(value)
+    if name not in STRING_OPTIONS or value.upper() in ('NONE', 'AUTO') or \
+            (len(value) >= 2 and value[0] == value[-1] == "'"):
+        return value
+    # escape sequences such as \t are kept, Snowflake reads them in string literals
+    return "'" + value.replace("'", "\\'") + "'"
+
+
+def _unquote(value):
+    value = str(value)
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        return value[1:-1]
+    return value
+
+
+def _option_character(value):
+    """
+    :param value: file format option taking one character, e.g. field_optionally_enclosed_by or escape
+    :return: the character as bytes, None if the option is not set or NONE
+    """
+    if value is None:
+        return None
+    value = _unquote(value)
+    if not value or value.upper() == 'NONE':
+        return None
+    if len(value) > 1 and value.startswith('\\'):
+        # escape sequences as written in a Snowflake string literal, e.g. \\ for a backslash or \' for a quote
+        value = value.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+    return value.encode('utf-8')
+
+
+class LoadStats:
+    """
+    Counters of the files prepared for bulk loads
+    """
+    __slots__ = ('files', 'chunks', 'bytes_read', 'bytes_compressed', 'prepare_time')
+
+    def __init__(self):
+        self.files = 0
+        self.chunks = 0
+        self.bytes_read = 0
+        self.bytes_compressed = 0
+        self.prepare_time = 0.0
+
+
+class BulkLoader:
+    """
+    Prepares the data files of a bulk load changeset (manifest_reader.LoadFile) for PUT and COPY INTO. CSV files
+    are split into chunks of about chunk_mb at record boundaries and gzip'd on worker threads, so the upload and the
+    COPY run in parallel over many files. Parquet files are uploaded as they are. Chunks are named after their data
+    file and compressed without a timestamp, so a load retried after a failure uploads identical files and the COPY
+    skips the files its load metadata records as already loaded.
+    """
+    def __init__(self, workers: int = 4, chunk_mb: float = 100, compression_level: int = 6, stage: str = None,
+                 work_directory: str = None, purge: bool = True):
+        """
+        :param workers: threads compressing chunks, also the PARALLEL option of the PUT
+        :param chunk_mb: uncompressed size of a CSV chunk
+        :param compression_level: gzip level, 1 (fastest) to 9 (smallest)
+        :param stage: stage the files are uploaded to, the table stage of the loaded table if None
+        :param work_directory: directory for the compressed chunks, a temp directory if None
+        :param purge: remove the files from the stage once loaded
+        """
+        self.workers = max(1, int(workers))
+        self.chunk_size = max(1, int(float(chunk_mb) * 1024 * 1024))
+        self.compression_level = int(compression_level)
+        self.stage = stage
+        self.work_directory = work_directory
+        self.purge = purge
+        self.stats = LoadStats()
+
+    @classmethod
+    def from_properties(cls, properties: dict):
+        """
+        :param properties: Dictionary of the properties yaml file, reads the bulk_load section
+        """
+        load_properties = properties.get('bulk_load') or {}
+        return cls(workers=int(load_properties.get('workers') or 4),
+                   chunk_mb=float(load_properties.get('chunk_mb') or 100),
+                   compression_level=int(load_properties.get('compression_level') or 6),
+                   stage=load_properties.get('stage') or None,
+                   work_directory=load_properties.get('work_directory') or None,
+                   purge=load_properties.get('purge', True))
+
+    def stage_location(self, load_file, changeset: str):
+        """
+        Stage path the files of a changeset are uploaded to, one path per changeset so loads never see each other's
+        files
+        :param load_file: manifest_reader.LoadFile
+        :param changeset: changeset id
+        :return: stage path without the leading @
+        """
+        stage = load_file.stage or self.stage
+        if stage:
+            stage = stage.lstrip('@').rstrip('/')
+        else:
+            schema, _, table = load_file.table.rpartition('.')
+            stage = f'{schema}.%{table}' if schema else f'%{table}'
+        return f'{stage}/release_tool/{UNSAFE_NAME_CHARACTERS.sub("_", changeset)}'
+
+    def _chunk_ranges(self, source: Path, skip_header: int, quote: bytes, escape: bytes = None):
+        """
+        Splits a CSV file into byte ranges of about chunk_size ending at record boundaries. Only the quote
+        characters are counted, a newline inside a quoted field does not end a record, and a quote character
+        following the escape character is not counted.
+        :return: list of (start, end) offsets
+        """
+        ranges = []
+        size = os.path.getsize(source)
+        escaped = None if escape is None else re.compile(re.escape(escape) + b'.', re.DOTALL)
+
+        def count_quotes(data, pending_escape):
+            """
+            :return: unescaped quote characters in data, whether data ends with an escape of the next byte
+            """
+            if escaped is None:
+                return data.count(quote), False
+            if pending_escape:
+                data = data[1:]
+            data = escaped.sub(b'', data)
+            return data.count(quote), data.endswith(escape)
+
+        with open(source, 'rb') as f:
+            for _ in range(skip_header):
+                f.readline()
+            start = f.tell()
+            in_quote = False
+            pending_escape = False
+            while start < size:
+                f.seek(start)
+                position = start
+                block = b''
+                while position - start < self.chunk_size:
+                    block = f.read(min(BLOCK_SIZE, self.chunk_size - (position - start)))
+                    if not block:
+                        break
+                    if quote is not None:
+                        quotes, pending_escape = count_quotes(block, pending_escape)
+                        if quotes % 2:
+                            in_quote = not in_quote
+                    position += len(block)
+                if in_quote or pending_escape or not block.endswith(b'\n'):
+                    # finish the record the chunk ends in
+                    for line in iter(f.readline, b''):
+                        position += len(line)
+                        if quote is not None:
+                            quotes, pending_escape = count_quotes(line, pending_escape)
+                            if quotes % 2:
+                                in_quote = not in_quote
+                        if not in_quote and not pending_escape:
+                            break
+                ranges.append((start, position))
+                start = position
+        return ranges
+
+    def _compress(self, source: Path, start: int, end: int, target: Path):
+        # the header carries no timestamp, the same range always compresses to the same file
+        with open(source, 'rb') as f, open(target, 'wb') as raw, \
+                gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=self.compression_level,
+                              mtime=0) as compressed:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                compressed.write(block)
+                remaining -= len(block)
+        return os.path.getsize(target)
+
+    def prepare(self, load_file, directory):
+        """
+        Splits and compresses the CSV files of a load into a directory
+        :param load_file: manifest_reader.LoadFile with format csv
+        :param directory: directory the chunks are written to
+        :return: number of chunks
+        """
+        start = time.perf_counter()
+        skip_header = int(_unquote(load_file.options.get('skip_header', 0)))
+        quote = _option_character(load_file.options.get('field_optionally_enclosed_by'))
+        # a doubled quote character keeps the count even, an escape that is the quote character is not skipped
+        escapes = {_option_character(load_file.options.get(name)) for name in ('escape', 'escape_unenclosed_field')}
+        escapes -= {None, quote}
+        whole_files = quote is not None and len(escapes) > 1
+        if whole_files:
+            # quotes escaped differently inside and outside quoted fields cannot be told apart by counting
+            logger.info(f'{load_file.file} sets different escape characters, its files are not split')
+        escape = next(iter(escapes), None) if quote is not None and not whole_files else None
+        chunks = []
+        data_files = load_file.data_files()
+        for data_file in data_files:
+            name = UNSAFE_NAME_CHARACTERS.sub('_', data_file.stem)
+            if whole_files:
+                with open(data_file, 'rb') as f:
+                    for _ in range(skip_header):
+                        f.readline()
+                    ranges = [(f.tell(), os.path.getsize(data_file))]
+            else:
+                ranges = self._chunk_ranges(data_file, skip_header, quote, escape)
+            for index, (chunk_start, chunk_end) in enumerate(ranges):
+                chunks.append((data_file, chunk_start, chunk_end, Path(directory, f'{name}_{index:05d}.csv.gz')))
+        with instrumentation.span('load_prepare', file=load_file.file, chunks=len(chunks)) as span:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bulk-load') as executor:
+                compressed = sum(executor.map(lambda chunk: self._compress(*chunk), chunks))
+            read = sum(chunk_end - chunk_start for _, chunk_start, chunk_end, _ in chunks)
+            span.set(bytes_read=read, bytes_compressed=compressed)
+        elapsed = time.perf_counter() - start
+        self.stats.files += len(data_files)
+        self.stats.chunks += len(chunks)
+        self.stats.bytes_read += read
+        self.stats.bytes_compressed += compressed
+        self.stats.prepare_time += elapsed
+        logger.info(f'Prepared {load_file.file}: {len(chunks)} chunks, {read / 1024 / 1024:.1f}MB compressed to '
+                    f'{compressed / 1024 / 1024:.1f}MB in {elapsed:.2f}s')
+        return len(chunks)
+
+    def put_statement(self, load_file, changeset: str, directory=None):
+        """
+        :param load_file: manifest_reader.LoadFile
+        :param changeset: changeset id
+        :param directory: directory of the prepared chunks of a CSV load
+        :return: PUT statement uploading the files of the load
+        """
+        if load_file.format == 'csv':
+            source, compression = Path(directory, '*.csv.gz'), 'GZIP'
+        elif load_file.path.is_dir():
+            source, compression = Path(load_file.path, f'*.{load_file.format}'), 'AUTO_DETECT'
+        else:
+            source, compression = load_file.path, 'AUTO_DETECT'
+        return get_rendered_template('put_load_files.j2',
+                                     source=Path(source).resolve().as_posix(),
+                                     stage=self.stage_location(load_file, changeset),
+                                     parallel=self.workers,
+                                     source_compression=compression)
+
+    def copy_statement(self, load_file, changeset: str):
+        """
+        :param load_file: manifest_reader.LoadFile
+        :param changeset: changeset id
+        :return: COPY INTO statement loading the uploaded files
+        """
+        options = {name: value for name, value in load_file.options.items() if name != 'skip_header'}
+        if load_file.format == 'csv':
+            # headers are dropped when the files are split
+            options['compression'] = 'GZIP'
+        return get_rendered_template('copy_into_table.j2',
+                                     table=load_file.table,
+                                     stage=self.stage_location(load_file, changeset),
+                                     format=load_file.format.upper(),
+                                     file_format=tuple((name.upper(), format_option(name, value))
+                                                       for name, value in sorted(options.items())),
+                                     match_by_column_name=load_file.format == 'parquet',
+                                     purge='TRUE' if self.purge else 'FALSE')
+
+    @contextmanager
+    def prepared(self, load_file, changeset: str):
+        """
+        Prepares the files of a load in a work directory removed on exit
+        :param load_file: manifest_reader.LoadFile
+        :param changeset: changeset id
+        :return: (PUT statement, COPY statement), the PUT must run before exit
+        """
+        if load_file.format not in LOAD_FORMATS:
+            raise ValueError(f'{load_file.file}: unsupported bulk load format {load_file.format}')
+        if self.work_directory:
+            Path(self.work_directory).mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix='release_tool_load_', dir=self.work_directory) as directory:
+            if load_file.format == 'csv':
+                self.prepare(load_file, directory)
+            yield self.put_statement(load_file, changeset, directory), self.copy_statement(load_file, changeset)
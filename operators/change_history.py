@@ -0,0 +1,107 @@
+from typing import NamedTuple, Any
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeRecord(NamedTuple):
+    """
+    A row of the history table, in table column order
+    """
+    id: str
+    author: str = None
+    filename: str = None
+    date_released: Any = None
+    change_log: str = None
+    jira_number: str = None
+    release_number: str = None
+    comments: str = None
+    deployment_id: Any = None
+    status: str = None
+    checksum: str = None
+
+
+HISTORY_COLUMNS = ChangeRecord._fields
+
+
+class ChangeHistory:
+    """
+    Change history of a database indexed by change id and filename, holding the latest record of each change
+    """
+    __slots__ = ('_by_id', '_by_filename', '_change_logs')
+
+    def __init__(self, rows=()):
+        """
+        :param rows: history table rows in HISTORY_COLUMNS order, as tuples or ChangeRecords
+        """
+        self._by_id = {}
+        self._by_filename = {}
+        self._change_logs = set()
+        self.extend(rows)
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        """
+        Indexes a history row, a later release of the same change id replaces the earlier one
+        :param row: history table row as a tuple or ChangeRecord
+        :return: the ChangeRecord held for the change id
+        """
+        record = row if isinstance(row, ChangeRecord) else ChangeRecord(*row)
+        current = self._by_id.get(record.id)
+        if current is not None and _is_older(record, current):
+            return current
+        self._by_id[record.id] = record
+        if record.filename is not None:
+            self._by_filename[record.filename] = record
+        if record.change_log is not None:
+            self._change_logs.add(record.change_log)
+        return record
+
+    def get(self, id: str):
+        """
+        Returns the latest record for a change id, None if the change was never released
+        """
+        return self._by_id.get(id)
+
+    def get_by_filename(self, filename: str):
+        """
+        Returns the latest record released from a SQL file, None if the file was never released
+        """
+        return self._by_filename.get(filename)
+
+    def status(self, id: str):
+        """
+        Returns the latest status of a change id, None if the change was never released
+        """
+        record = self._by_id.get(id)
+        return record.status if record is not None else None
+
+    def is_released(self, id: str):
+        return self.status(id) == 'success'
+
+    @property
+    def change_logs(self):
+        """
+        Change logs with at least one change in the history
+        """
+        return self._change_logs
+
+    def __contains__(self, id):
+        return id in self._by_id
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+def _is_older(record, current):
+    try:
+        return record.date_released is not None and current.date_released is not None \
+            and record.date_released < current.date_released
+    except TypeError:
+        return False
@@ -0,0 +1,125 @@
+from typing import NamedTuple
+import re
+
+CHANGESET_PATTERN = re.compile(r'^--\s*changeset\s+(?P<author>[^\s:]+):(?P<id>\S+)(?P<attributes>.*)$',
+                               re.IGNORECASE)
+ATTRIBUTE_PATTERN = re.compile(r'(?P<name>[\w.-]+):(?:"(?P<quoted>[^"]*)"|(?P<value>\S*))')
+HEADER_PATTERN = re.compile(r'^--\s*(?P<name>comment|labels|depends)\s*:(?P<value>.*)$', re.IGNORECASE)
+LIST_SEPARATOR = re.compile(r'[\s,]+')
+
+
+class ChangeSet(NamedTuple):
+    """
+    Metadata from the comment header of a SQL change file
+    """
+    author: str = None
+    id: str = None
+    context: str = None
+    labels: tuple = ()
+    comments: str = None
+    depends: tuple = None
+    attributes: tuple = ()
+
+    def get_attribute(self, name: str, default=None):
+        """
+        Returns an extra --changeset attribute, e.g. runOnChange:true
+        """
+        for attribute_name, value in self.attributes:
+            if attribute_name == name:
+                return value
+        return default
+
+    def to_change_details(self):
+        """
+        Returns the metadata keyed by history table column
+        """
+        details = {'author': self.author,
+                   'id': self.id,
+                   'release_number': self.context,
+                   'jira_number': self.labels[0] if self.labels else None,
+                   'comments': self.comments}
+        if self.depends is not None:
+            details['depends'] = list(self.depends)
+        return details
+
+
+def _split_list(value):
+    return tuple(item for item in LIST_SEPARATOR.split(value.strip()) if item)
+
+
+def parse_header(lines):
+    """
+    Parses the changeset metadata from the leading comment lines of a SQL change file, stops at the first line that
+    is not blank or a comment so the SQL itself is never scanned
+    :param lines: iterable of lines, e.g. an open file or ChangeFile.header_lines
+    :return: ChangeSet, all fields empty if the file has no --changeset line
+    """
+    fields = {}
+    labels = []
+    comments = []
+    attributes = []
+    for line in lines:
+        # a byte order mark saved by Windows editors precedes the first line
+        line = line.strip().lstrip('\ufeff')
+        if not line:
+            continue
+        if not line.startswith('--'):
+            break
+
+        match = CHANGESET_PATTERN.match(line)
+        if match:
+            fields['author'] = match.group('author')
+            fields['id'] = match.group('id')
+            for attribute in ATTRIBUTE_PATTERN.finditer(match.group('attributes')):
+                value = attribute.group('quoted')
+                if value is None:
+                    value = attribute.group('value')
+                if attribute.group('name').lower() == 'context':
+                    fields['context'] = value
+                else:
+                    attributes.append((attribute.group('name'), value))
+            continue
+
+        match = HEADER_PATTERN.match(line)
+        if match:
+            name = match.group('name').lower()
+            value = match.group('value').strip()
+            if name == 'comment':
+                if value:
+                    comments.append(value)
+            elif name == 'labels':
+                labels.extend(_split_list(value))
+            else:
+                # an id listed twice is one dependency
+                fields['depends'] = tuple(dict.fromkeys(fields.get('depends', ()) + _split_list(value)))
+
+    return ChangeSet(labels=tuple(labels),
+                     comments=' '.join(comments) if comments else None,
+                     attributes=tuple(attributes),
+                     **fields)
+
+
+def parse_attributes(attributes: dict):
+    """
+    Builds the changeset metadata of a changeset declared by the attributes of a manifest element instead of a SQL
+    comment header, e.g. <include file="seed/countries.csv" type="load" id="seed-1" author="jdoe" labels="JIRA-1"/>
+    :param attributes: element attributes, author, id, context, labels, comment and depends are read
+    :return: ChangeSet
+    """
+    depends = attributes.get('depends')
+    return ChangeSet(author=attributes.get('author'),
+                     id=attributes.get('id'),
+                     context=attributes.get('context'),
+                     labels=_split_list(attributes.get('labels', '')),
+                     comments=attributes.get('comment') or None,
+                     depends=_split_list(depends) if depends is not None else None)
+
+
+def parse_file(sqlfile):
+    """
+    Parses the changeset metadata of a SQL change file, reading only its comment header
+    :param sqlfile: SQL file location
+    :return: ChangeSet
+    """
+    with open(sqlfile, encoding='utf-8-sig') as f:
+        return parse_header(f)
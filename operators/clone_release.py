@@ -0,0 +1,251 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from operators.instrumentation import instrumentation
+from operators.sql_templates import get_rendered_template
+from snowflake.connector.errors import DatabaseError, ProgrammingError
+
+logger = logging.getLogger(__name__)
+
+CLONE_INFIX = '_CLONE_'
+# phases of a release to a clone, in order
+CLONE_PHASES = ('clone', 'deploy', 'validate', 'swap', 'cleanup')
+
+
+def clone_prefix(target_database: str):
+    """
+    :param target_database: database released to
+    :return: prefix of the names of its clones, backups and failed clones
+    """
+    return f'{target_database}{CLONE_INFIX}'.upper()
+
+
+def expired_databases(databases, target_database: str, status: str, retain: int):
+    """
+    Applies the retention policy to the databases left by releases to clones of a target
+    :param databases: database names, e.g. from SHOW TERSE DATABASES
+    :param target_database: database released to
+    :param status: suffix given by SnowflakeOperator.mark_database_release, e.g. BACKUP or FAILED
+    :param retain: number of the most recent databases with the status to keep
+    :return: names of the databases to drop, oldest last
+    """
+    prefix = clone_prefix(target_database)
+    suffix = f'_{status.upper()}'
+    # clone names end in a timestamp, so they sort in the order they were created
+    marked = sorted((name for name in databases if name.upper().startswith(prefix) and name.upper().endswith(suffix)),
+                    reverse=True)
+    return marked[max(0, int(retain)):]
+
+
+class ValidationCheck:
+    """
+    A query validating a clone before it is swapped with the target: a view compiled, a table counted or a
+    validation query from the properties
+    """
+    __slots__ = ('kind', 'name', 'sql', 'compare_sql', 'ok', 'detail', 'elapsed')
+
+    def __init__(self, kind: str, name: str, sql: str, compare_sql: str = None):
+        """
+        :param kind: view, row_count or query
+        :param name: object validated, or the validation query
+        :param sql: query run against the clone
+        :param compare_sql: row count of the table in the target, None for a table new in the release
+        """
+        self.kind = kind
+        self.name = name
+        self.sql = sql
+        self.compare_sql = compare_sql
+        self.ok = None
+        self.detail = ''
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return f'ValidationCheck({self.kind}, {self.name}, ok={self.ok})'
+
+
+class CloneValidator:
+    """
+    Validates a clone a release was deployed to. Every view is compiled, every table is counted and compared with
+    the target and the validation queries of the properties must return no rows. The checks are queued and run on
+    up to workers pooled connections, each validation is a short metadata or compilation query so they are latency
+    bound and run concurrently.
+    """
+    def __init__(self, connection_pool, workers: int = 4, validate_views: bool = True, count_rows: bool = True,
+                 max_row_loss: float = None, validation_queries=()):
+        """
+        :param connection_pool: pool the validation connections are borrowed from
+        :param workers: connections the checks run on
+        :param validate_views: compile every view of the clone
+        :param count_rows: count the rows of every table of the clone and of the target
+        :param max_row_loss: fraction of its rows a table of the target may lose in the release, row counts are
+                             only reported if None
+        :param validation_queries: queries run with the clone as the current database, a query returning rows
+                                   fails the validation
+        """
+        self.connection_pool = connection_pool
+        self.workers = max(1, int(workers))
+        self.validate_views = validate_views
+        self.count_rows = count_rows
+        self.max_row_loss = None if max_row_loss is None else float(max_row_loss)
+        self.validation_queries = tuple(validation_queries or ())
+
+    @classmethod
+    def from_properties(cls, connection_pool, properties: dict):
+        """
+        :param connection_pool: pool the validation connections are borrowed from
+        :param properties: Dictionary of the properties yaml file, reads the clone_release section
+        """
+        clone_properties = properties.get('clone_release') or {}
+        max_row_loss = clone_properties.get('max_row_loss')
+        return cls(connection_pool,
+                   workers=int(clone_properties.get('validation_workers') or 4),
+                   validate_views=clone_properties.get('validate_views', True),
+                   count_rows=clone_properties.get('count_rows', True),
+                   max_row_loss=None if max_row_loss in (None, '') else float(max_row_loss),
+                   validation_queries=clone_properties.get('validation_queries') or ())
+
+    @staticmethod
+    def _objects(cursor, database):
+        sql = get_rendered_template(template='select_database_objects.j2', database=database)
+        logger.debug(sql)
+        return {(schema, name): kind for schema, name, kind in cursor.execute(sql).fetchall()}
+
+    def checks(self, cursor, clone: str, target: str):
+        """
+        Lists the objects of the clone and of the target and builds the checks
+        :param cursor: cursor of the release connection
+        :param clone: clone released to
+        :param target: database the clone was made from
+        :return: list of ValidationCheck
+        """
+        checks = []
+        clone_objects = self._objects(cursor, clone)
+        target_objects = self._objects(cursor, target) if self.count_rows else {}
+        for (schema, name), kind in sorted(clone_objects.items()):
+            if kind == 'VIEW' and self.validate_views:
+                checks.append(ValidationCheck('view', f'{schema}.{name}',
+                                              f'SELECT * FROM {clone}.{schema}.{name} LIMIT 0'))
+            elif kind == 'BASE TABLE' and self.count_rows:
+                compare_sql = f'SELECT COUNT(*) FROM {target}.{schema}.{name}' \
+                    if target_objects.get((schema, name)) == 'BASE TABLE' else None
+                checks.append(ValidationCheck('row_count', f'{schema}.{name}',
+                                              f'SELECT COUNT(*) FROM {clone}.{schema}.{name}', compare_sql))
+        for sql in self.validation_queries:
+            checks.append(ValidationCheck('query', ' '.join(sql.split())[:80], sql))
+        return checks
+
+    def _run(self, cursor, check):
+        start = time.perf_counter()
+        try:
+            rows = cursor.execute(check.sql).fetchall()
+            if check.kind == 'row_count':
+                count = rows[0][0]
+                before = cursor.execute(check.compare_sql).fetchone()[0] if check.compare_sql else None
+                check.detail = f'{count} rows' if before is None else f'{before} -> {count} rows'
+                check.ok = self.max_row_loss is None or not before or (before - count) / before <= self.max_row_loss
+            elif check.kind == 'query':
+                check.ok = not rows
+                check.detail = f'{len(rows)} rows returned' if rows else ''
+            else:
+                check.ok = True
+        except (ProgrammingError, DatabaseError) as e:
+            check.ok = False
+            check.detail = str(e)
+        check.elapsed = time.perf_counter() - start
+        if not check.ok:
+            logger.error(f'Validation failed: {check.kind} {check.name}: {check.detail}')
+        return check
+
+    def validate(self, conn, clone: str, target: str):
+        """
+        Validates a clone
+        :param conn: the release connection, the checks run on it when the pool has no other connection
+        :param clone: clone released to
+        :param target: database the clone was made from
+        :return: list of ValidationCheck
+        """
+        start = time.perf_counter()
+        checks = self.checks(conn.cursor(), clone, target)
+        pending = iter(checks)
+        lock = threading.Lock()
+
+        def run_checks(worker_conn):
+            cursor = worker_conn.cursor()
+            # validation queries name the objects of the clone without the database
+            cursor.execute(f'USE DATABASE {clone}')
+            while True:
+                with lock:
+                    check = next(pending, None)
+                if check is None:
+                    return
+                with instrumentation.span('validation', check=check.kind, object=check.name) as span:
+                    span.set(ok=self._run(cursor, check).ok)
+
+        def work():
+            with self.connection_pool.connection() as worker_conn:
+                run_checks(worker_conn)
+
+        # the release connection stays borrowed, the workers share the rest of the pool
+        workers = min(self.workers, len(checks), self.connection_pool.max_size - 1)
+        if workers < 1:
+            run_checks(conn)
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='validate') as executor:
+                for future in [executor.submit(work) for _ in range(workers)]:
+                    future.result()
+
+        failed = sum(1 for check in checks if not check.ok)
+        kinds = {kind: sum(1 for check in checks if check.kind == kind) for kind in ('view', 'row_count', 'query')}
+        logger.info(f'Validated {clone}: {kinds["view"]} views compiled, {kinds["row_count"]} tables counted, '
+                    f'{kinds["query"]} validation queries, {failed} failed in {time.perf_counter() - start:.2f}s '
+                    f'on {max(1, workers)} connections')
+        for check in checks:
+            if check.ok and check.detail:
+                logger.debug(f'{check.kind} {check.name}: {check.detail}')
+        return checks
+
+
+class CloneRelease:
+    """
+    A release to a clone of the target: the clone, the time taken by each phase (clone, deploy, validate, swap,
+    cleanup), the validation checks and whether the clone was swapped with the target
+    """
+    __slots__ = ('target', 'clone', 'phases', 'checks', 'swapped', 'kept', 'dropped', 'error')
+
+    def __init__(self, target: str):
+        self.target = target
+        self.clone = None
+        self.phases = {}
+        self.checks = []
+        self.swapped = False
+        # name the clone was renamed to after the release, BACKUP holding the previous target or FAILED
+        self.kept = None
+        self.dropped = []
+        # error of the swap or of the rename after it
+        self.error = None
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Times a phase of the release, use as a context manager
+        :param name: one of CLONE_PHASES
+        """
+        start = time.perf_counter()
+        try:
+            with instrumentation.span('release_phase', phase=name, database=self.target, clone=self.clone):
+                yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    @property
+    def failed_checks(self):
+        return [check for check in self.checks if not check.ok]
+
+    def summary(self):
+        phases = ', '.join(f'{name} {self.phases[name]:.2f}s' for name in CLONE_PHASES if name in self.phases)
+        outcome = f'swapped with {self.target}' if self.swapped else 'not swapped'
+        error = f', {self.error}' if self.error else ''
+        return f'Clone release of {self.target} to {self.clone} {outcome}: {phases}{error}'
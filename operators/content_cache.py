@@ -0,0 +1,102 @@
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+def content_checksum(content):
+    """
+    Returns the checksum of a manifest or SQL file stored in the cache and the history table
+    :param content: file content, str or bytes
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+class ContentCache:
+    """
+    Persistent cache of manifest and SQL file metadata keyed by file path. An entry is only used while the file
+    size and modification time are unchanged, so unchanged files are never re-read or re-parsed.
+    """
+    def __init__(self, cache_file=None):
+        """
+        :param cache_file: JSON file the cache is loaded from and saved to, the cache is in memory only if None
+        """
+        self.cache_file = Path(cache_file) if cache_file else None
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.info(f'Ignoring invalid content cache {self.cache_file}: {e}')
+            return
+        if cache.get('version') == CACHE_VERSION:
+            self._entries = cache.get('entries', {})
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, path):
+        """
+        Returns the cached data of a file if the file is unchanged since it was cached
+        :param path: file path
+        :return: dict of cached data, None if not cached or changed
+        """
+        try:
+            size, mtime_ns = self._stat(path)
+        except OSError:
+            size = mtime_ns = None
+        with self._lock:
+            entry = self._entries.get(str(path))
+            if entry is None or size is None or entry.get('size') != size or entry.get('mtime_ns') != mtime_ns:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry.get('data')
+
+    def update(self, path, **data):
+        """
+        Caches data for a file at its current size and modification time
+        :param path: file path
+        :param data: JSON serialisable data, e.g. checksum and parsed metadata
+        """
+        size, mtime_ns = self._stat(path)
+        with self._lock:
+            self._entries[str(path)] = {'size': size, 'mtime_ns': mtime_ns, 'data': data}
+            self._dirty = True
+
+    def save(self):
+        """
+        Writes the cache file if any entry changed
+        """
+        if self.cache_file is None or not self._dirty:
+            return
+        with self._lock:
+            cache = {'version': CACHE_VERSION, 'entries': self._entries}
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_suffix('.tmp')
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_file, self.cache_file)
+            self._dirty = False
+        logger.debug(f'Content cache saved: {self.hits} hits, {self.misses} misses')
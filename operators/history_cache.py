@@ -0,0 +1,149 @@
+from pathlib import Path
+import datetime
+import json
+import logging
+import os
+
+from operators.change_history import HISTORY_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 3
+
+
+def _encode(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _decode_row(row, datetime_columns):
+    for i in datetime_columns:
+        if row[i] is not None:
+            row[i] = datetime.datetime.fromisoformat(row[i])
+    return row
+
+
+class HistoryCache:
+    """
+    Local copy of the successful rows of a history table. Rows are appended to a JSON lines file and a small
+    metadata file records the state of the history table at the last sync, its count of successful rows and the
+    watermark (highest value of the watermark column, read on the server), and the size of the rows file, so a
+    truncated or foreign file is detected and triggers a full resync. Before a sync the state of the history table
+    is compared to the cached one: the same state needs no fetch, fewer rows or a lower watermark mean the table
+    was truncated, restored or swapped and the cache is rebuilt.
+    """
+    def __init__(self, cache_directory, history_table: str, watermark_column: str = 'date_released',
+                 overlap: datetime.timedelta = datetime.timedelta(hours=24)):
+        """
+        :param cache_directory: directory holding the cache files
+        :param history_table: fully qualified history table name, one cache per target database
+        :param watermark_column: history column used to find new rows, release timestamp or a sequence
+        :param overlap: rows released up to this long before the watermark are fetched again, to pick up rows that
+                        were written late or changed status after the last sync
+        """
+        if watermark_column not in HISTORY_COLUMNS:
+            raise ValueError(f'Unknown history watermark column {watermark_column}')
+        self.history_table = history_table
+        self.watermark_column = watermark_column
+        self.watermark_index = HISTORY_COLUMNS.index(watermark_column)
+        self.overlap = overlap
+        self.rows_file = Path(cache_directory, f'{history_table.lower()}.rows.jsonl')
+        self.meta_file = Path(cache_directory, f'{history_table.lower()}.meta.json')
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('version') != CACHE_VERSION or meta.get('history_table') != self.history_table \
+                or meta.get('watermark_column') != self.watermark_column:
+            return None
+        try:
+            if self.rows_file.stat().st_size != meta.get('rows_size'):
+                return None
+        except OSError:
+            return None
+        return meta
+
+    def load(self):
+        """
+        Reads the cached rows
+        :return: (rows, state), state the (row count, watermark) of the history table at the last sync, None if the
+                 cache is missing or invalid
+        """
+        meta = self._read_meta()
+        if meta is None:
+            return None
+        datetime_columns = [HISTORY_COLUMNS.index('date_released')]
+        try:
+            with open(self.rows_file) as f:
+                rows = [_decode_row(json.loads(line), datetime_columns) for line in f]
+        except (OSError, ValueError) as e:
+            logger.info(f'History cache {self.rows_file} is invalid: {e}')
+            return None
+        watermark = meta.get('watermark')
+        if watermark is not None and meta.get('watermark_is_datetime'):
+            watermark = datetime.datetime.fromisoformat(watermark)
+        return rows, (meta.get('row_count'), watermark)
+
+    def query_watermark(self, watermark):
+        """
+        Returns the value new rows are fetched from, the watermark less the overlap for timestamps
+        """
+        if isinstance(watermark, datetime.datetime):
+            return watermark - self.overlap
+        return watermark
+
+    @staticmethod
+    def is_replaced(cached_state, state):
+        """
+        Checks whether the history table was truncated, restored or swapped since the last sync
+        :param cached_state: (row count, watermark) recorded at the last sync
+        :param state: current (row count, watermark) of the history table
+        :return: True if the table holds fewer successful rows or its watermark went back
+        """
+        cached_count, cached_watermark = cached_state
+        count, watermark = state
+        if count < cached_count:
+            return True
+        try:
+            return cached_watermark is not None and (watermark is None or watermark < cached_watermark)
+        except TypeError:
+            return True
+
+    def save(self, rows, state, append: bool = True):
+        """
+        Writes rows to the cache and records the state of the history table they were read from
+        :param rows: iterable of history rows in HISTORY_COLUMNS order
+        :param state: (row count, watermark) of the successful rows of the history table, read before the rows
+        :param append: add to the cached rows, otherwise replace them
+        """
+        self.rows_file.parent.mkdir(parents=True, exist_ok=True)
+        if not append:
+            self.invalidate()
+        with open(self.rows_file, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(list(row), default=_encode) + '\n')
+
+        row_count, watermark = state
+        meta = {'version': CACHE_VERSION,
+                'history_table': self.history_table,
+                'watermark_column': self.watermark_column,
+                'watermark': _encode(watermark) if not isinstance(watermark, (int, float, str, type(None)))
+                else watermark,
+                'watermark_is_datetime': isinstance(watermark, datetime.datetime),
+                'row_count': row_count,
+                'rows_size': self.rows_file.stat().st_size}
+        tmp_file = self.meta_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, self.meta_file)
+
+    def invalidate(self):
+        for cache_file in (self.meta_file, self.rows_file):
+            try:
+                cache_file.unlink()
+            except FileNotFoundError:
+                pass
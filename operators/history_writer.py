@@ -0,0 +1,137 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from operators.change_history import HISTORY_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+INSERT_TEMPLATE = 'insert_into_release_log_history_table.j2'
+STATUS_TEMPLATE = 'update_status.j2'
+
+
+def status_chunks(rows: int, batch_size: int):
+    """
+    Splits status changes into MERGE statements of a power of two rows, largest first
+    :param rows: number of status changes
+    :param batch_size: the largest chunk is the largest power of two up to batch_size
+    :return: list of chunk sizes adding up to rows
+    """
+    largest = 1 << (max(1, int(batch_size)).bit_length() - 1)
+    chunks = [largest] * (rows // largest)
+    rows %= largest
+    while rows:
+        chunk = 1 << (rows.bit_length() - 1)
+        chunks.append(chunk)
+        rows -= chunk
+    return chunks
+
+
+class HistoryWriter:
+    """
+    Buffers change records and status transitions for the history table and writes them in batches: one bulk
+    INSERT (executemany) for new changes and one MERGE for status changes of changes that are already written.
+    Values are sent as bind parameters so the statement text is reused, status changes are merged in chunks of a
+    power of two rows so a MERGE has one of a few statement texts whatever the number of changes.
+    The buffer is flushed when it holds batch_size records, when the change log changes and at the first change
+    after it held a record for flush_interval seconds, so a crash loses at most that many records. A change is only
+    ever written as success after it was deployed, so the records lost leave changes unrecorded (and deployable on
+    the next run, see release_journal for resuming them), never wrongly marked as success.
+    """
+    def __init__(self, execute, executemany, render, history_table: str, batch_size: int = 50,
+                 flush_interval: float = 10.0):
+        """
+        :param execute: callable taking a sql string and a sequence of bind parameters
+        :param executemany: callable taking a sql string and a sequence of bind parameter sequences
+        :param render: callable taking a template name and keyword arguments, returns sql
+        :param history_table: fully qualified history table name
+        :param batch_size: number of buffered records that triggers a flush
+        :param flush_interval: seconds a record is buffered before the next change flushes it, None for no limit
+        """
+        self.execute = execute
+        self.executemany = executemany
+        self.render = render
+        self.history_table = history_table
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self._new_changes = OrderedDict()
+        self._status_changes = OrderedDict()
+        # ids of the changes tracked, a second record with the same id would overwrite the first in the buffer
+        self._tracked = set()
+        # when the oldest buffered record was buffered
+        self._buffered_at = None
+        self._change_log = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._new_changes) + len(self._status_changes)
+
+    def track(self, **record):
+        """
+        Buffers a new change record, flushing first when the change belongs to a new change log
+        :param record: change metadata, keyed by history table column
+        :raises ValueError: the record has no id, or a change with the same id was already tracked
+        """
+        id = record.get('id')
+        with self._lock:
+            if id is None or id in self._tracked:
+                raise ValueError(f'Change {record.get("filename")} in {record.get("change_log")} has '
+                                 f'{"no id" if id is None else f"the id {id} of another change"}, every change '
+                                 f'needs a unique id to be recorded in {self.history_table}')
+            if self._change_log is not None and record.get('change_log') != self._change_log:
+                self.flush()
+            self._change_log = record.get('change_log')
+            self._tracked.add(id)
+            self._new_changes[id] = dict(record)
+            self._buffered()
+
+    def set_status(self, id: str, status: str):
+        """
+        Buffers a status transition for a change
+        :param id: the unique id for the change
+        :param status: success/failed
+        """
+        with self._lock:
+            if id in self._new_changes:
+                # the record is not written yet, it will be inserted with its final status
+                self._new_changes[id]['status'] = status
+            else:
+                self._status_changes.pop(id, None)
+                self._status_changes[id] = {'id': id, 'status': status}
+            self._buffered()
+
+    def flush(self):
+        """
+        Writes all buffered records and status changes to the history table
+        """
+        with self._lock:
+            if self._new_changes:
+                rows = [tuple(record.get(column) for column in HISTORY_COLUMNS)
+                        for record in self._new_changes.values()]
+                self.executemany(self.render(INSERT_TEMPLATE, history_table=self.history_table), rows)
+                logger.debug(f'Inserted {len(rows)} records into {self.history_table}')
+                self._new_changes.clear()
+            if self._status_changes:
+                records = list(self._status_changes.values())
+                start = 0
+                for rows in status_chunks(len(records), self.batch_size):
+                    params = []
+                    for record in records[start:start + rows]:
+                        params.extend((record['id'], record['status']))
+                    self.execute(self.render(STATUS_TEMPLATE, history_table=self.history_table, rows=rows), params)
+                    start += rows
+                logger.debug(f'Updated the status of {len(self._status_changes)} records in {self.history_table}')
+                self._status_changes.clear()
+            self._buffered_at = None
+
+    def _buffered(self):
+        """
+        Flushes when the buffer is full or holds a record for longer than flush_interval
+        """
+        now = time.monotonic()
+        if self._buffered_at is None:
+            self._buffered_at = now
+        if len(self) >= self.batch_size or \
+                (self.flush_interval is not None and now - self._buffered_at >= self.flush_interval):
+            self.flush()
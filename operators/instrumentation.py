@@ -0,0 +1,308 @@
+from pathlib import Path
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """
+    A timed operation of a release: connect, history_fetch, parse, render, statement or changeset
+    """
+    __slots__ = ('name', 'attributes', 'span_id', 'parent_id', 'start', 'end', 'error', '_instrumentation')
+
+    def __init__(self, instrumentation, name: str, attributes: dict):
+        self._instrumentation = instrumentation
+        self.name = name
+        self.attributes = attributes
+        self.span_id = None
+        self.parent_id = None
+        self.start = None
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def set(self, **attributes):
+        """
+        Adds attributes known once the operation ran, e.g. query_id and rows
+        """
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._instrumentation._enter(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.error = f'{exc_type.__name__}: {exc}'
+            if getattr(exc, 'sfqid', None):
+                self.attributes.setdefault('query_id', exc.sfqid)
+        self._instrumentation._exit(self)
+        return False
+
+
+class _NoopSpan:
+    """
+    Returned by a disabled Instrumentation, shared and stateless
+    """
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class JsonLinesSink:
+    """
+    Writes every span as a line of JSON
+    """
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._file = open(path, 'a')
+
+    def emit(self, span):
+        self._file.write(json.dumps({'name': span.name, 'start': span.start, 'duration': span.duration,
+                                     'span_id': span.span_id, 'parent_id': span.parent_id, 'error': span.error,
+                                     **span.attributes}, default=str) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class PrometheusTextfileSink:
+    """
+    Aggregates span durations by name and writes them in the Prometheus text format when closed, for the node
+    exporter textfile collector
+    """
+    def __init__(self, path, prefix: str = 'release_tool'):
+        self.path = path
+        self.prefix = prefix
+        self.count = {}
+        self.seconds = {}
+        self.errors = {}
+
+    def emit(self, span):
+        self.count[span.name] = self.count.get(span.name, 0) + 1
+        self.seconds[span.name] = self.seconds.get(span.name, 0.0) + span.duration
+        if span.error is not None:
+            self.errors[span.name] = self.errors.get(span.name, 0) + 1
+
+    def close(self):
+        lines = [f'# HELP {self.prefix}_span_seconds Wall time of release operations',
+                 f'# TYPE {self.prefix}_span_seconds summary']
+        for name in sorted(self.count):
+            lines.append(f'{self.prefix}_span_seconds_sum{{operation="{name}"}} {self.seconds[name]:.6f}')
+            lines.append(f'{self.prefix}_span_seconds_count{{operation="{name}"}} {self.count[name]}')
+        lines.append(f'# TYPE {self.prefix}_span_errors_total counter')
+        for name in sorted(self.count):
+            lines.append(f'{self.prefix}_span_errors_total{{operation="{name}"}} {self.errors.get(name, 0)}')
+        # the collector may read the file at any time, it is replaced atomically
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.path)
+
+
+class OpenTelemetrySpanSink:
+    """
+    Writes spans in the OpenTelemetry JSON span format (one trace per release), readable by OTLP file receivers
+    """
+    def __init__(self, path, service_name: str = 'release_tool'):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.service_name = service_name
+        self.trace_id = os.urandom(16).hex()
+        self._file = open(path, 'a')
+
+    def emit(self, span):
+        attributes = [{'key': key, 'value': {'stringValue': str(value)}} for key, value in span.attributes.items()
+                      if value is not None]
+        record = {'traceId': self.trace_id,
+                  'spanId': f'{span.span_id:016x}',
+                  'parentSpanId': f'{span.parent_id:016x}' if span.parent_id is not None else '',
+                  'name': span.name,
+                  'startTimeUnixNano': int(span.start * 1e9),
+                  'endTimeUnixNano': int(span.end * 1e9),
+                  'attributes': attributes,
+                  'status': {'code': 'STATUS_CODE_ERROR', 'message': span.error} if span.error
+                  else {'code': 'STATUS_CODE_OK'}}
+        self._file.write(json.dumps({'resource': {'service.name': self.service_name}, 'span': record}) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+SINKS = {'jsonl': (JsonLinesSink, 'spans.jsonl'),
+         'prometheus': (PrometheusTextfileSink, 'release_tool.prom'),
+         'otel': (OpenTelemetrySpanSink, 'otel_spans.jsonl')}
+
+
+class Instrumentation:
+    """
+    Records the wall time of release operations as spans and passes them to sinks. Disabled by default, span()
+    then returns a shared no-op span so instrumented code pays one attribute lookup.
+    Changeset spans are kept to summarise the slowest changesets at the end of the run.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.top_n = 10
+        self._changesets = []
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool = False, sinks=(), directory: str = '.release_metrics', top_n: int = 10):
+        """
+        Enables or disables instrumentation, replacing the sinks
+        :param enabled: record spans
+        :param sinks: sink names (jsonl, prometheus, otel) or objects with emit(span) and close()
+        :param directory: directory of the files written by named sinks
+        :param top_n: number of changesets in the summary
+        """
+        self.reset()
+        self.enabled = bool(enabled)
+        self.top_n = int(top_n)
+        if not self.enabled:
+            return
+        for sink in sinks or ():
+            if isinstance(sink, str):
+                sink_class, file_name = SINKS[sink]
+                sink = sink_class(str(Path(directory, file_name)))
+            self.sinks.append(sink)
+        logger.debug(f'Instrumentation enabled, sinks: {", ".join(type(sink).__name__ for sink in self.sinks)}')
+
+    def configure_from_properties(self, properties: dict):
+        """
+        Configures instrumentation from the instrumentation section of the properties file
+        :param properties: Dictionary of the properties yaml file
+        """
+        section = properties.get('instrumentation') or {}
+        self.configure(enabled=section.get('enabled', False),
+                       sinks=section.get('sinks') or (),
+                       directory=section.get('directory') or '.release_metrics',
+                       top_n=section.get('top_n') or 10)
+
+    def span(self, name: str, **attributes):
+        """
+        Times an operation, use as a context manager
+        :param name: operation name
+        :param attributes: e.g. changeset, template, query_id, rows
+        :return: Span, or a no-op span when disabled
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, attributes)
+
+    def record(self, name: str, start: float, end: float, error: str = None, **attributes):
+        """
+        Records an operation timed elsewhere, e.g. asynchronous queries
+        :param name: operation name
+        :param start: start time, time.time()
+        :param end: end time, time.time()
+        :param error: error message if the operation failed
+        :param attributes: span attributes
+        """
+        if not self.enabled:
+            return
+        span = Span(self, name, attributes)
+        span.span_id = next(self._ids)
+        span.parent_id = self._parent_id()
+        span.start, span.end, span.error = start, end, error
+        self._emit(span)
+
+    def _parent_id(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1].span_id if stack else None
+
+    def _enter(self, span):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        span.span_id = next(self._ids)
+        span.parent_id = stack[-1].span_id if stack else None
+        stack.append(span)
+        span.start = time.time()
+
+    def _exit(self, span):
+        span.end = time.time()
+        self._local.stack.pop()
+        self._emit(span)
+
+    def _emit(self, span):
+        with self._lock:
+            if span.name == 'changeset':
+                self._changesets.append(span)
+            for sink in self.sinks:
+                try:
+                    sink.emit(span)
+                except Exception as e:
+                    logger.warning(f'Instrumentation sink {type(sink).__name__} failed: {e}')
+
+    def slowest_changesets(self, n: int = None):
+        """
+        :param n: number of changesets, top_n if None
+        :return: changeset spans, slowest first
+        """
+        with self._lock:
+            return heapq.nlargest(n or self.top_n, self._changesets, key=lambda span: span.duration)
+
+    def summary(self, n: int = None):
+        """
+        Table of the slowest changesets of the run
+        :param n: number of changesets, top_n if None
+        :return: text table
+        """
+        spans = self.slowest_changesets(n)
+        if not spans:
+            return 'No changesets recorded'
+        lines = [f'{"#":>3}  {"seconds":>8}  {"statements":>10}  {"status":<7}  {"database":<20}  changeset']
+        for rank, span in enumerate(spans, 1):
+            attributes = span.attributes
+            status = 'failed' if span.error or attributes.get('status') == 'failed' else 'ok'
+            statements = attributes.get('statements')
+            lines.append(f'{rank:>3}  {span.duration:>8.3f}  {"" if statements is None else statements:>10}  '
+                         f'{status:<7}  '
+                         f'{attributes.get("database") or "":<20}  {attributes.get("changeset")}')
+        return '\n'.join(lines)
+
+    def close(self):
+        """
+        Closes the sinks, writing aggregated sinks such as the Prometheus textfile, and disables instrumentation.
+        The changesets recorded are kept for summary() until reset.
+        """
+        self.enabled = False
+        sinks, self.sinks = self.sinks, []
+        for sink in sinks:
+            sink.close()
+
+    def reset(self):
+        """
+        Closes the sinks and forgets the changesets recorded, the next release starts from a clean state
+        """
+        self.close()
+        with self._lock:
+            self._changesets = []
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+
+
+instrumentation = Instrumentation()
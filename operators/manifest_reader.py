@@ -1,34 +1,319 @@
 import xml.etree.ElementTree as ET
 from pathlib import Path
+import hashlib
+import io
 import logging
+import os
+
+from operators.changeset_parser import parse_attributes, parse_header
 
 logger = logging.getLogger(__name__)
 
+# bytes hashed per read when a change file checksum is computed without loading the body
+CHUNK_SIZE = 1024 * 1024
 
-def _parse_xml(xmlfile):
-    # create element tree object
+# formats of bulk load changesets, see LoadFile
+LOAD_FORMATS = ('csv', 'parquet')
+# include attributes of a bulk load changeset that are not file format options
+LOAD_ATTRIBUTES = ('file', 'type', 'table', 'format', 'stage', 'author', 'id', 'context', 'labels', 'comment',
+                   'depends')
+
+
+def _iter_xml(xmlfile):
+    """
+    Streams the include elements directly under the manifest root, the file location of a plain include and a
+    dictionary of the attributes of an include with other attributes, e.g. a bulk load changeset
+    """
     logger.debug(str(xmlfile))
-    tree = ET.parse(Path(xmlfile))
+    depth = 0
+    root = None
+    for event, item in ET.iterparse(str(Path(xmlfile)), events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = item
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if item.tag == 'include':
+                yield item.attrib['file'] if len(item.attrib) == 1 else dict(item.attrib)
+            # elements are not needed once handled and are dropped from the root, keeps memory flat for large
+            # manifests
+            root.clear()
+
+
+def _parse_xml(xmlfile):
+    return list(_iter_xml(xmlfile))
+
+
+def iter_manifest(xml_file, content_cache=None):
+    """
+    Streams the files included by a manifest, an unchanged manifest is not re-parsed when a content cache is given
+    :param xml_file: manifest file
+    :param content_cache: ContentCache holding the includes of previously parsed manifests
+    :return: generator of includes in manifest order, file locations or attribute dictionaries (see _iter_xml)
+    """
+    if content_cache is not None:
+        cached = content_cache.lookup(xml_file)
+        if cached is not None and 'includes' in cached:
+            yield from cached['includes']
+            return
+
+    files = []
+    for file_loc in _iter_xml(xml_file):
+        files.append(file_loc)
+        yield file_loc
+    if content_cache is not None:
+        content_cache.update(xml_file, includes=files)
+
+
+def read_manifest(xml_file, content_cache=None):
+    """
+    Returns the files included by a manifest, an unchanged manifest is not re-parsed when a content cache is given
+    :param xml_file: manifest file
+    :param content_cache: ContentCache holding the includes of previously parsed manifests
+    :return: list of includes in manifest order, file locations or attribute dictionaries (see _iter_xml)
+    """
+    return list(iter_manifest(xml_file, content_cache=content_cache))
+
+
+def include_location(include):
+    """
+    :param include: include from iter_manifest
+    :return: file location of the include
+    """
+    return include if isinstance(include, str) else include['file']
+
+
+class ChangeFile:
+    """
+    A SQL change file listed in a manifest. The leading comment header is read on first use and the SQL body is
+    only read when it is executed, continuing from where the header ended. A body read with read_sql is hashed as
+    it is read, so the file is read once; a streamed body (compute_checksum, then open_sql) is read twice, once
+    in chunks for the checksum that is recorded before it runs and once as it is executed.
+    """
+    kind = 'sql'
+    __slots__ = ('file', 'path', 'checksum', '_header_lines', '_changeset', '_body_offset', '_hash')
+
+    def __init__(self, file: str, path: Path, checksum: str = None):
+        self.file = file
+        self.path = path
+        self.checksum = checksum
+        self._header_lines = None
+        self._changeset = None
+        self._body_offset = None
+        self._hash = None
 
-    root = tree.getroot()
-    change_items = []
+    def __repr__(self):
+        return f'ChangeFile({self.file})'
 
-    for item in root.findall('./include'):
-        change_items.append(item.attrib['file'])
-    return change_items
+    @property
+    def header_lines(self):
+        """
+        Leading blank and comment lines of the file, holding the changeset metadata
+        """
+        if self._header_lines is None:
+            self._read_header()
+        return self._header_lines
 
+    @property
+    def changeset(self):
+        """
+        Changeset metadata parsed from the header
+        :return: changeset_parser.ChangeSet
+        """
+        if self._changeset is None:
+            self._changeset = parse_header(self.header_lines)
+        return self._changeset
 
-def read_xml_files(xml_file, source_file_directory):
+    def _read_header(self):
+        lines = []
+        file_hash = hashlib.blake2b(digest_size=16)
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for raw in f:
+                # the byte order mark of the first line is hashed and skipped with the header, never parsed
+                line = raw.decode('utf-8-sig' if offset == 0 else 'utf-8')
+                stripped = line.strip()
+                if stripped and not stripped.startswith('--'):
+                    break
+                lines.append(line)
+                file_hash.update(raw)
+                offset += len(raw)
+        self._header_lines = lines
+        self._body_offset = offset
+        self._hash = file_hash
+
+    def compute_checksum(self):
+        """
+        Completes the file checksum by hashing the body in chunks, without keeping the body in memory
+        :return: checksum, the same value content_cache.content_checksum returns for the whole file
+        """
+        if self.checksum is None:
+            if self._hash is None:
+                self._read_header()
+            file_hash = self._hash.copy()
+            with open(self.path, 'rb') as f:
+                f.seek(self._body_offset)
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    file_hash.update(chunk)
+            self.checksum = file_hash.hexdigest()
+        return self.checksum
+
+    @property
+    def size(self):
+        """
+        File size in bytes
+        """
+        return os.path.getsize(self.path)
+
+    def open_sql(self):
+        """
+        Opens the SQL body of the file for streaming, everything after the comment header. Lines are read in
+        buffered chunks and returned exactly as read_sql returns them.
+        :return: text stream, to be closed by the caller
+        """
+        if self._body_offset is None:
+            self._read_header()
+        f = open(self.path, 'rb')
+        f.seek(self._body_offset)
+        return io.TextIOWrapper(f, encoding='utf-8', newline='\n')
+
+    def read_sql(self):
+        """
+        Reads the SQL body of the file, everything after the comment header
+        :return: SQL text
+        """
+        if self._body_offset is None:
+            self._read_header()
+        with open(self.path, 'rb') as f:
+            f.seek(self._body_offset)
+            body = f.read()
+        if self.checksum is None:
+            file_hash = self._hash.copy()
+            file_hash.update(body)
+            self.checksum = file_hash.hexdigest()
+        return body.decode('utf-8')
+
+
+class LoadFile:
     """
-    Takes an xml file and returns a dictionary of the content
-    :param xml_file:
-    :param source_file_directory:
-    :return:
+    A bulk load changeset listed in a manifest, declared by the include attributes instead of a SQL header:
+
+        <include file="seed/countries.csv" type="load" table="REF.COUNTRIES" id="seed-countries" author="jdoe"
+                 skip_header="1" field_optionally_enclosed_by='"'/>
+
+    The file is a CSV or Parquet data file, or a directory of them, loaded with PUT and COPY INTO (see
+    operators.bulk_load). Attributes other than the changeset metadata, table, format and stage are file format
+    options of the COPY.
     """
-    files = _parse_xml(Path(xml_file))
-    files_for_release = {}
-    for i, file_loc in enumerate(files):
-        change_file = Path(source_file_directory, file_loc)
-        sql = open(change_file, 'r')
-        files_for_release[file_loc] = sql.read()
-    return files_for_release
+    kind = 'load'
+    __slots__ = ('file', 'path', 'attributes', 'table', 'format', 'stage', 'options', 'checksum', '_changeset')
+
+    def __init__(self, file: str, path: Path, attributes: dict, checksum: str = None):
+        """
+        :param file: file location from the manifest
+        :param path: data file or directory
+        :param attributes: include attributes
+        :param checksum: checksum of the data files, computed on first use if None
+        """
+        self.file = file
+        self.path = path
+        self.attributes = dict(attributes)
+        self.table = attributes.get('table')
+        self.format = (attributes.get('format') or Path(file).suffix.lstrip('.') or 'csv').lower()
+        self.stage = attributes.get('stage')
+        self.options = {name.lower(): value for name, value in attributes.items() if name not in LOAD_ATTRIBUTES}
+        self.checksum = checksum
+        self._changeset = parse_attributes(attributes)
+
+    def __repr__(self):
+        return f'LoadFile({self.file})'
+
+    @property
+    def changeset(self):
+        """
+        Changeset metadata from the include attributes
+        :return: changeset_parser.ChangeSet
+        """
+        return self._changeset
+
+    def data_files(self):
+        """
+        :return: the data files to load, the files of the format in a directory in name order
+        """
+        if self.path.is_dir():
+            return sorted(path for path in self.path.iterdir()
+                          if path.is_file() and path.suffix.lower() == f'.{self.format}')
+        return [self.path]
+
+    def compute_checksum(self):
+        """
+        Hashes the names and content of the data files in chunks
+        :return: checksum
+        """
+        if self.checksum is None:
+            file_hash = hashlib.blake2b(digest_size=16)
+            for path in self.data_files():
+                file_hash.update(path.name.encode('utf-8') + b'\0')
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        file_hash.update(chunk)
+            self.checksum = file_hash.hexdigest()
+        return self.checksum
+
+    @property
+    def size(self):
+        """
+        Size of the data files in bytes
+        """
+        return sum(os.path.getsize(path) for path in self.data_files())
+
+
+def make_change_file(include, source_file_directory):
+    """
+    :param include: include from iter_manifest
+    :param source_file_directory: directory the included file locations are relative to
+    :return: LoadFile for an include of type load, ChangeFile otherwise
+    """
+    file_loc = include_location(include)
+    path = Path(source_file_directory, file_loc)
+    if not isinstance(include, str) and include.get('type', 'sql').lower() == 'load':
+        return LoadFile(file=file_loc, path=path, attributes=include)
+    return ChangeFile(file=file_loc, path=path)
+
+
+def iter_change_files(xml_file, source_file_directory, content_cache=None):
+    """
+    Streams the change files of a manifest one at a time, nothing is read from the SQL files until the header
+    or body of a ChangeFile is used
+    :param xml_file: manifest file
+    :param source_file_directory: directory the included file locations are relative to
+    :param content_cache: ContentCache holding the includes of previously parsed manifests
+    :return: generator of ChangeFile and LoadFile
+    """
+    for include in iter_manifest(xml_file, content_cache=content_cache):
+        yield make_change_file(include, source_file_directory)
+
+
+def read_release(master_xml_file, change_log_directory, source_file_directory, content_cache=None):
+    """
+    Reads a whole release once: the change logs of the master manifest and the changeset headers of their SQL
+    files. SQL bodies are still only read when they are released.
+    :param master_xml_file: master manifest
+    :param change_log_directory: directory the change logs are relative to
+    :param source_file_directory: directory the SQL files are relative to
+    :param content_cache: ContentCache holding the includes of previously parsed manifests
+    :return: dict of change log to tuple of ChangeFile and LoadFile, in manifest order
+    """
+    release = {}
+    for change_log in iter_manifest(master_xml_file, content_cache=content_cache):
+        change_files = tuple(iter_change_files(xml_file=Path(change_log_directory, change_log),
+                                               source_file_directory=source_file_directory,
+                                               content_cache=content_cache))
+        for change_file in change_files:
+            # parsed here once, the parsed ChangeSet is kept on the ChangeFile
+            change_file.changeset
+        release[change_log] = change_files
+    return release
+
@@ -1,4 +1,3 @@
-import yaml
 import logging
 
 logger = logging.getLogger(__name__)
@@ -10,8 +9,11 @@ def get_properties(properties_file_path):
     :param properties_file_path: location of properties.yaml
     :return: Dictionary of properties
     """
+    import yaml
+
     logger.info(f'reading property file: {properties_file_path}')
     with open(properties_file_path) as properties:
-        property_details = yaml.load(properties, loader=yaml.FullLoader)
+        # the libyaml loader when PyYAML was built with it, several times faster than the pure Python one
+        property_details = yaml.load(properties, Loader=getattr(yaml, 'CFullLoader', yaml.FullLoader))
         logger.debug(f'Properties found in file: {property_details}')
         return property_details
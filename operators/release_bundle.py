@@ -0,0 +1,289 @@
+from functools import lru_cache
+from pathlib import Path
+import datetime
+import io
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+from operators import manifest_reader as filereader
+from operators.changeset_parser import ChangeSet
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_MAGIC = b'RTBUNDLE'
+BUNDLE_VERSION = 1
+# magic, version, length of the index
+BUNDLE_HEADER = struct.Struct('>8sIQ')
+# bytes copied per read when SQL bodies are written to a bundle
+COPY_SIZE = 1024 * 1024
+# release settings stored in a bundle. Connection settings (user, password, private_key, account, role,
+# authenticator, tokens) are never bundled, they come from the properties file of the release run
+BUNDLED_PROPERTIES = ('root_sql_directory', 'change_log_directory', 'master_change_log_name', 'history_schema',
+                      'history_table', 'parallel_workers', 'history_batch_size', 'history_cache_directory',
+                      'history_watermark_column', 'history_cache_overlap_hours', 'history_fetch_size',
+                      'content_cache_file', 'checksum_mismatch', 'release_journal_directory', 'execution_mode',
+                      'async_max_in_flight', 'streaming_threshold_mb', 'bulk_load', 'clone_release', 'retry',
+                      'instrumentation', 'fan_out', 'history_flush_seconds')
+
+
+class _BodyReader(io.RawIOBase):
+    """
+    Reads one SQL body of a bundle on its own file handle, for statements streamed from large bodies
+    """
+    def __init__(self, bundle_file, offset: int, length: int):
+        self._file = open(bundle_file, 'rb')
+        self._file.seek(offset)
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._remaining <= 0:
+            return 0
+        data = self._file.read(min(len(buffer), self._remaining))
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class BundledChangeFile:
+    """
+    A SQL change file read from a release bundle, with the same interface as manifest_reader.ChangeFile. The
+    changeset header and checksum were parsed when the bundle was built, the SQL body is read from the bundle when
+    the change is released.
+    """
+    kind = 'sql'
+    __slots__ = ('file', 'path', 'checksum', 'changeset', '_bundle', '_offset', '_length')
+
+    def __init__(self, bundle, file: str, changeset: ChangeSet, checksum: str, offset: int, length: int):
+        self.file = file
+        # not read, the content cache is not used for bundled files
+        self.path = None
+        self.changeset = changeset
+        self.checksum = checksum
+        self._bundle = bundle
+        self._offset = offset
+        self._length = length
+
+    def __repr__(self):
+        return f'BundledChangeFile({self.file})'
+
+    def compute_checksum(self):
+        """
+        :return: checksum of the source file, computed when the bundle was built
+        """
+        return self.checksum
+
+    @property
+    def size(self):
+        """
+        Size of the SQL body in bytes
+        """
+        return self._length
+
+    def open_sql(self):
+        """
+        Opens the SQL body for streaming
+        :return: text stream, to be closed by the caller
+        """
+        reader = io.BufferedReader(_BodyReader(self._bundle.bundle_file, self._bundle.body_offset + self._offset,
+                                               self._length))
+        return io.TextIOWrapper(reader, encoding='utf-8', newline='\n')
+
+    def read_sql(self):
+        """
+        :return: SQL text of the body
+        """
+        return self._bundle.read_body(self._offset, self._length).decode('utf-8')
+
+
+def _changeset_to_json(changeset: ChangeSet):
+    return changeset._asdict()
+
+
+def _changeset_from_json(fields: dict):
+    fields = dict(fields)
+    fields['labels'] = tuple(fields.get('labels') or ())
+    if fields.get('depends') is not None:
+        fields['depends'] = tuple(fields['depends'])
+    fields['attributes'] = tuple(tuple(attribute) for attribute in fields.get('attributes') or ())
+    return ChangeSet(**fields)
+
+
+def bundled_properties(properties: dict):
+    """
+    :param properties: Dictionary of the properties yaml file
+    :return: the release settings of the properties, see BUNDLED_PROPERTIES
+    """
+    return {name: value for name, value in properties.items() if name in BUNDLED_PROPERTIES}
+
+
+def _read_manifests(properties, content_cache):
+    return filereader.read_release(
+        master_xml_file=Path(properties.get('change_log_directory'), properties.get('master_change_log_name')),
+        change_log_directory=properties.get('change_log_directory'),
+        source_file_directory=properties.get('root_sql_directory'),
+        content_cache=content_cache)
+
+
+def write_bundle(properties: dict, bundle_file, content_cache=None):
+    """
+    Compiles a release into one file: the change logs of the master manifest, the parsed changeset headers and
+    checksums of their files and the release settings of the properties (see BUNDLED_PROPERTIES) in a JSON index,
+    followed by the SQL bodies. Data files of bulk load changesets are not bundled, they are read from
+    root_sql_directory when loaded. The bundle is written to a temporary file and renamed, a failed build never
+    leaves a partial bundle.
+    :param properties: Dictionary of the properties yaml file
+    :param bundle_file: bundle to write
+    :param content_cache: ContentCache holding the includes of previously parsed manifests
+    :return: number of changesets bundled
+    """
+    bundle_file = Path(bundle_file)
+    release = _read_manifests(properties, content_cache)
+
+    bundle_file.parent.mkdir(parents=True, exist_ok=True)
+    change_logs = []
+    changes = 0
+    with tempfile.TemporaryFile(dir=bundle_file.parent) as bodies:
+        for change_log, change_files in release.items():
+            entries = []
+            for change_file in change_files:
+                if change_file.kind == 'load':
+                    entries.append({'kind': 'load', 'file': change_file.file, 'attributes': change_file.attributes})
+                    continue
+                offset = bodies.tell()
+                with change_file.open_sql() as sql:
+                    shutil.copyfileobj(sql.buffer, bodies, COPY_SIZE)
+                entries.append({'kind': 'sql', 'file': change_file.file,
+                                'changeset': _changeset_to_json(change_file.changeset),
+                                'checksum': change_file.compute_checksum(),
+                                'offset': offset, 'length': bodies.tell() - offset})
+            changes += len(entries)
+            change_logs.append({'name': change_log, 'changes': entries})
+
+        index = json.dumps({'version': BUNDLE_VERSION,
+                            'created': datetime.datetime.now().isoformat(),
+                            'properties': bundled_properties(properties),
+                            'change_logs': change_logs}, default=str).encode('utf-8')
+        tmp_file = bundle_file.with_name(bundle_file.name + '.tmp')
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(index)))
+                f.write(index)
+                bodies.seek(0)
+                shutil.copyfileobj(bodies, f, COPY_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, bundle_file)
+        except BaseException:
+            tmp_file.unlink(missing_ok=True)
+            raise
+    logger.info(f'Bundled {changes} changesets of {len(change_logs)} change logs into {bundle_file}, '
+                f'{bundle_file.stat().st_size / 1024 / 1024:.1f}MB')
+    return changes
+
+
+class ReleaseBundle:
+    """
+    A release compiled by write_bundle. Only the index is read when the bundle is opened, SQL bodies are read from
+    the one open file when their changes are released, the file stays open while its change files are in use.
+    """
+    def __init__(self, bundle_file):
+        """
+        :param bundle_file: bundle written by write_bundle
+        """
+        self.bundle_file = Path(bundle_file)
+        self._file = open(self.bundle_file, 'rb')
+        self._lock = threading.Lock()
+        try:
+            header = self._file.read(BUNDLE_HEADER.size)
+            magic, version, index_length = BUNDLE_HEADER.unpack(header) if len(header) == BUNDLE_HEADER.size \
+                else (None, None, None)
+            if magic != BUNDLE_MAGIC:
+                raise ValueError(f'{self.bundle_file} is not a release bundle')
+            if version != BUNDLE_VERSION:
+                raise ValueError(f'{self.bundle_file} is a version {version} release bundle, version '
+                                 f'{BUNDLE_VERSION} is supported, rebuild it with the bundle command')
+            self._index = json.loads(self._file.read(index_length))
+        except ValueError:
+            self._file.close()
+            raise
+        self.body_offset = BUNDLE_HEADER.size + index_length
+        logger.info(f'Opened release bundle {self.bundle_file} built {self._index.get("created")}')
+
+    @property
+    def properties(self):
+        """
+        Release settings the bundle was built with, without connection settings
+        """
+        # bundles built before BUNDLED_PROPERTIES may hold credentials, they are not read back
+        return bundled_properties(self._index.get('properties') or {})
+
+    def read_body(self, offset: int, length: int):
+        """
+        :param offset: offset of the body in the body section
+        :param length: length of the body
+        :return: body bytes
+        """
+        with self._lock:
+            self._file.seek(self.body_offset + offset)
+            return self._file.read(length)
+
+    def read_release(self, source_file_directory=None):
+        """
+        The release in the form of manifest_reader.read_release
+        :param source_file_directory: directory the data files of bulk loads are relative to, root_sql_directory of
+                                      the bundled properties if None
+        :return: dict of change log to tuple of BundledChangeFile and LoadFile, in manifest order
+        """
+        if source_file_directory is None:
+            source_file_directory = self.properties.get('root_sql_directory')
+        release = {}
+        for change_log in self._index['change_logs']:
+            change_files = []
+            for entry in change_log['changes']:
+                if entry['kind'] == 'load':
+                    change_files.append(filereader.make_change_file(entry['attributes'], source_file_directory))
+                else:
+                    change_files.append(BundledChangeFile(self, file=entry['file'],
+                                                          changeset=_changeset_from_json(entry['changeset']),
+                                                          checksum=entry['checksum'], offset=entry['offset'],
+                                                          length=entry['length']))
+            release[change_log['name']] = tuple(change_files)
+        return release
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+@lru_cache(maxsize=None)
+def open_bundle(bundle_file: str):
+    """
+    Opens a bundle once per process, its properties and its release are read from the same open file
+    :param bundle_file: bundle written by write_bundle
+    :return: ReleaseBundle
+    """
+    return ReleaseBundle(bundle_file)
+
+
+def read_release(properties: dict, content_cache=None):
+    """
+    Reads the release from the bundle set as release_bundle in the properties, or from the manifests
+    :param properties: Dictionary of the properties yaml file
+    :param content_cache: ContentCache holding the includes of previously parsed manifests
+    :return: dict of change log to tuple of change files, see manifest_reader.read_release
+    """
+    if properties.get('release_bundle'):
+        return open_bundle(str(properties['release_bundle'])).read_release(properties.get('root_sql_directory'))
+    return _read_manifests(properties, content_cache)
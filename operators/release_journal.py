@@ -0,0 +1,223 @@
+from pathlib import Path
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+
+from operators.content_cache import content_checksum
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+
+# statements that set up the session, replayed when a changeset is resumed after them
+SESSION_STATEMENT = re.compile(r'^\s*(USE\s|ALTER\s+SESSION\s)', re.IGNORECASE)
+TRANSACTION_START = re.compile(r'^\s*(BEGIN|START\s+TRANSACTION)\b', re.IGNORECASE)
+TRANSACTION_END = re.compile(r'^\s*(COMMIT|ROLLBACK)\b', re.IGNORECASE)
+
+
+def _fsync_directory(directory):
+    # makes a created or replaced journal file survive a crash, not supported on Windows
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class ReleaseJournal:
+    """
+    Append only local journal of the statements released to a database. A record is written and fsync'd after
+    each statement succeeds, with the hash of the statement, so a rerun after a failure or a crash resumes a
+    multi-statement changeset at the statement that did not complete instead of repeating the whole file.
+    Records of changesets recorded as released in the history table are dropped when the journal is compacted.
+    """
+    def __init__(self, journal_directory, database: str):
+        """
+        :param journal_directory: directory holding the journal files
+        :param database: database released to, one journal per database
+        """
+        self.database = database
+        self.journal_file = Path(journal_directory, f'{database.lower()}.journal.jsonl')
+        # statement hashes by changeset id, in statement order
+        self._statements = {}
+        self._released = set()
+        self._lock = threading.Lock()
+        self._file = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.journal_file, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        valid = content.rfind(b'\n') + 1
+        if valid < len(content):
+            # the process stopped while writing the last record
+            logger.info(f'Discarding a partly written record at the end of {self.journal_file}')
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(valid)
+        for line in content[:valid].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.info(f'Ignoring an invalid record in {self.journal_file}: {line[:80]!r}')
+                continue
+            if record.get('version') == JOURNAL_VERSION:
+                self._apply(record)
+
+    def _apply(self, record):
+        changeset = record.get('changeset')
+        if record.get('event') == 'statement':
+            hashes = self._statements.setdefault(changeset, [])
+            # a statement re-executed after an edit replaces it and every statement after it
+            del hashes[record['position'] - 1:]
+            hashes.append(record['hash'])
+            self._released.discard(changeset)
+        elif record.get('event') == 'released':
+            self._released.add(changeset)
+
+    def _append(self, **record):
+        record['version'] = JOURNAL_VERSION
+        record['at'] = datetime.datetime.now().isoformat()
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if self._file is None:
+                self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+                created = not self.journal_file.exists()
+                self._file = open(self.journal_file, 'a')
+                if created:
+                    _fsync_directory(self.journal_file.parent)
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._apply(record)
+
+    def __len__(self):
+        return len(self._statements)
+
+    def resume(self, changeset: str, statements):
+        """
+        Finds where a changeset resumes. Statements are compared by hash, so an edit of the failed statement (or
+        of any later one) keeps the statements before it released. A changeset never resumes inside an explicit
+        transaction that did not commit, its statements were rolled back. Statements are consumed one at a time,
+        so a stream of statements from a large file is not read into memory.
+        :param changeset: changeset id
+        :param statements: statements of the changeset in order, a list or an iterator
+        :return: (index of the first statement to execute, session statements before it to replay,
+                  iterator of the statements to execute)
+        """
+        with self._lock:
+            hashes = list(self._statements.get(changeset, ()))
+        statements = iter(statements)
+        position = 0
+        session_statements = []
+        # statements of a transaction that did not commit, executed again
+        transaction = None
+        mismatched = []
+        for journaled in hashes:
+            statement = next(statements, None)
+            if statement is None:
+                break
+            if journaled != content_checksum(statement):
+                mismatched.append(statement)
+                break
+            if TRANSACTION_START.match(statement):
+                transaction = []
+            elif TRANSACTION_END.match(statement):
+                transaction = None
+            if transaction is not None:
+                transaction.append(statement)
+            if SESSION_STATEMENT.match(statement):
+                session_statements.append((position, statement))
+            position += 1
+        if transaction:
+            position -= len(transaction)
+        session_statements = [statement for index, statement in session_statements if index < position]
+        return position, session_statements, itertools.chain(transaction or (), mismatched, statements)
+
+    def statement(self, changeset: str, position: int, statement: str, query_id: str = None):
+        """
+        Records a statement that completed
+        :param changeset: changeset id
+        :param position: 1-based position of the statement in the changeset
+        :param statement: statement text, only its hash is recorded
+        :param query_id: Snowflake query id
+        """
+        self._append(event='statement', changeset=changeset, position=position, hash=content_checksum(statement),
+                     query_id=query_id)
+
+    def released(self, changeset: str):
+        """
+        Records that every statement of a changeset completed
+        """
+        if changeset in self._statements:
+            self._append(event='released', changeset=changeset)
+
+    def reconcile(self, change_history):
+        """
+        Drops the records of changesets the history table records as released, e.g. by a release from another
+        machine, and reports the changesets that will be resumed
+        :param change_history: ChangeHistory of the database
+        """
+        with self._lock:
+            self._drop([changeset for changeset in self._statements if change_history.is_released(changeset)])
+            resumable = {changeset: len(hashes) for changeset, hashes in self._statements.items()
+                         if changeset not in self._released}
+        for changeset, statements in resumable.items():
+            logger.info(f'Release journal of {self.database}: {statements} statements of {changeset} were already '
+                        f'released, resuming after them')
+
+    def compact(self):
+        """
+        Rewrites the journal without the changesets that completed, the file is removed when nothing is left.
+        Called when the release finished and the history table records are written.
+        """
+        with self._lock:
+            self._drop([changeset for changeset in self._statements if changeset in self._released])
+
+    def _drop(self, changesets):
+        if not changesets:
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for changeset in changesets:
+            del self._statements[changeset]
+            self._released.discard(changeset)
+        if not self._statements:
+            try:
+                self.journal_file.unlink()
+            except FileNotFoundError:
+                pass
+            return
+
+        tmp_file = self.journal_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            for changeset, hashes in self._statements.items():
+                for position, statement_hash in enumerate(hashes, start=1):
+                    f.write(json.dumps({'event': 'statement', 'changeset': changeset, 'position': position,
+                                        'hash': statement_hash, 'version': JOURNAL_VERSION}) + '\n')
+                if changeset in self._released:
+                    f.write(json.dumps({'event': 'released', 'changeset': changeset,
+                                        'version': JOURNAL_VERSION}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.journal_file)
+        _fsync_directory(self.journal_file.parent)
+        logger.debug(f'Release journal of {self.database} compacted, {len(changesets)} changesets dropped')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,370 @@
+from contextlib import contextmanager
+import logging
+import random
+import re
+import threading
+import time
+
+from operators.instrumentation import instrumentation
+from operators.release_journal import TRANSACTION_END, TRANSACTION_START
+from snowflake.connector.errors import DatabaseError, ProgrammingError
+
+logger = logging.getLogger(__name__)
+
+# classes of transient errors, a statement failing with one can succeed when it runs again
+LOCK = 'lock'
+OVERLOAD = 'overload'
+INTERNAL = 'internal'
+# the statement may have run before the session or the response was lost
+SESSION = 'session'
+ERROR_CLASSES = (LOCK, OVERLOAD, INTERNAL, SESSION)
+
+# Snowflake error codes of transient conditions
+TRANSIENT_ERRNOS = {
+    625: LOCK,  # statement waited too long for a lock held by another transaction
+    630: OVERLOAD,  # queued timeout, the warehouse is overloaded (see TRANSIENT_MESSAGES)
+    603: INTERNAL,  # SQL execution internal error
+    300010: INTERNAL,  # internal error, an incident was raised
+    390111: SESSION,  # session no longer exists
+    390112: SESSION,  # session token expired
+    390114: SESSION,  # authentication token expired
+    250001: SESSION,  # could not connect to Snowflake
+    250003: SESSION,  # failed to get the response, the request timed out
+}
+TRANSIENT_SQLSTATES = {
+    '08001': SESSION,  # unable to connect
+    '08003': SESSION,  # connection does not exist
+    '08006': SESSION,  # connection failure
+    '40001': LOCK,  # transaction aborted by a deadlock
+}
+# error codes also raised for errors that fail again, only transient when their message matches. 630 is a statement
+# canceled while queued, or one that ran out its statement timeout and would run as long again
+TRANSIENT_MESSAGES = {
+    630: re.compile(r'\bqueue', re.IGNORECASE),
+}
+# statements that can run twice with the result of running them once, retried after a SESSION error
+IDEMPOTENT_STATEMENT = re.compile(r'^\s*(SELECT|WITH|SHOW|DESC(RIBE)?|LIST|USE|ALTER\s+SESSION|GRANT|REVOKE|PUT|'
+                                  r'COPY\s+INTO|CREATE\s+OR\s+REPLACE|CREATE\s+(\w+\s+){1,3}IF\s+NOT\s+EXISTS|'
+                                  r'DROP\s+(\w+\s+){1,2}IF\s+EXISTS|'
+                                  r'ALTER\s+\w+\s+\S+\s+\w+\s+COLUMN\s+IF\s+NOT\s+EXISTS)\b',
+                                  re.IGNORECASE)
+
+
+def classify_error(error, transient_errnos: dict = None):
+    """
+    Classifies a Snowflake error by its error code and SQL state
+    :param error: ProgrammingError or DatabaseError
+    :param transient_errnos: error classes by error code, TRANSIENT_ERRNOS if None
+    :return: one of ERROR_CLASSES, None for an error that fails again when retried
+    """
+    errno = getattr(error, 'errno', None)
+    error_class = (TRANSIENT_ERRNOS if transient_errnos is None else transient_errnos).get(errno)
+    if error_class is not None and errno in TRANSIENT_MESSAGES:
+        if not TRANSIENT_MESSAGES[errno].search(getattr(error, 'msg', None) or str(error)):
+            return None
+    if error_class is None:
+        error_class = TRANSIENT_SQLSTATES.get(getattr(error, 'sqlstate', None))
+    return error_class
+
+
+def is_idempotent(statement: str):
+    """
+    :param statement: SQL statement
+    :return: True if running the statement twice has the effect of running it once
+    """
+    return bool(IDEMPOTENT_STATEMENT.match(statement))
+
+
+def transaction_open(statement: str, open_before: bool):
+    """
+    :param statement: SQL statement that ran
+    :param open_before: an explicit transaction was open before the statement
+    :return: True if an explicit transaction is open after the statement
+    """
+    if TRANSACTION_START.match(statement):
+        return True
+    if TRANSACTION_END.match(statement):
+        return False
+    return open_before
+
+
+class RetryStats:
+    """
+    Counters of the transient errors retried and of the in-flight limit. Each release counts its own, added to the
+    process totals (stats)
+    """
+    __slots__ = ('retries', 'recovered', 'exhausted', 'not_retried', 'backoff_time', 'lock', 'overload', 'internal',
+                 'session', 'limit_decreases', 'lowest_limit', '_lock', '_parent')
+
+    def __init__(self, parent=None):
+        """
+        :param parent: RetryStats the counters are also added to
+        """
+        self._lock = threading.Lock()
+        self._parent = parent
+        self.reset()
+
+    def reset(self):
+        self.retries = 0
+        self.recovered = 0
+        self.exhausted = 0
+        self.not_retried = 0
+        self.backoff_time = 0.0
+        self.lock = 0
+        self.overload = 0
+        self.internal = 0
+        self.session = 0
+        self.limit_decreases = 0
+        self.lowest_limit = None
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+        if self._parent is not None:
+            self._parent.add(**counters)
+
+    def limit_decreased(self, limit: int):
+        with self._lock:
+            self.limit_decreases += 1
+            self.lowest_limit = limit if self.lowest_limit is None else min(self.lowest_limit, limit)
+        if self._parent is not None:
+            self._parent.limit_decreased(limit)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if not name.startswith('_')}
+
+    def summary(self):
+        summary = f'{self.retries} retries ({self.lock} lock, {self.overload} overload, {self.internal} internal, ' \
+                  f'{self.session} session), {self.recovered} statements recovered, {self.exhausted} gave up, ' \
+                  f'{self.not_retried} not retried, {self.backoff_time:.2f}s backing off'
+        if self.limit_decreases:
+            summary += f', in-flight limit lowered {self.limit_decreases} times to {self.lowest_limit}'
+        return summary
+
+
+stats = RetryStats()
+
+
+class RetryPolicy:
+    """
+    Retries statements failing with transient errors (see classify_error) with jittered exponential backoff: the
+    n-th retry waits a random time up to base_delay * 2 ** (n - 1), capped at max_delay, so releases hitting the same
+    overloaded warehouse or lock do not retry in step. A statement failing with a SESSION error may have run, it is
+    only retried when it is idempotent. A statement of an open explicit transaction is never retried on its own: a
+    deadlock or a lost session rolls the transaction back, the retry would run without the statements before it.
+    """
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0,
+                 transient_errnos: dict = None, seed=None, stats: RetryStats = stats):
+        """
+        :param max_attempts: attempts of a statement, 1 to never retry
+        :param base_delay: seconds the first retry waits at most
+        :param max_delay: upper bound of the wait before a retry
+        :param transient_errnos: error classes by error code, added to TRANSIENT_ERRNOS
+        :param seed: seed of the jitter
+        :param stats: RetryStats counting the retries
+        """
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.transient_errnos = dict(TRANSIENT_ERRNOS, **(transient_errnos or {}))
+        self.random = random.Random(seed)
+        self.stats = stats
+
+    @classmethod
+    def from_properties(cls, properties: dict, stats: RetryStats = stats):
+        """
+        :param properties: Dictionary of the properties yaml file, reads the retry section
+        :param stats: RetryStats counting the retries
+        """
+        retry_properties = properties.get('retry') or {}
+        max_attempts = retry_properties.get('max_attempts')
+        return cls(max_attempts=5 if max_attempts is None else int(max_attempts),
+                   base_delay=float(retry_properties.get('base_delay') or 0.5),
+                   max_delay=float(retry_properties.get('max_delay') or 30),
+                   transient_errnos={int(errno): error_class for errno, error_class
+                                     in (retry_properties.get('transient_errnos') or {}).items()},
+                   stats=stats)
+
+    def classify(self, error):
+        return classify_error(error, self.transient_errnos)
+
+    def backoff(self, attempt: int):
+        """
+        :param attempt: number of the retry, from 1
+        :return: seconds to wait before the retry
+        """
+        return self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def retry_delay(self, error, attempt: int, statement: str = None, description: str = 'Statement',
+                    in_transaction: bool = False):
+        """
+        Decides whether a failed attempt is retried and counts it
+        :param error: error of the attempt
+        :param attempt: number of the attempt that failed, from 1
+        :param statement: statement of the attempt, checked for idempotence after a SESSION error
+        :param description: what failed, for the log
+        :param in_transaction: the statement ran in an open explicit transaction, see transaction_open
+        :return: seconds to wait before the retry, None if the error is raised
+        """
+        error_class = self.classify(error)
+        if error_class is None:
+            return None
+        if in_transaction:
+            logger.error(f'{description} failed with a {error_class} error in an open transaction, it is not retried '
+                         f'without the statements of the transaction before it: {error}')
+            self.stats.add(not_retried=1)
+            return None
+        if error_class == SESSION and statement is not None and not is_idempotent(statement):
+            logger.error(f'{description} failed with a {error_class} error and may have run, it is not idempotent '
+                         f'and is not retried: {error}')
+            self.stats.add(not_retried=1)
+            return None
+        if attempt >= self.max_attempts:
+            logger.error(f'{description} failed with a {error_class} error {attempt} times, giving up: {error}')
+            self.stats.add(exhausted=1)
+            return None
+        delay = self.backoff(attempt)
+        logger.warning(f'{description} failed with a transient {error_class} error, retry {attempt}/'
+                       f'{self.max_attempts - 1} in {delay:.2f}s: {error}')
+        self.stats.add(retries=1, backoff_time=delay, **{error_class: 1})
+        return delay
+
+    def call(self, operation, statement: str = None, description: str = 'Statement', in_transaction: bool = False):
+        """
+        Runs an operation, retrying it after transient errors
+        :param operation: callable taking the number of earlier attempts, e.g. to skip work a failed attempt did
+        :param statement: statement the operation runs, checked for idempotence after a SESSION error
+        :param description: what runs, for the log
+        :param in_transaction: the statement runs in an open explicit transaction, it is not retried
+        :return: the operation's result
+        """
+        attempt = 0
+        while True:
+            try:
+                result = operation(attempt)
+            except (ProgrammingError, DatabaseError) as e:
+                attempt += 1
+                delay = self.retry_delay(e, attempt, statement=statement, description=description,
+                                         in_transaction=in_transaction)
+                if delay is None:
+                    raise
+                start = time.time()
+                time.sleep(delay)
+                instrumentation.record('retry', start, time.time(), error=str(e), attempt=attempt,
+                                       errno=getattr(e, 'errno', None), error_class=self.classify(e))
+                continue
+            if attempt:
+                self.stats.add(recovered=1)
+            return result
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit of the statements in flight: the limit grows by one for every limit statements that complete and is
+    halved when the warehouse queues statements or rejects them as overloaded. Every decrease starts a new epoch,
+    congestion is only counted for statements started in the current epoch, those started before were in flight
+    under the higher limit and are what the decrease reacted to. A decrease is also at most once per cooldown.
+    Threads wait for a slot with acquire, the asynchronous executor reads the limit.
+    """
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease: float = 0.5, cooldown: float = 1.0,
+                 stats: RetryStats = stats):
+        """
+        :param max_limit: statements in flight when there is no congestion, the starting limit
+        :param min_limit: lower bound of the limit
+        :param decrease: factor the limit is multiplied by on congestion
+        :param cooldown: seconds after a decrease during which congestion does not decrease the limit again
+        :param stats: RetryStats counting the decreases
+        """
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.decrease = float(decrease)
+        self.cooldown = float(cooldown)
+        self._limit = float(self.max_limit)
+        # number of decreases, statements record it when they start
+        self.epoch = 0
+        self._in_flight = 0
+        self._decreased_at = None
+        self._available = threading.Condition(threading.Lock())
+        self.stats = stats
+
+    @classmethod
+    def from_properties(cls, properties: dict, max_limit: int, stats: RetryStats = stats):
+        """
+        :param properties: Dictionary of the properties yaml file, reads the retry section
+        :param max_limit: statements in flight when there is no congestion
+        :param stats: RetryStats counting the decreases
+        """
+        retry_properties = properties.get('retry') or {}
+        if not retry_properties.get('adaptive_concurrency', True):
+            # the limit never drops below max_limit
+            return cls(max_limit, min_limit=max_limit, stats=stats)
+        return cls(max_limit,
+                   min_limit=int(retry_properties.get('min_in_flight') or 1),
+                   cooldown=float(retry_properties.get('congestion_cooldown') or 1.0),
+                   stats=stats)
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        with self._available:
+            while self._in_flight >= int(self._limit):
+                self._available.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._available:
+            self._in_flight -= 1
+            self._available.notify()
+
+    def succeeded(self):
+        """
+        Additive increase, called when a statement completes
+        """
+        with self._available:
+            if self._limit < self.max_limit:
+                self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+                self._available.notify()
+
+    def congested(self, epoch: int = None, floor: int = None):
+        """
+        Multiplicative decrease, called when a statement is queued or rejected as overloaded
+        :param epoch: epoch the statement started in, congestion of statements started before the last decrease
+                      is not counted. Always counted if None
+        :param floor: statements in flight the limit is not lowered below, e.g. what the warehouse runs at once
+        """
+        with self._available:
+            if epoch is not None and epoch < self.epoch:
+                return
+            now = time.monotonic()
+            if self._decreased_at is not None and now - self._decreased_at < self.cooldown:
+                return
+            limit = max(float(self.min_limit), self._limit * self.decrease, float(floor or 0))
+            if int(limit) < int(self._limit):
+                self._decreased_at = now
+                self.epoch += 1
+                logger.info(f'Warehouse congested, lowering the statements in flight from {int(self._limit)} to '
+                            f'{int(limit)}')
+                self.stats.limit_decreased(int(limit))
+            self._limit = limit
+
+    @contextmanager
+    def slot(self, transient_errnos: dict = None):
+        """
+        Holds a slot while a statement runs, a statement rejected as overloaded decreases the limit
+        :param transient_errnos: error classes by error code, TRANSIENT_ERRNOS if None
+        """
+        self.acquire()
+        epoch = self.epoch
+        try:
+            yield
+        except (ProgrammingError, DatabaseError) as e:
+            if classify_error(e, transient_errnos) == OVERLOAD:
+                self.congested(epoch=epoch)
+            raise
+        else:
+            self.succeeded()
+        finally:
+            self.release()
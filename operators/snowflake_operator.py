@@ -1,20 +1,29 @@
 from hooks import snowflake_hook as sfc
+from hooks.connection_pool import SnowflakeConnectionPool, alter_session_statements
+from operators.change_history import HISTORY_COLUMNS, ChangeHistory, ChangeRecord
+from operators.changeset_parser import ChangeSet, parse_file, parse_header
+from operators.history_cache import HistoryCache
+from operators.history_writer import HistoryWriter
+from operators.instrumentation import instrumentation
+from operators.retry_policy import RetryPolicy, transaction_open
+from operators.sql_templates import get_rendered_template
+from operators.statement_cache import StatementStats, statement_cache, stats as statement_stats
+from collections import deque
+from contextlib import nullcontext
 import datetime
 import logging
+import re
+import time
 from snowflake.connector.errors import DatabaseError, ProgrammingError
-from jinja2 import Environment, FileSystemLoader
 
 logger = logging.getLogger(__name__)
 
-file_loader = FileSystemLoader(searchpath='sql')
-j2_env = Environment(loader=file_loader)
+USE_STATEMENT = re.compile(r'^\s*USE\s', re.IGNORECASE)
+# statements of a change that leave the session changed, the connection is not reused by the connection pool
+SESSION_STATEMENT = re.compile(r'^\s*(USE\s|ALTER\s+SESSION\s)', re.IGNORECASE)
 
-
-def get_rendered_template(template, records):
-    """
-
-    """
-    return j2_env.get_template(template).render(records=records)
+# query ids kept of a change streamed from a large file
+STREAMED_QUERY_IDS = 100
 
 
 class SnowflakeOperator:
@@ -22,14 +31,136 @@ class SnowflakeOperator:
     Manages interactions with Snowflake
     """
 
-    def __init__(self, conn, target_database, history_schema, history_table):
+    def __init__(self, conn, target_database, history_schema, history_table, history_batch_size: int = 50,
+                 history_flush_interval: float = 10.0, history_cache_directory: str = None,
+                 history_watermark_column: str = 'date_released',
+                 history_cache_overlap: datetime.timedelta = datetime.timedelta(hours=24),
+                 history_fetch_size: int = 10000, retry_policy: RetryPolicy = None,
+                 statement_stats: StatementStats = statement_stats):
         self.history_schema = history_schema
         self.history_table = history_table
-        self.change_history = []
+        self.change_history = ChangeHistory()
         self.deploy_database_name = ''
         self.database_error = 0
         self.conn = conn
         self.target_database = target_database
+        self.history_batch_size = history_batch_size
+        self.history_flush_interval = history_flush_interval
+        self._history_writer = None
+        self.history_cache_directory = history_cache_directory
+        self.history_watermark_column = history_watermark_column
+        self.history_cache_overlap = history_cache_overlap
+        self.history_fetch_size = history_fetch_size
+        self._cursor = None
+        self._current_database = None
+        # operators.release_journal.ReleaseJournal of the database released to, statements are not journaled if None
+        self.journal = None
+        # statements failing with transient errors are retried
+        self.retry_policy = retry_policy or RetryPolicy()
+        # counters of the statements split and executed, shared by the operators of a release
+        self.statement_stats = statement_stats
+        # retry_policy.AdaptiveLimiter shared by the operators of a release, change statements are not limited if None
+        self.limiter = None
+        # a change ran a USE or ALTER SESSION statement on the connection, see SnowflakeConnectionPool.release
+        self.session_changed = False
+
+    @property
+    def cursor(self):
+        """
+        Cursor reused for every statement this operator executes on its connection
+        """
+        if self._cursor is None:
+            self._cursor = self.conn.cursor()
+        return self._cursor
+
+    def use_database(self, database: str):
+        """
+        Makes a database current for the session, only if it is not already current
+        :param database: database name
+        """
+        if database != self._current_database:
+            self.cursor.execute(f'USE DATABASE {database}')
+            self._current_database = database
+            self.statement_stats.add(database_switches=1)
+
+    def restore_session(self, database: str, session_parameters: dict = None):
+        """
+        Makes the release context current again after a change ran USE or ALTER SESSION statements on the session.
+        The connection is still closed when it is returned to the pool, a role or warehouse is not restored.
+        :param database: database to make current, the target or its clone
+        :param session_parameters: session parameters to set again, e.g. those of the connection pool
+        """
+        self.session_changed = True
+        for statement in alter_session_statements(session_parameters or {}):
+            self.cursor.execute(statement)
+        self._current_database = None
+        self.use_database(database)
+
+    @property
+    def history_database(self):
+        """
+        The database holding the history table, the clone when releasing to a clone
+        """
+        return self.deploy_database_name or self.target_database
+
+    @property
+    def history_writer(self):
+        """
+        Buffered writer for the history table of the database being released to
+        """
+        history_table = f'{self.history_database}.{self.history_schema}.{self.history_table}'
+        if self._history_writer is None or self._history_writer.history_table != history_table:
+            self.flush_history()
+            self._history_writer = HistoryWriter(execute=self._execute_history_sql,
+                                                 executemany=self._executemany_history_sql,
+                                                 render=get_rendered_template,
+                                                 history_table=history_table,
+                                                 batch_size=self.history_batch_size,
+                                                 flush_interval=self.history_flush_interval)
+        return self._history_writer
+
+    def flush_history(self):
+        """
+        Writes buffered change records and statuses to the history table
+        """
+        if self._history_writer is not None:
+            self._history_writer.flush()
+
+    def _execute_history_sql(self, sql, params=None):
+        """
+        Executes a history table statement, errors are raised so buffered records are never silently lost. The
+        status MERGE sets the status of the changes, it is retried after transient errors.
+        """
+        logger.debug(sql)
+        self.retry_policy.call(lambda attempt: self.cursor.execute(sql, params),
+                               description=f'History update of {self.history_database}')
+
+    def _executemany_history_sql(self, sql, seq_params):
+        """
+        Inserts history records, one row of bind parameters per record in HISTORY_COLUMNS order, in one round-trip.
+        The insert is retried after transient errors. An attempt that failed with a lost session may have inserted
+        the records, a retry only inserts the records that are not in the history table.
+        """
+        logger.debug(sql)
+        rows = list(seq_params)
+
+        def insert(attempt):
+            pending = rows if attempt == 0 else self._unwritten_history_rows(rows)
+            if pending:
+                self.cursor.executemany(sql, pending)
+
+        self.retry_policy.call(insert, description=f'History insert into {self.history_database}')
+
+    def _unwritten_history_rows(self, rows):
+        """
+        :param rows: history records in HISTORY_COLUMNS order
+        :return: the records not in the history table, a record is identified by its id and release time
+        """
+        id_column, date_column = HISTORY_COLUMNS.index('id'), HISTORY_COLUMNS.index('date_released')
+        sql = get_rendered_template(template='select_history_records.j2',
+                                    history_table=self._history_writer.history_table, rows=len(rows))
+        written = {tuple(row) for row in self.cursor.execute(sql, [row[id_column] for row in rows]).fetchall()}
+        return [row for row in rows if (row[id_column], row[date_column]) not in written]
 
     @staticmethod
     def get_conn(**kwargs):
@@ -38,89 +169,215 @@ class SnowflakeOperator:
         :param kwargs: connection details from the properties file
         :return: Snowflake connection object
         """
-        conn = sfc.SnowflakeConnection(kwargs)
+        with instrumentation.span('connect', pooled=False):
+            conn = sfc.SnowflakeConnection(**kwargs).get_conn()
         return conn
 
     @staticmethod
-    def _execute_sql(conn, sql):
-        try:
-            return conn.cursor().execute(sql)
-        except ProgrammingError as e:
-            logger.error(e)
-        except DatabaseError as e:
-            logger.error(e)
-        except Exception as e:
-            raise e
+    def get_connection_pool(**kwargs):
+        """
+        Returns a pool of Snowflake connections, sized by the connection_pool section of the properties file
+        :param kwargs: connection details from the properties file
+        :return: SnowflakeConnectionPool
+        """
+        return SnowflakeConnectionPool.from_properties(sfc.SnowflakeConnection(**kwargs), kwargs,
+                                                       instrumentation=instrumentation)
 
-    @staticmethod
-    def _execute_string(conn, sql):
+    def close(self):
+        """
+        Writes buffered history records and closes the Snowflake connection used by this operator
+        """
+        self.flush_history()
+        if self.conn is not None:
+            self.conn.close()
+
+    def _execute_sql(self, sql):
+        """
+        Runs a statement of the release tool itself, e.g. a history table lookup
+        :param sql: statement
+        :return: cursor
+        :raises ProgrammingError: or DatabaseError, once retries of transient errors are exhausted
+        """
         try:
-            return conn.cursor().execute_string(sql)
-        except ProgrammingError as e:
-            logger.error(e)
-        except DatabaseError as e:
-            logger.error(e)
-        except Exception as e:
-            raise e
+            # the statements run here are reads and IF NOT EXISTS DDL, retried after transient errors
+            return self.retry_policy.call(lambda attempt: self.cursor.execute(sql), statement=sql)
+        except (ProgrammingError, DatabaseError) as e:
+            logger.error(f'{e}: {sql}')
+            raise
 
-    @staticmethod
-    def clone_database(conn, target_database):
+    def clone_database(self, target_database: str, clone_name: str = None):
         """
-        Clones a target database
-        :param conn:
-        :param target_database:
+        Creates a zero-copy clone of a target database, the release is deployed to the clone. Errors are raised,
+        a release never falls back to the target when its clone could not be created.
+        :param target_database: database to clone
+        :param clone_name: name of the clone, <target>_CLONE_<timestamp> if None
+        :return: clone name
         """
-        # TODO implement clone
-        pass
+        if clone_name is None:
+            clone_name = f'{target_database}_CLONE_{datetime.datetime.now():%Y%m%d%H%M%S%f}'.upper()
+        sql = f'CREATE DATABASE {clone_name} CLONE {target_database}'
+        logger.info(f'Cloning {target_database} to {clone_name}')
+        logger.debug(sql)
+        self.cursor.execute(sql)
+        self.deploy_database_name = clone_name
+        return clone_name
+
+    def drop_database(self, database: str):
+        """
+        Drops a database, e.g. a backup of a target past its retention
+        :param database: database name
+        """
+        sql = f'DROP DATABASE IF EXISTS {database}'
+        logger.info(f'Dropping {database}')
+        logger.debug(sql)
+        self.cursor.execute(sql)
+        if database == self._current_database:
+            self._current_database = None
+
+    def list_databases(self, prefix: str):
+        """
+        :param prefix: start of the database names
+        :return: names of the databases starting with the prefix
+        """
+        # SHOW TERSE DATABASES returns created_on, name, kind, database_name, schema_name
+        rows = self.cursor.execute(f"SHOW TERSE DATABASES STARTS WITH '{prefix}'").fetchall()
+        return [row[1] for row in rows if row[1].upper().startswith(prefix.upper())]
 
     def get_database_change_history(self):
         """
-        Gets all the successful changes to the database from the history table
-        :return: Tuples of the database history table
+        Gets all the successful changes to the database from the history table. When history_cache_directory is
+        set the rows are kept in a local cache and only rows newer than the cached watermark are fetched.
+        :return: ChangeHistory indexed by change id
         """
-        if self.deploy_database_name is None:
-            database = self.target_database
-        else:
-            database = self.deploy_database_name
+        database = self.history_database
+        history_table = f'{database}.{self.history_schema}.{self.history_table}'
+        with instrumentation.span('history_fetch', history_table=history_table) as span:
+            self._get_database_change_history(database, history_table)
+            span.set(rows=len(self.change_history))
+        return self.change_history
 
+    def _get_database_change_history(self, database, history_table):
+        self.change_history = ChangeHistory()
+        # the table is checked before the cache is trusted, it may have been dropped or lack newer columns
         self._validate_change_history_table(database=database)
 
-        sql = f"SELECT * FROM {database}.{self.history_schema}.{self.history_table} " \
-              f"WHERE status = 'success'"
-        logger.debug(sql)
+        cache = None
+        cached = None
+        if self.history_cache_directory:
+            cache = HistoryCache(cache_directory=self.history_cache_directory,
+                                 history_table=history_table,
+                                 watermark_column=self.history_watermark_column,
+                                 overlap=self.history_cache_overlap)
+            cached = cache.load()
+
+        if cached is not None:
+            rows, cached_state = cached
+            self.change_history.extend(rows)
+            try:
+                cached = self._sync_history(cache, history_table, cached_state)
+            except (ProgrammingError, DatabaseError) as e:
+                logger.info(f'Incremental history sync failed, re-syncing {history_table}: {e}')
+                cached = None
+            if cached is not None:
+                logger.info(f'History of {history_table} is in sync, {len(self.change_history)} changes cached')
+
+        if cached is None:
+            self.change_history = ChangeHistory()
+            if cache is not None:
+                state = self._fetch_history_state(history_table)
+                # the rows are indexed as the cache writes them, they are never all held in a list
+                cache.save(self._indexed(self._fetch_history(history_table)), state, append=False)
+            else:
+                self._index_history(self._fetch_history(history_table))
 
-        self.change_history = self._execute_sql(sql).fetchall()
+    def _sync_history(self, cache, history_table, cached_state):
+        """
+        Fetches the history rows written since the last sync into the cache and the change history
+        :param cache: HistoryCache of the history table
+        :param history_table: fully qualified history table name
+        :param cached_state: (row count, watermark) of the history table at the last sync
+        :return: the new state, None if the cache has to be rebuilt
+        """
+        state = self._fetch_history_state(history_table)
+        if state == cached_state:
+            return state
+        if cache.is_replaced(cached_state, state):
+            logger.info(f'History table {history_table} was truncated, restored or swapped since the last sync')
+            return None
+        new_rows = [row for row in self._fetch_history(history_table, cache.query_watermark(cached_state[1]))
+                    if self.change_history.get(row[0]) != ChangeRecord(*row)]
+        if len(new_rows) != state[0] - cached_state[0]:
+            # rows were written or changed status before the overlap window
+            logger.info(f'{state[0] - cached_state[0]} rows were added to {history_table} since the last sync, '
+                        f'{len(new_rows)} found after {cache.query_watermark(cached_state[1])}')
+            return None
+        self.change_history.extend(new_rows)
+        cache.save(new_rows, state)
+        logger.info(f'Synced {len(new_rows)} new history rows from {history_table}')
+        return state
+
+    def _fetch_history_state(self, history_table):
+        """
+        Reads the count of successful history rows and the highest value of their watermark column, on the server
+        :param history_table: fully qualified history table name
+        :return: (row count, watermark)
+        """
+        sql = get_rendered_template(template='select_history_state.j2', history_table=history_table,
+                                    watermark_column=self.history_watermark_column)
+        cursor = self.conn.cursor()
+        self.retry_policy.call(lambda attempt: cursor.execute(sql), description=f'History state of {history_table}')
+        count, watermark = cursor.fetchone()
+        return count, watermark
+
+    def _indexed(self, rows):
+        """
+        Adds history rows to the change history as they are read
+        :param rows: history rows
+        :return: generator of the rows
+        """
+        for row in rows:
+            self.change_history.add(row)
+            yield row
 
-        return self.change_history
+    def _index_history(self, rows):
+        """
+        Adds history rows to the change history
+        :param rows: history rows, consumed
+        """
+        for row in rows:
+            self.change_history.add(row)
+
+    def _fetch_history(self, history_table, watermark=None):
+        """
+        Streams successful history rows in batches of history_fetch_size
+        :param history_table: fully qualified history table name
+        :param watermark: only rows with a watermark column value from this value on are fetched, all if None
+        """
+        sql = get_rendered_template(template='select_release_history.j2', history_table=history_table,
+                                    watermark_column=self.history_watermark_column,
+                                    incremental=watermark is not None)
+        logger.debug(sql)
+
+        cursor = self.conn.cursor()
+        self.retry_policy.call(lambda attempt: cursor.execute(sql, (watermark,) if watermark is not None else None),
+                               description=f'History fetch from {history_table}')
+        while True:
+            rows = cursor.fetchmany(self.history_fetch_size)
+            if not rows:
+                break
+            yield from rows
 
     def track_change_in_history_table(self, **kwargs):
         """
-        Inserts a new record for in teh history table for a new change
+        Inserts a new record for in teh history table for a new change, the record is buffered and written in a
+        batch with other changes
         :param kwargs: Change metadata
         :return: True is successful, false is change id found in history
         """
-        # sql = f"INSERT INTO {self.deploy_database_name}.{self.history_schema}.{self.history_table} " \
-        #       f"(id, author, filename, date_released, change_log, jira_number, release_number, comments, " \
-        #       f"deployment_id, status) " \
-        #       f"VALUES(\'{kwargs.get('id')}\'," \
-        #       f"\'{kwargs.get('author')}\'," \
-        #       f"\'{kwargs.get('filename')}\'," \
-        #       f"\'{kwargs.get('date_released')}\'," \
-        #       f"\'{kwargs.get('change_log')}\'," \
-        #       f"\'{kwargs.get('jira_number')}\'," \
-        #       f"\'{kwargs.get('release_number')}\','" \
-        #       f"\'{kwargs.get('comments')}\'," \
-        #       f"\'{kwargs.get('deployment_id')}\'," \
-        #       f"\'{kwargs.get('status')}\'" \
-        #       f")"
-
-        template = 'insert_into_release_log_history_table.j2'
-
         try:
             # Checks if the change id is already in the database
             if self._check_id_is_valid(kwargs.get('id')):
-                sql = get_rendered_template(template=template, records=kwargs)
-                self._execute_sql(conn=self.conn, sql=sql)
+                self.history_writer.track(**kwargs)
                 return True
             else:
                 return False
@@ -128,62 +385,196 @@ class SnowflakeOperator:
             raise e
 
     def _check_id_is_valid(self, id: str):
-        is_valid = True
-        for x in self.change_history:
-            if x[0] == id and x[9] == 'success':
-                logger.info(f"Change ID {id} is already released to this database")
-                is_valid = False
-            elif x[0] == id and x[9] == 'failed':
-                logger.info(f"Change ID {id} was a failed release to this database, re-trying release")
-                is_valid = True
-        return is_valid
-
-    def deploy_change_to_target(self, sqlfile: str, author: str, id: str, database: str = None):
+        status = self.change_history.status(id)
+        if status == 'success':
+            logger.info(f"Change ID {id} is already released to this database")
+            return False
+        elif status == 'failed':
+            logger.info(f"Change ID {id} was a failed release to this database, re-trying release")
+        return True
+
+    def deploy_change_to_target(self, sqlfile: str, author: str, id: str, database: str = None,
+                                checksum: str = None, statements=None):
         """
         Releases a SQL file to the database
-        :param sqlfile: File to release
+        :param sqlfile: File to release, None when statements are given
         :param author: Author metadata from the SQL change file
         :param id: the unique id for the change
         :param database: target database
+        :param checksum: content hash of the file, used to reuse the statements split on a previous run
+        :param statements: statements streamed from a large file (see statement_cache.stream_statements), executed
+                           as they are split, sqlfile is split if None
+        :return: Snowflake query ids of the statements, only the last STREAMED_QUERY_IDS of a streamed file, None
+                 if the release failed
         """
         if database is None:
             database = self.deploy_database_name
 
-        use_db = f'USE DATABASE {database};\n'
-        sql = use_db + sqlfile
-
+        streamed = statements is not None
         try:
-            logger.debug(f'SQL to release: \n {sqlfile}')
-            # execute_string releases multiple changes in a file delimited by ";"
-            self.conn.execute_string(sql, remove_comments=True, return_cursors=True)
-            logger.info(f'Released change {author}:{id}')
+            if not streamed:
+                logger.debug(f'SQL to release: \n {sqlfile}')
+                # the file is split into statements delimited by ";" once per content hash
+                statements = statement_cache.split(sqlfile, checksum=checksum, stats=self.statement_stats)
+            self.use_database(database)
+            start = time.perf_counter()
+            position = 0
+            if self.journal is not None:
+                position, session_statements, statements = self.journal.resume(id, statements)
+                if position:
+                    logger.info(f'Resuming change {author}:{id} at statement {position + 1}, the statements before '
+                                f'it were released by a previous run')
+                    self._execute_statements(session_statements, [], changeset=id, journal=False)
+            # a streamed file can have millions of statements, only the last query ids are kept
+            query_ids = deque(maxlen=STREAMED_QUERY_IDS) if streamed else []
+            executed = self._execute_statements(statements, query_ids, changeset=id, position=position)
+            logger.info(f'Released change {author}:{id} in {time.perf_counter() - start:.2f}s, '
+                        f'{executed} statements, {"last " if streamed else ""}query ids {", ".join(query_ids)}')
+            return list(query_ids)
 
         except ProgrammingError as e:
             logger.error(e)
             logger.info(f'Failed to release change {author}:{id}, check errors')
-            logger.error(f'SQL to release: \n {sqlfile}')
+            if not streamed:
+                logger.error(f'SQL to release: \n {sqlfile}')
             self.database_error = 1
         except DatabaseError as e:
             logger.error(e)
             logger.info(f'Failed to release change {author}:{id}, check errors')
-            logger.error(f'SQL to release: \n {sqlfile}')
+            if not streamed:
+                logger.error(f'SQL to release: \n {sqlfile}')
             self.database_error = 1
         except Exception as e:
             raise e
 
+    def stage_load_files(self, load_file, id: str, loader, query_ids: list):
+        """
+        Prepares the data files of a bulk load changeset and uploads them to its stage with PUT
+        :param load_file: manifest_reader.LoadFile
+        :param id: the unique id for the change
+        :param loader: bulk_load.BulkLoader
+        :param query_ids: list the query id of the PUT is appended to
+        :return: COPY INTO statement loading the uploaded files
+        """
+        with loader.prepared(load_file, id) as (put_statement, copy_statement):
+            self._execute_statements([put_statement], query_ids, changeset=id, journal=False)
+        return copy_statement
+
+    def load_change_to_target(self, load_file, author: str, id: str, loader, database: str = None):
+        """
+        Releases a bulk load changeset to the database: the data files are split, compressed and uploaded to a
+        stage, then loaded with COPY INTO. A load is not journaled, a rerun uploads the same files and the COPY
+        skips the files it already loaded.
+        :param load_file: manifest_reader.LoadFile
+        :param author: Author metadata from the manifest include
+        :param id: the unique id for the change
+        :param loader: bulk_load.BulkLoader
+        :param database: target database
+        :return: Snowflake query ids of the PUT and the COPY, None if the release failed
+        """
+        if database is None:
+            database = self.deploy_database_name
+        try:
+            self.use_database(database)
+            start = time.perf_counter()
+            query_ids = []
+            copy_statement = self.stage_load_files(load_file, id, loader, query_ids)
+            self._execute_statements([copy_statement], query_ids, changeset=id, position=1, journal=False)
+            logger.info(f'Released change {author}:{id} in {time.perf_counter() - start:.2f}s, loaded '
+                        f'{load_file.file} into {load_file.table}, query ids {", ".join(query_ids)}')
+            return query_ids
+
+        except (ProgrammingError, DatabaseError) as e:
+            logger.error(e)
+            logger.info(f'Failed to release change {author}:{id}, check errors')
+            self.database_error = 1
+        except (OSError, ValueError) as e:
+            logger.error(f'Cannot prepare {load_file.file} for loading: {e}')
+            logger.info(f'Failed to release change {author}:{id}, check errors')
+            self.database_error = 1
+
+    def _execute_statements(self, statements, query_ids, changeset: str = None, position: int = 0,
+                            journal: bool = True):
+        """
+        Executes statements in order on the reused cursor
+        :param statements: statements from the statement cache, or streamed from a large file
+        :param query_ids: list the Snowflake query ids of the statements are appended to
+        :param changeset: id of the change the statements belong to, for instrumentation and the journal
+        :param position: number of statements of the change before these, when resuming a change
+        :param journal: record the statements in the release journal, False for replayed session statements
+        :return: number of statements executed
+        """
+        start = time.perf_counter()
+        executed = 0
+        # an explicit transaction of the change is open, its statements are not retried on their own
+        in_transaction = False
+        try:
+            for statement in statements:
+                if SESSION_STATEMENT.match(statement):
+                    self.session_changed = True
+                if USE_STATEMENT.match(statement):
+                    # the file changes the session, the current database is no longer known
+                    self._current_database = None
+                with instrumentation.span('statement', changeset=changeset, position=position + executed + 1) as span:
+                    try:
+                        self._execute_change_statement(statement, f'Statement {position + executed + 1} of change '
+                                                                  f'{changeset}', in_transaction=in_transaction)
+                    except (ProgrammingError, DatabaseError):
+                        logger.error(f'Statement {position + executed + 1} of change {changeset} failed: '
+                                     f'{statement[:1000]}')
+                        raise
+                    span.set(query_id=self.cursor.sfqid, rows=self.cursor.rowcount)
+                in_transaction = transaction_open(statement, in_transaction)
+                query_ids.append(self.cursor.sfqid)
+                executed += 1
+                if journal and self.journal is not None:
+                    self.journal.statement(changeset, position + executed, statement, self.cursor.sfqid)
+        finally:
+            self.statement_stats.add(statements_executed=executed, execute_time=time.perf_counter() - start)
+        return executed
+
+    def _execute_change_statement(self, statement: str, description: str, in_transaction: bool = False):
+        """
+        Executes a statement of a change on the reused cursor, in a slot of the limiter. Transient errors are
+        retried, a statement that may have run is only retried when it is idempotent.
+        :param statement: SQL statement
+        :param description: statement and change, for the log
+        :param in_transaction: the statement runs in an open explicit transaction, it is not retried
+        """
+        def execute(attempt):
+            with self.limiter.slot(self.retry_policy.transient_errnos) if self.limiter is not None \
+                    else nullcontext():
+                self.cursor.execute(statement)
+
+        self.retry_policy.call(execute, statement=statement, description=description, in_transaction=in_transaction)
+
+    def split_statements(self, sql: str, checksum: str = None):
+        """
+        Splits the SQL of a change file into statements the way execute_string does, without comments
+        :param sql: SQL text
+        :param checksum: content hash of the file, the statements are split once per hash
+        :return: list of statements
+        """
+        return list(statement_cache.split(sql, checksum=checksum, stats=self.statement_stats))
+
     @staticmethod
-    def get_change_details(sqlfile: str, date_released: datetime, change_log: str):
+    def get_change_details(sqlfile: str, date_released: datetime, change_log: str, content=None,
+                           changeset: ChangeSet = None):
         """
         Reads the change metadata from a SQL change file
         :param sqlfile: File to release
         :param date_released: release timestamp
         :param change_log: Parent manifest file
+        :param content: lines of the file already read, e.g. ChangeFile.header_lines, the file is read if None
+        :param changeset: metadata already parsed from the file header, e.g. ChangeFile.changeset
         :return:
         """
-        with open(sqlfile) as f:
-            content = f.readlines()
-            logger.debug(f'Found SQL file {sqlfile}')
-        content = [x.strip() for x in content]
+        if changeset is None:
+            if content is None:
+                changeset = parse_file(sqlfile)
+                logger.debug(f'Found SQL file {sqlfile}')
+            else:
+                changeset = parse_header(content)
 
         change_details = {'filename': sqlfile,
                           'date_released': date_released,
@@ -191,78 +582,71 @@ class SnowflakeOperator:
                           'change_log': change_log,
                           'status': 'in progress'
                           }
-
-        # Substring change metadata from comments
-        for i, line in enumerate(content):
-            if '--changeset' in line:
-
-                author = line.split(" ")[1][:line.split(" ")[1].find(':')]
-                id = line.split(" ")[1][line.split(" ")[1].find(':') + 1:]
-                context = line.split(" ")[2][line.split(" ")[2].find(':') + 1:]
-
-                change_details['author'] = author
-                change_details['id'] = id
-                change_details['release_number'] = context
-
-            elif 'comment:' in line and len(line) > len('--comment:'):
-                comments = line.split(" ")[1]
-                change_details['comments'] = comments
-
-            elif 'labels:' in line:
-                jira = line.split(" ")[1]
-                change_details['jira_number'] = jira
+        change_details.update(changeset.to_change_details())
 
         return change_details
 
     def swap_database(self, cloned_db_name: str, target_db_name: str):
         """
-        Swaps a target and clone database
-        :param cloned_db_name:
-        :param target_db_name:
+        Swaps a target and clone database in one atomic statement. Errors are raised, the target is unchanged when
+        the swap fails.
+        :param cloned_db_name: clone the release was deployed to
+        :param target_db_name: target database
         """
         sql = f"ALTER DATABASE {cloned_db_name} SWAP WITH {target_db_name}"
-
-        try:
-            logger.info(f'Swapping clone {cloned_db_name} from {target_db_name}')
-            self._execute_sql(sql)
-            logger.info('Databases swapped')
-        except Exception as e:
-            raise e
+        logger.info(f'Swapping clone {cloned_db_name} with {target_db_name}')
+        logger.debug(sql)
+        self.cursor.execute(sql)
+        # the session keeps the database it used, which now has the other name
+        self._current_database = None
+        logger.info('Databases swapped')
 
     def mark_database_release(self, status: str):
         """
-        Renames the original target after a clone has been swapped as back up for housekeeping
+        Renames the clone after a release as back up for housekeeping: once swapped it holds the original target
         :param status: status to suffix the database name
+        :return: new name of the clone
         """
         new_name = f'{self.deploy_database_name}_{status.upper()}'
         sql = f'ALTER DATABASE {self.deploy_database_name} RENAME TO {new_name}'
-        try:
-            logger.info(f'Marking clone {self.deploy_database_name} as {status.upper()}')
-            self._execute_sql(sql)
-            self.deploy_database_name = new_name
-        except Exception as e:
-            raise e
+        logger.info(f'Marking clone {self.deploy_database_name} as {status.upper()}')
+        logger.debug(sql)
+        self.cursor.execute(sql)
+        self.deploy_database_name = new_name
+        self._current_database = None
+        return new_name
 
     def set_change_status(self, status: str, id: str):
         """
-        sets the status of a record in the history table
-        :param status: success/failed
+        sets the status of a record in the history table, the status is buffered and written in a batch with
+        other changes
+        :param status: success/failed, or skipped for a change prepared but not run
         :param id: the unique id for the change
         """
-        sql = f"UPDATE {self.deploy_database_name}.{self.history_schema}.{self.history_table} " \
-              f"SET STATUS = '{status}' " \
-              f"WHERE id = '{id}'"
-        self._execute_sql(sql)
+        self.history_writer.set_status(id=id, status=status)
 
     def _validate_change_history_table(self, database=None):
         if database is None:
-            database = self.deploy_database_name
+            database = self.history_database
 
-        sql = f"select count(1) from {database}.INFORMATION_SCHEMA.TABLES " \
-              f"WHERE table_catalog = '{database}' " \
-              f"AND table_schema = '{self.history_schema}' " \
-              f"AND table_schema = '{self.history_table}'"
+        sql = get_rendered_template(template='validate_change_history.j2', database=database,
+                                    history_schema=self.history_schema, history_table=self.history_table)
 
         if self._execute_sql(sql).fetchone()[0] == 0:
             logger.info(f'Tracking table not found.... Creating {database}.{self.history_schema}.{self.history_table}')
             self._create_tracking_table(database=database)
+        else:
+            # history tables created before checksums were recorded
+            sql = get_rendered_template(template='alter_release_log_history_table.j2', database=database,
+                                        history_schema=self.history_schema, history_table=self.history_table)
+            self._execute_sql(sql)
+
+    def _create_tracking_table(self, database):
+        """
+        Creates the history schema and table
+        :param database: database to create the history table in
+        """
+        for template in ('create_release_log_history_schema.j2', 'create_release_log_history_table.j2'):
+            sql = get_rendered_template(template=template, database=database,
+                                        history_schema=self.history_schema, history_table=self.history_table)
+            self._execute_sql(sql)
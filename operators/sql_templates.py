@@ -0,0 +1,62 @@
+from functools import lru_cache
+from pathlib import Path
+import logging
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from operators.instrumentation import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# templates ship next to the packages, independent of the working directory
+SQL_DIRECTORY = Path(__file__).resolve().parent.parent / 'sql'
+
+
+class StatementRegistry:
+    """
+    Loads and compiles every sql/*.j2 template once. Templates only render identifiers (database, schema and
+    table names), values are passed as bind parameters, so the rendered text of a statement is the same for every
+    execution and is cached here and by Snowflake's compiled statement cache.
+    """
+    def __init__(self, searchpath=SQL_DIRECTORY, bytecode_cache_directory: str = None):
+        """
+        :param searchpath: directory holding the templates
+        :param bytecode_cache_directory: directory for compiled templates, a per user temp directory if None
+        """
+        self.env = Environment(loader=FileSystemLoader(str(searchpath)),
+                               bytecode_cache=FileSystemBytecodeCache(bytecode_cache_directory),
+                               auto_reload=False,
+                               keep_trailing_newline=False)
+        self.templates = {name: self.env.get_template(name)
+                          for name in self.env.list_templates(extensions=['j2'])}
+        logger.debug(f'Compiled {len(self.templates)} sql templates from {searchpath}')
+        self.statement = lru_cache(maxsize=256)(self._statement)
+
+    def render(self, template: str, **kwargs):
+        """
+        Renders a template
+        :param template: template file name in the sql directory
+        :param kwargs: template variables
+        :return: sql
+        """
+        return self.templates[template].render(**kwargs)
+
+    def _statement(self, template: str, **kwargs):
+        return self.render(template, **kwargs).strip()
+
+
+statements = StatementRegistry()
+
+
+def get_rendered_template(template, records=None, **kwargs):
+    """
+    Renders a sql template, the rendered text is cached for templates rendered without records
+    :param template: template file name in the sql directory
+    :param records: records to render, a dict or a list of dicts
+    :param kwargs: other template variables, must be hashable when records is None
+    :return: sql
+    """
+    with instrumentation.span('render', template=template):
+        if records is None:
+            return statements.statement(template, **kwargs)
+        return statements.render(template, records=records, **kwargs)
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import hashlib
+import io
+import logging
+import threading
+import time
+
+from snowflake.connector.util_text import split_statements
+
+logger = logging.getLogger(__name__)
+
+
+class StatementStats:
+    """
+    Counters of statement splitting and execution. Each release counts its own, added to the process totals (stats)
+    """
+    __slots__ = ('statements_executed', 'database_switches', 'cache_hits', 'cache_misses', 'split_time',
+                 'execute_time', 'streamed_files', '_lock', '_parent')
+
+    def __init__(self, parent=None):
+        """
+        :param parent: StatementStats the counters are also added to
+        """
+        self._lock = threading.Lock()
+        self._parent = parent
+        self.reset()
+
+    def reset(self):
+        self.statements_executed = 0
+        self.database_switches = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.split_time = 0.0
+        self.execute_time = 0.0
+        self.streamed_files = 0
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+        if self._parent is not None:
+            self._parent.add(**counters)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if not name.startswith('_')}
+
+    def summary(self):
+        return f'{self.statements_executed} statements executed in {self.execute_time:.2f}s, ' \
+               f'{self.database_switches} database switches, split {self.cache_misses} files in ' \
+               f'{self.split_time:.3f}s, {self.cache_hits} split cache hits, ' \
+               f'{self.streamed_files} large files streamed'
+
+
+stats = StatementStats()
+
+
+class StatementCache:
+    """
+    Statements of SQL change files keyed by content hash, a file is only split once however often it is executed
+    or retried
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+
+    def split(self, sql: str, checksum: str = None, stats: StatementStats = stats):
+        """
+        Splits SQL text into statements the way execute_string does, without comments
+        :param sql: SQL text
+        :param checksum: content hash of the file the SQL was read from, the SQL is hashed if None
+        :param stats: StatementStats counting the split
+        :return: tuple of statements
+        """
+        key = checksum or hashlib.blake2b(sql.encode('utf-8'), digest_size=16).hexdigest()
+        with self._lock:
+            statements = self._statements.get(key)
+            if statements is not None:
+                self._statements.move_to_end(key)
+        if statements is not None:
+            stats.add(cache_hits=1)
+            return statements
+
+        start = time.perf_counter()
+        statements = tuple(statement for statement, _ in split_statements(io.StringIO(sql), remove_comments=True))
+        stats.add(cache_misses=1, split_time=time.perf_counter() - start)
+        with self._lock:
+            self._statements[key] = statements
+            while len(self._statements) > self.maxsize:
+                self._statements.popitem(last=False)
+        return statements
+
+
+statement_cache = StatementCache()
+
+
+def stream_statements(open_sql, stats: StatementStats = stats):
+    """
+    Splits SQL into statements as it is read, the way StatementCache.split does, for files too large to hold in
+    memory. Only the statement being split is kept, so memory is bounded by the largest statement, not the file.
+    The statements are not cached.
+    :param open_sql: callable returning a text stream, e.g. manifest_reader.ChangeFile.open_sql
+    :param stats: StatementStats counting the streamed file
+    :return: generator of statements, the stream is closed when it is exhausted or closed
+    """
+    stats.add(streamed_files=1)
+    with open_sql() as sql:
+        for statement, _ in split_statements(sql, remove_comments=True):
+            yield statement
@@ -0,0 +1,69 @@
+from pathlib import Path
+import sys
+
+import pytest
+
+# the packages are imported from the repository root, as deploy.py and the benchmarks do
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic_release import write_release  # noqa: E402
+from core import deploy_changes  # noqa: E402
+from hooks.connection_pool import SnowflakeConnectionPool  # noqa: E402
+from hooks.fake_snowflake_hook import FakeSnowflakeConnectionHook  # noqa: E402
+
+TARGET_DATABASE = 'TEST'
+HISTORY_TABLE = f'{TARGET_DATABASE}.HISTORY_SCHEMA.HISTORY_TABLE'
+
+
+@pytest.fixture(autouse=True)
+def halt_release_on_fail():
+    # deploy.py sets the module flag from --continue-on-fail, tests changing it must not leak into others
+    halt = deploy_changes.halt_release_on_fail
+    yield
+    deploy_changes.halt_release_on_fail = halt
+
+
+@pytest.fixture
+def release_properties(tmp_path):
+    """
+    Writes a synthetic release and returns properties releasing it to the fake backend without local caches
+    """
+    def make(change_logs=2, files=3, statements=2, independent=False, **properties):
+        release = write_release(tmp_path / 'release', change_logs, files, statements=statements,
+                                independent=independent)
+        return dict(dict(release, history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE',
+                         history_cache_directory=None, content_cache_file=None, release_journal_directory=None),
+                    **properties)
+    return make
+
+
+@pytest.fixture
+def fake_hook():
+    """
+    Fake Snowflake account holding the target database, a backend can be given to reconnect to an account
+    """
+    def make(**kwargs):
+        kwargs.setdefault('record', False)
+        hook = FakeSnowflakeConnectionHook(database=TARGET_DATABASE, **kwargs)
+        if TARGET_DATABASE not in hook.backend.list_databases():
+            hook.backend.execute(f'CREATE DATABASE {TARGET_DATABASE}')
+        return hook
+    return make
+
+
+@pytest.fixture
+def deployer():
+    """
+    DeployChanges releasing to the target database of a fake hook
+    """
+    def make(hook, properties, cloning=False):
+        return deploy_changes.DeployChanges(target_database=TARGET_DATABASE, cloning=cloning, properties=properties,
+                                            connection_pool=SnowflakeConnectionPool.from_properties(hook, properties))
+    return make
+
+
+def history(backend):
+    """
+    :return: status by change id of the history table of the target database
+    """
+    return dict(backend.execute(f'SELECT id, status FROM {HISTORY_TABLE}'))
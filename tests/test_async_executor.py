@@ -0,0 +1,147 @@
+import time
+
+import pytest
+from snowflake.connector.errors import ProgrammingError
+
+from core import async_executor
+from core.async_executor import AsyncStatementExecutor
+from core.scheduler import ChangeSetNode, build_change_set_graph
+from hooks.fake_snowflake_hook import FakeSnowflakeConnection
+
+
+def nodes_of(*changes):
+    """
+    :param changes: (id, depends) pairs in manifest order, depends None for a changeset without --depends:
+    """
+    return build_change_set_graph([ChangeSetNode(id, 'changelog.xml', None, {'id': id, 'depends': depends})
+                                   for id, depends in changes])
+
+
+def statements(count):
+    """
+    :return: prepare callable returning count statements per changeset
+    """
+    return lambda node: [f"SELECT '{node.id}-{i}'" for i in range(count)]
+
+
+def ids(nodes):
+    return [node.id for node in nodes]
+
+
+def run(conn, nodes, prepare, **kwargs):
+    completed = []
+    executor = AsyncStatementExecutor(conn, min_poll_interval=0.001, max_poll_interval=0.01, **kwargs)
+    report = executor.run(nodes, prepare, lambda node, result: completed.append(node.id))
+    return executor, report, completed
+
+
+def test_statements_run_in_dependency_order():
+    conn = FakeSnowflakeConnection(query_duration=0.02)
+    nodes = nodes_of(('a', ()), ('b', ('a',)), ('c', ()), ('d', ('b', 'c')))
+    executor, report, completed = run(conn, nodes, statements(2))
+    submitted = conn.executed_sql
+    position = {sql.split("'")[1]: i for i, sql in enumerate(submitted)}
+    assert len(submitted) == 8 and not report.failed
+    # the statements of a changeset run in order, its dependants start once its last statement completed
+    assert all(position[f'{id}-0'] < position[f'{id}-1'] for id in 'abcd')
+    assert position['a-1'] < position['b-0']
+    assert max(position['b-1'], position['c-1']) < position['d-0']
+    # independent changesets are in flight together
+    assert position['c-0'] < position['a-1']
+    assert completed.index('a') < completed.index('b') < completed.index('d')
+    assert {id: result.statements for id, result in executor.results.items()} == dict.fromkeys('abcd', 2)
+
+
+@pytest.mark.parametrize('max_in_flight, expected', [(1, 1), (2, 2), (8, 6)])
+def test_queries_in_flight_are_bounded(max_in_flight, expected):
+    conn = FakeSnowflakeConnection(query_duration=0.02)
+    nodes = nodes_of(*((f'c{i}', ()) for i in range(6)))
+    _, report, _ = run(conn, nodes, statements(2), max_in_flight=max_in_flight)
+    assert len(report.succeeded) == 6
+    assert report.max_in_flight == expected
+    assert conn.max_running == expected
+
+
+def test_the_poll_interval_resets_when_a_statement_completes(monkeypatch):
+    sleeps = []
+    sleep = time.sleep
+
+    def recording_sleep(seconds):
+        sleeps.append(seconds)
+        sleep(seconds)
+
+    monkeypatch.setattr(async_executor.time, 'sleep', recording_sleep)
+    conn = FakeSnowflakeConnection(query_duration=0.05)
+    executor = AsyncStatementExecutor(conn, min_poll_interval=0.005, max_poll_interval=0.02, poll_backoff=2)
+    report = executor.run(nodes_of(('a', ())), statements(3), lambda node, result: None)
+    assert report.succeeded and executor.results['a'].statements == 3
+    # the interval grows while the query runs, up to max_poll_interval
+    assert max(sleeps) == 0.02
+    assert all(later in (0.005, min(earlier * 2, 0.02)) for earlier, later in zip(sleeps, sleeps[1:]))
+    # and starts over for each statement of the changeset, not only when the changeset finishes
+    assert sleeps.count(0.005) == 3
+
+
+@pytest.mark.parametrize('halt_on_fail, succeeded, skipped', [(True, ['a'], ['c', 'd']),
+                                                               (False, ['a', 'd'], ['c'])])
+@pytest.mark.parametrize('fails_in', ['statement', 'prepare'])
+def test_a_failure_halts_or_skips_dependants(halt_on_fail, succeeded, skipped, fails_in):
+    conn = FakeSnowflakeConnection(failures=[r"'b-1'"] if fails_in == 'statement' else [])
+    prepare = statements(2)
+    if fails_in == 'prepare':
+        def prepare(node, prepare=prepare):
+            if node.id == 'b':
+                raise ProgrammingError(msg='upload failed')
+            return prepare(node)
+    nodes = nodes_of(('a', ()), ('b', ()), ('c', ('b',)), ('d', ()))
+    executor, report, completed = run(conn, nodes, prepare, max_in_flight=1, halt_on_fail=halt_on_fail)
+    assert (ids(report.succeeded), ids(report.failed), ids(report.skipped)) == (succeeded, ['b'], skipped)
+    assert completed == ['a', 'b'] + succeeded[1:]
+    failed = executor.results['b']
+    assert not failed.ok and isinstance(failed.error, ProgrammingError)
+    # the statement before the failed one completed, nothing of c ran
+    assert failed.statements == (1 if fails_in == 'statement' else 0)
+    assert not any("'c-" in sql for sql in conn.executed_sql)
+
+
+def test_the_session_is_restored_after_a_changeset_changing_it():
+    conn = FakeSnowflakeConnection(query_duration=0.01)
+    restored = []
+
+    def restore_session():
+        restored.append(len(conn.executed_sql))
+        conn.cursor().execute('USE DATABASE TEST')
+
+    def prepare(node):
+        if node.id == 'a':
+            return ['USE SCHEMA OTHER', "SELECT 'a-0'"]
+        return statements(2)(node)
+
+    nodes = nodes_of(('a', ()), ('b', ()), ('c', ()))
+    executor = AsyncStatementExecutor(conn, min_poll_interval=0.001, max_poll_interval=0.01)
+    report = executor.run(nodes, prepare, lambda node, result: None, restore_session=restore_session)
+    assert len(report.succeeded) == 3
+    submitted = conn.executed_sql
+    # the changeset changing the session ran alone, the plain ones after it run in the release database again
+    assert submitted[:3] == ['USE SCHEMA OTHER', "SELECT 'a-0'", 'USE DATABASE TEST']
+    assert restored == [2]
+    assert sorted(submitted[3:]) == ["SELECT 'b-0'", "SELECT 'b-1'", "SELECT 'c-0'", "SELECT 'c-1'"]
+
+
+def test_a_prepared_changeset_waiting_to_run_alone_is_skipped_when_the_release_halts():
+    conn = FakeSnowflakeConnection(failures=[r"'a-0'"], query_duration=0.01)
+    prepared = []
+    completed = {}
+
+    def prepare(node):
+        prepared.append(node.id)
+        return ['USE SCHEMA OTHER', f"SELECT '{node.id}-0'"] if node.id == 'b' else statements(1)(node)
+
+    nodes = nodes_of(('a', ()), ('b', ()), ('c', ('b',)))
+    executor = AsyncStatementExecutor(conn, min_poll_interval=0.001, max_poll_interval=0.01, halt_on_fail=True)
+    report = executor.run(nodes, prepare, lambda node, result: completed.setdefault(node.id, result))
+    assert (ids(report.failed), ids(report.skipped)) == (['a'], ['b', 'c'])
+    assert prepared == ['a', 'b']
+    # b was prepared, its history record is completed as skipped, none of its statements ran
+    assert completed['b'].skipped and completed['b'].statements == 0 and executor.results['b'] is completed['b']
+    assert conn.executed_sql == ["SELECT 'a-0'"]
@@ -0,0 +1,145 @@
+from pathlib import Path
+import csv
+import gzip
+import io
+
+import pytest
+
+from conftest import TARGET_DATABASE, history
+from operators.bulk_load import BulkLoader
+from operators.manifest_reader import LoadFile
+
+TABLE = f'{TARGET_DATABASE}.PUBLIC.seed'
+# chunk_mb of about 100 bytes, every file is split into many chunks
+CHUNK_MB = 100 / 1024 / 1024
+QUOTED = {'field_optionally_enclosed_by': '"'}
+ESCAPED = {'field_optionally_enclosed_by': '"', 'escape': '\\'}
+
+
+def quoted_rows(rows):
+    """
+    Records with quoted delimiters, doubled quotes and newlines
+    """
+    lines = []
+    for i in range(rows):
+        label = f'"row {i}, ""quoted""\nsecond line"' if i % 3 == 0 else f'row {i}'
+        lines.append(f'{i},{label}\n')
+    return ''.join(lines)
+
+
+def escaped_rows(rows):
+    """
+    Records with quotes escaped by a backslash, a backslash escaped before a closing quote and newlines
+    """
+    lines = []
+    for i in range(rows):
+        if i % 3 == 0:
+            label = f'"row {i} \\"quoted\\",\nsecond line\\\\"'
+        elif i % 3 == 1:
+            label = f'"ends with a quote \\""'
+        else:
+            label = f'row {i}'
+        lines.append(f'{i},{label}\n')
+    return ''.join(lines)
+
+
+def records(data: bytes, options):
+    dialect = {'quotechar': '"', 'doublequote': 'escape' not in options, 'escapechar': options.get('escape')}
+    return list(csv.reader(io.StringIO(data.decode('utf-8'), newline=''), **dialect))
+
+
+def write(path, content, header_lines=0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # skip_header counts lines like Snowflake does, a header line never holds a quoted newline
+    header = ''.join(f'id,"header {i}, with ""a quote"""\n' for i in range(header_lines))
+    path.write_bytes((header + content).encode('utf-8'))
+    return path
+
+
+def load_file(path, options, skip_header=0):
+    return LoadFile(file=path.name, path=path,
+                    attributes=dict(options, table=TABLE, id='seed-rows', author='test', skip_header=str(skip_header)))
+
+
+@pytest.mark.parametrize('options, content', [(QUOTED, quoted_rows(40)), (ESCAPED, escaped_rows(40))],
+                         ids=['doubled quotes', 'escaped quotes'])
+@pytest.mark.parametrize('skip_header', [0, 1, 3])
+def test_chunks_end_at_record_boundaries(tmp_path, options, content, skip_header):
+    path = write(tmp_path / 'rows.csv', content, header_lines=skip_header)
+    loader = BulkLoader(chunk_mb=CHUNK_MB)
+    ranges = loader._chunk_ranges(path, skip_header, b'"', options.get('escape', '').encode() or None)
+    data = path.read_bytes()
+    assert len(ranges) > 5
+    # the header lines are never part of a chunk, however many chunks they span
+    assert data[ranges[0][0]:] == content.encode('utf-8')
+    assert all(end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+    assert ranges[-1][1] == len(data)
+    chunked = [record for start, end in ranges for record in records(data[start:end], options)]
+    assert chunked == records(content.encode('utf-8'), options)
+
+
+@pytest.mark.parametrize('options', [QUOTED, ESCAPED, dict(ESCAPED, escape_unenclosed_field='^')],
+                         ids=['doubled quotes', 'escaped quotes', 'two escapes'])
+def test_prepared_chunks_hold_the_records_of_every_file(tmp_path, options):
+    directory = tmp_path / 'seed'
+    content = escaped_rows(30) if 'escape' in options else quoted_rows(30)
+    for name in ('a', 'b'):
+        write(directory / f'{name}.csv', content, header_lines=2)
+    loader = BulkLoader(chunk_mb=CHUNK_MB, workers=2)
+    (tmp_path / 'work').mkdir()
+    chunks = loader.prepare(load_file(directory, options, skip_header=2), tmp_path / 'work')
+    prepared = sorted((tmp_path / 'work').iterdir())
+    assert len(prepared) == chunks
+    if 'escape_unenclosed_field' in options:
+        # the files are not split, their header lines are still skipped
+        assert [path.name for path in prepared] == ['a_00000.csv.gz', 'b_00000.csv.gz']
+    else:
+        assert chunks > 4
+    loaded = [record for path in prepared for record in records(gzip.decompress(path.read_bytes()), options)]
+    assert loaded == records(content.encode('utf-8'), options) * 2
+
+
+def test_a_rerun_prepares_identical_files(tmp_path):
+    source = load_file(write(tmp_path / 'rows.csv', quoted_rows(50), header_lines=1), QUOTED, skip_header=1)
+    prepared = []
+    for run in ('first', 'second'):
+        (tmp_path / run).mkdir()
+        BulkLoader(chunk_mb=CHUNK_MB, workers=3).prepare(source, tmp_path / run)
+        prepared.append({path.name: path.read_bytes() for path in (tmp_path / run).iterdir()})
+    assert len(prepared[0]) > 5
+    assert prepared[0] == prepared[1]
+
+
+@pytest.mark.parametrize('purge', [True, False])
+def test_copy_skips_the_files_it_already_loaded(tmp_path, fake_hook, purge):
+    backend = fake_hook().backend
+    backend.execute(f'CREATE TABLE {TABLE} (id int, label varchar(100))')
+    source = load_file(write(tmp_path / 'rows.csv', quoted_rows(30), header_lines=1), QUOTED, skip_header=1)
+    loader = BulkLoader(chunk_mb=CHUNK_MB, purge=purge)
+
+    loaded = []
+    for _ in range(2):
+        # a retried load prepares and uploads the same files again
+        with loader.prepared(source, 'seed-rows') as (put_statement, copy_statement):
+            backend.execute(put_statement)
+        loaded.append(len([row for row in backend.execute(copy_statement) if row[1:2] == ('LOADED',)]))
+    assert loaded[0] > 5 and loaded[1] == 0
+    assert backend.execute(f'SELECT COUNT(*) FROM {TABLE}') == [(30,)]
+
+
+def test_a_copy_whose_response_was_lost_loads_the_rows_once(tmp_path, fake_hook, release_properties, deployer):
+    properties = release_properties(change_logs=1, files=1, statements=0,
+                                    bulk_load={'chunk_mb': CHUNK_MB, 'work_directory': str(tmp_path / 'work')})
+    write(Path(properties['root_sql_directory'], 'seed', 'rows.csv'), quoted_rows(30), header_lines=1)
+    change_log = Path(properties['change_log_directory'], 'changelog_0.xml')
+    change_log.write_text(change_log.read_text().replace(
+        '</databaseChangeLog>', '  <include file="seed/rows.csv" type="load" table="bench_0_0" id="seed-rows" '
+                                'author="test" skip_header="1" field_optionally_enclosed_by=\'"\'/>\n'
+                                '</databaseChangeLog>'))
+    # the COPY runs and its response is lost, it is retried and loads nothing twice
+    hook = fake_hook(transient_errors=[[r'^COPY INTO', 250003, 1, True]])
+    release = deployer(hook, properties)
+    assert not release.run_release().failed
+    assert release.retry_stats.recovered == 1
+    assert hook.backend.execute(f'SELECT COUNT(*) FROM {TARGET_DATABASE}.PUBLIC.bench_0_0') == [(30,)]
+    assert history(hook.backend)['seed-rows'] == 'success'
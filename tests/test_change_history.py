@@ -0,0 +1,56 @@
+import datetime
+
+import pytest
+
+from operators.change_history import HISTORY_COLUMNS, ChangeHistory, ChangeRecord
+
+JANUARY = datetime.datetime(2024, 1, 1)
+FEBRUARY = datetime.datetime(2024, 2, 1)
+
+
+def row(id, status='success', date_released=JANUARY, filename=None, change_log='changelog.xml'):
+    return (id, 'author', filename or f'{id}.sql', date_released, change_log, None, None, None, None, status, None)
+
+
+def test_rows_are_indexed_by_id_and_filename():
+    change_history = ChangeHistory([row('a'), ChangeRecord(*row('b', status='failed', change_log='other.xml'))])
+    assert len(change_history) == 2 and 'a' in change_history and 'c' not in change_history
+    assert change_history.get('a') == ChangeRecord(*row('a'))
+    assert change_history.get_by_filename('b.sql').id == 'b'
+    assert change_history.get('c') is None and change_history.get_by_filename('c.sql') is None
+    assert change_history.change_logs == {'changelog.xml', 'other.xml'}
+    assert {record.id for record in change_history} == {'a', 'b'}
+    assert HISTORY_COLUMNS[0] == 'id' and len(HISTORY_COLUMNS) == len(row('a'))
+
+
+@pytest.mark.parametrize('id, status, released', [('a', 'success', True), ('b', 'failed', False),
+                                                  ('c', None, False)])
+def test_status_and_is_released(id, status, released):
+    change_history = ChangeHistory([row('a'), row('b', status='failed')])
+    assert change_history.status(id) == status
+    assert change_history.is_released(id) == released
+
+
+@pytest.mark.parametrize('rows, status', [
+    # the latest release of a change wins, whatever the order of the rows
+    ([row('a', 'failed', JANUARY), row('a', 'success', FEBRUARY)], 'success'),
+    ([row('a', 'success', FEBRUARY), row('a', 'failed', JANUARY)], 'success'),
+    ([row('a', 'success', JANUARY), row('a', 'failed', FEBRUARY)], 'failed'),
+    # without a release date, or with dates that do not compare, the later row wins
+    ([row('a', 'failed', None), row('a', 'success', JANUARY)], 'success'),
+    ([row('a', 'failed', '2024-01-01'), row('a', 'success', JANUARY)], 'success'),
+])
+def test_the_latest_record_of_a_change_is_held(rows, status):
+    change_history = ChangeHistory(rows)
+    assert len(change_history) == 1
+    assert change_history.status('a') == status
+    assert change_history.get_by_filename('a.sql').status == status
+
+
+def test_add_returns_the_record_held():
+    change_history = ChangeHistory([row('a', 'success', FEBRUARY)])
+    assert change_history.add(row('a', 'failed', JANUARY)).status == 'success'
+    assert change_history.add(row('a', 'failed', FEBRUARY)).status == 'failed'
+    # a change moved to another file is found under its new filename
+    change_history.add(row('a', date_released=FEBRUARY, filename='moved.sql'))
+    assert change_history.get_by_filename('moved.sql').id == 'a'
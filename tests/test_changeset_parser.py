@@ -0,0 +1,115 @@
+import pytest
+
+from benchmarks.bench_changeset_parser import split_parse
+from operators.changeset_parser import ChangeSet, parse_attributes, parse_file, parse_header
+from operators.manifest_reader import ChangeFile
+
+HEADER = '--liquibase formatted sql\n\n--changeset jdoe:change-1 context:r1\n--comment: seeds the table\n' \
+         '--labels: JIRA-1\n'
+BODY = "INSERT INTO t VALUES (1, '--comment: not a header');\n--labels: JIRA-9\nINSERT INTO t VALUES (2);\n"
+
+
+def write(tmp_path, content, name='change.sql', encoding='utf-8'):
+    path = tmp_path / name
+    path.write_bytes(content.encode(encoding))
+    return path
+
+
+@pytest.mark.parametrize('lines, expected', [
+    ([], ChangeSet()),
+    (['--liquibase formatted sql', 'SELECT 1;'], ChangeSet()),
+    (['--changeset jdoe:c1'], ChangeSet(author='jdoe', id='c1')),
+    (['', '   ', '--changeset jdoe:c1', '', '--comment: first', '', '--comment: second'],
+     ChangeSet(author='jdoe', id='c1', comments='first second')),
+    (['-- changeset jdoe:c1 context:"r 1" runOnChange:true', '--  LABELS : JIRA-1, JIRA-2 JIRA-3'],
+     ChangeSet(author='jdoe', id='c1', context='r 1', labels=('JIRA-1', 'JIRA-2', 'JIRA-3'),
+               attributes=(('runOnChange', 'true'),))),
+    (['--changeset jdoe:c1', '--comment:', '--labels:'], ChangeSet(author='jdoe', id='c1')),
+    # the header ends at the first SQL line, comment lines after it are SQL comments
+    (['--changeset jdoe:c1', 'SELECT 1;', '--comment: in the body', '--changeset other:c2'],
+     ChangeSet(author='jdoe', id='c1')),
+    (['  --changeset jdoe:c1  ', '\t--comment: indented\t'], ChangeSet(author='jdoe', id='c1', comments='indented')),
+    (['--changeset jdoe:c1\r\n', '--comment: crlf\r\n', '\r\n', 'SELECT 1;\r\n'],
+     ChangeSet(author='jdoe', id='c1', comments='crlf')),
+    (['--changeset jdoe:c1', '--comment: café ☕ 日本'],
+     ChangeSet(author='jdoe', id='c1', comments='café ☕ 日本')),
+])
+def test_parse_header_examples(lines, expected):
+    assert parse_header(lines) == expected
+
+
+@pytest.mark.parametrize('depends, expected', [
+    (None, None),
+    ('--depends:', ()),
+    ('--depends:    ', ()),
+    ('--depends: , ,', ()),
+    ('--depends: a', ('a',)),
+    ('--depends: a, b  c', ('a', 'b', 'c')),
+    ('--depends: a, b, a, b', ('a', 'b')),
+])
+def test_parse_depends_examples(depends, expected):
+    lines = ['--changeset jdoe:c1'] + ([depends] if depends is not None else [])
+    changeset = parse_header(lines)
+    assert changeset.depends == expected
+    assert changeset.to_change_details().get('depends') == (list(expected) if expected is not None else None)
+
+
+def test_depends_lines_are_combined():
+    assert parse_header(['--changeset jdoe:c1', '--depends: a', '--depends: b, a']).depends == ('a', 'b')
+
+
+def test_parse_attributes_of_a_load_include():
+    changeset = parse_attributes({'id': 'seed-1', 'author': 'jdoe', 'labels': 'JIRA-1 JIRA-2', 'depends': ''})
+    assert changeset == ChangeSet(author='jdoe', id='seed-1', labels=('JIRA-1', 'JIRA-2'), depends=())
+
+
+@pytest.mark.parametrize('encoding, newline', [('utf-8', '\n'), ('utf-8', '\r\n'), ('utf-8-sig', '\n'),
+                                               ('utf-8-sig', '\r\n')])
+def test_change_files_with_bom_and_crlf(tmp_path, encoding, newline):
+    content = (HEADER + '--comment: déjà vu\n\n' + BODY).replace('\n', newline)
+    path = write(tmp_path, content, encoding=encoding)
+    expected = ChangeSet(author='jdoe', id='change-1', context='r1', labels=('JIRA-1',),
+                         comments='seeds the table déjà vu')
+    change_file = ChangeFile('change.sql', path)
+    assert parse_file(path) == change_file.changeset == expected
+    assert change_file.read_sql() == BODY.replace('\n', newline)
+    with change_file.open_sql() as sql:
+        assert sql.read() == BODY.replace('\n', newline)
+    change_file.checksum = None
+    assert change_file.compute_checksum() == ChangeFile('change.sql', path).compute_checksum()
+
+
+def test_a_header_without_a_body(tmp_path):
+    path = write(tmp_path, HEADER.rstrip('\n'))
+    change_file = ChangeFile('change.sql', path)
+    assert change_file.changeset.id == 'change-1'
+    assert change_file.read_sql() == ''
+    with change_file.open_sql() as sql:
+        assert sql.read() == ''
+
+
+def test_an_empty_file(tmp_path):
+    change_file = ChangeFile('change.sql', write(tmp_path, ''))
+    assert change_file.changeset == ChangeSet()
+    assert change_file.read_sql() == ''
+
+
+@pytest.mark.parametrize('header', [
+    '--liquibase formatted sql\n\n--changeset jdoe:change-1 context:r1\n--comment: seeds\n--labels: JIRA-1\n',
+    '--changeset jdoe:change-2 context:r2\n--labels: JIRA-2\n',
+    '\n\n--liquibase formatted sql\n--changeset a.b:c-3 context:release_3\n--comment: one-word\n',
+    '--changeset jdoe:change-4 context:r4\r\n--comment: crlf\r\n--labels: JIRA-4\r\n',
+])
+def test_parity_with_the_line_scanning_parser(tmp_path, header):
+    # headers in the form the line scanning parser understood, its SQL body has none of its false matches
+    path = write(tmp_path, header + 'SELECT 1;\n')
+    details = parse_file(path).to_change_details()
+    baseline = split_parse(path)
+    assert {name: details[name] for name in baseline} == baseline
+    assert all(details[name] is None for name in details if name not in baseline)
+
+
+def test_the_body_is_never_parsed_unlike_the_line_scanning_parser(tmp_path):
+    path = write(tmp_path, HEADER + BODY)
+    assert split_parse(path)['jira_number'] == 'JIRA-9'
+    assert parse_file(path).labels == ('JIRA-1',)
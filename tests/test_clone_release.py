@@ -0,0 +1,162 @@
+from pathlib import Path
+
+import pytest
+
+from conftest import TARGET_DATABASE, history
+from core import deploy_changes
+from operators.clone_release import CLONE_PHASES, clone_prefix, expired_databases
+
+BREAKING_CHANGE = '--liquibase formatted sql\n\n--changeset test:drop-existing\nDROP TABLE existing;\n'
+
+
+def tables_of(backend, database):
+    rows = backend.execute(f"SELECT table_schema, table_name, table_type FROM {database}.INFORMATION_SCHEMA.TABLES "
+                           f"WHERE table_schema <> 'INFORMATION_SCHEMA'")
+    return {name.upper() for schema, name, _ in rows if schema == 'PUBLIC'}
+
+
+def clones_of(backend):
+    return [database for database in backend.list_databases() if database.startswith(clone_prefix(TARGET_DATABASE))]
+
+
+@pytest.fixture
+def target(fake_hook):
+    """
+    Fake account whose target holds a table with rows and a view reading it
+    """
+    def make(**kwargs):
+        hook = fake_hook(**kwargs)
+        hook.backend.execute(f'CREATE TABLE {TARGET_DATABASE}.PUBLIC.existing (id int, label varchar(100))')
+        hook.backend.execute(f"INSERT INTO {TARGET_DATABASE}.PUBLIC.existing VALUES (1, 'a'), (2, 'b'), (3, 'c')")
+        hook.backend.execute(f'CREATE VIEW {TARGET_DATABASE}.PUBLIC.existing_v AS SELECT id FROM '
+                             f'{TARGET_DATABASE}.PUBLIC.existing')
+        return hook
+    return make
+
+
+def add_change(properties, name, sql):
+    """
+    Appends a change log holding one SQL file to the release
+    """
+    Path(properties['change_log_directory'], f'changelog_{name}.xml').write_text(
+        f'<databaseChangeLog>\n  <include file="{name}/change.sql"/>\n</databaseChangeLog>\n')
+    Path(properties['root_sql_directory'], name).mkdir()
+    Path(properties['root_sql_directory'], name, 'change.sql').write_text(sql)
+    master = Path(properties['change_log_directory'], properties['master_change_log_name'])
+    master.write_text(master.read_text().replace('</databaseChangeLog>',
+                                                 f'  <include file="changelog_{name}.xml"/>\n</databaseChangeLog>'))
+
+
+@pytest.mark.parametrize('status, retain, expected', [
+    ('backup', 1, ['T_CLONE_20240101_BACKUP', 'T_CLONE_20230101_BACKUP']),
+    ('backup', 0, ['T_CLONE_20250101_BACKUP', 'T_CLONE_20240101_BACKUP', 'T_CLONE_20230101_BACKUP']),
+    ('backup', 5, []),
+    ('failed', 0, ['T_CLONE_20240601_FAILED']),
+])
+def test_expired_databases(status, retain, expected):
+    databases = ['T_CLONE_20230101_BACKUP', 'T_CLONE_20250101_BACKUP', 'T_CLONE_20240101_BACKUP',
+                 'T_CLONE_20240601_FAILED', 'T_CLONE_20240701', 'OTHER_CLONE_20200101_BACKUP', 'T']
+    assert expired_databases(databases, 'T', status, retain) == expected
+
+
+@pytest.mark.parametrize('mode', ['threads', 'async'])
+def test_a_validated_clone_is_swapped(target, release_properties, deployer, mode):
+    hook = target()
+    release = deployer(hook, release_properties(change_logs=2, files=2, execution_mode=mode), cloning=True)
+    report = release.run_release()
+    clone_release = release.clone_release
+    assert not report.failed and clone_release.swapped and clone_release.error is None
+    assert list(clone_release.phases) == list(CLONE_PHASES)
+    # every view compiled and every table counted, in the clone and in the target
+    assert {check.name for check in clone_release.checks} >= {'PUBLIC.EXISTING', 'PUBLIC.EXISTING_V'}
+    assert not clone_release.failed_checks
+    assert {'BENCH_0_0', 'BENCH_1_1', 'EXISTING'} <= tables_of(hook.backend, TARGET_DATABASE)
+    # the backup holds the target as it was before the release
+    assert clone_release.kept.endswith('_BACKUP')
+    assert tables_of(hook.backend, clone_release.kept) == {'EXISTING', 'EXISTING_V'}
+    assert set(history(hook.backend).values()) == {'success'}
+
+
+def test_a_failed_changeset_is_not_validated_or_swapped(target, release_properties, deployer):
+    deploy_changes.halt_release_on_fail = False
+    hook = target(failures=[r'^INSERT INTO bench_0_1 '])
+    release = deployer(hook, release_properties(change_logs=1, files=2), cloning=True)
+    release.run_release()
+    clone_release = release.clone_release
+    assert not clone_release.swapped
+    assert 'validate' not in clone_release.phases and 'swap' not in clone_release.phases
+    assert clone_release.kept.endswith('_FAILED') and clones_of(hook.backend) == [clone_release.kept]
+    assert tables_of(hook.backend, TARGET_DATABASE) == {'EXISTING', 'EXISTING_V'}
+
+
+def test_a_clone_failing_validation_is_not_swapped(target, release_properties, deployer):
+    properties = release_properties(change_logs=1, files=1)
+    add_change(properties, 'break', BREAKING_CHANGE)
+    hook = target()
+    release = deployer(hook, properties, cloning=True)
+    assert not release.run_release().failed
+    clone_release = release.clone_release
+    assert [check.name for check in clone_release.failed_checks] == ['PUBLIC.EXISTING_V']
+    assert not clone_release.swapped and 'swap' not in clone_release.phases
+    assert clone_release.kept.endswith('_FAILED')
+    assert tables_of(hook.backend, TARGET_DATABASE) == {'EXISTING', 'EXISTING_V'}
+
+
+@pytest.mark.parametrize('clone_properties, failed_check', [
+    ({'validation_queries': ['SELECT id FROM PUBLIC.existing WHERE id > 2']},
+     'SELECT id FROM PUBLIC.existing WHERE id > 2'),
+    ({'max_row_loss': 0.1}, 'PUBLIC.EXISTING'),
+    ({'max_row_loss': 0.5}, None),
+])
+def test_validation_queries_and_row_loss(target, release_properties, deployer, clone_properties, failed_check):
+    properties = release_properties(change_logs=1, files=1, clone_release=clone_properties)
+    add_change(properties, 'delete', '--liquibase formatted sql\n\n--changeset test:delete-one\n'
+                                     'DELETE FROM existing WHERE id = 1;\n')
+    release = deployer(target(), properties, cloning=True)
+    release.run_release()
+    assert [check.name for check in release.clone_release.failed_checks] == ([failed_check] if failed_check else [])
+    assert release.clone_release.swapped == (failed_check is None)
+
+
+def test_a_failed_swap_keeps_the_target_and_cleans_up(target, release_properties, deployer):
+    hook = target(failures=[r'^ALTER DATABASE \S+ SWAP WITH '])
+    release = deployer(hook, release_properties(change_logs=1, files=1), cloning=True)
+    assert not release.run_release().failed
+    clone_release = release.clone_release
+    assert not clone_release.swapped and clone_release.error
+    assert clone_release.kept.endswith('_FAILED') and 'cleanup' in clone_release.phases
+    assert tables_of(hook.backend, TARGET_DATABASE) == {'EXISTING', 'EXISTING_V'}
+    assert clone_release.error in clone_release.summary()
+
+
+@pytest.mark.parametrize('retain_backups', [0, 1, 2])
+def test_backups_past_their_retention_are_dropped(target, release_properties, deployer, retain_backups):
+    hook = target()
+    properties = release_properties(change_logs=1, files=1, clone_release={'retain_backups': retain_backups})
+    kept = []
+    for _ in range(3):
+        release = deployer(hook, properties, cloning=True)
+        release.run_release()
+        assert release.clone_release.swapped
+        kept.append(release.clone_release.kept)
+    backups = clones_of(hook.backend)
+    assert len(backups) == retain_backups and all(backup.endswith('_BACKUP') for backup in backups)
+    # the most recent backups are kept
+    assert sorted(backups) == sorted(name for name in kept if name)[len(kept) - retain_backups:]
+    assert (kept[-1] is None) == (retain_backups == 0)
+
+
+def test_a_clone_whose_release_raised_is_marked_failed(target, release_properties, deployer, monkeypatch):
+    hook = target()
+    release = deployer(hook, release_properties(change_logs=1, files=1), cloning=True)
+
+    def run_change_sets(nodes):
+        raise RuntimeError('scheduler crashed')
+
+    monkeypatch.setattr(release, '_run_change_sets', run_change_sets)
+    with pytest.raises(RuntimeError, match='scheduler crashed'):
+        release.run_release()
+    clone_release = release.clone_release
+    assert not clone_release.swapped and clone_release.error == 'RuntimeError: scheduler crashed'
+    assert clone_release.kept == f'{clone_release.clone}_FAILED' and clones_of(hook.backend) == [clone_release.kept]
+    assert tables_of(hook.backend, TARGET_DATABASE) == {'EXISTING', 'EXISTING_V'}
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from conftest import TARGET_DATABASE
+from hooks.connection_pool import SnowflakeConnectionPool
+from operators.snowflake_operator import SnowflakeOperator
+
+
+@pytest.mark.parametrize('properties, max_size', [
+    ({}, 2),
+    ({'parallel_workers': 4}, 5),
+    ({'parallel_workers': 4, 'connection_pool': {'max_size': None}}, 5),
+    ({'parallel_workers': 4, 'connection_pool': {'max_size': 3}}, 3),
+])
+def test_max_size_defaults_to_a_connection_per_worker_and_one(properties, max_size):
+    # the sizes are read and checked before a connection is opened, no hook is needed
+    assert SnowflakeConnectionPool.from_properties(None, properties).max_size == max_size
+
+
+def test_invalid_sizes_are_rejected():
+    with pytest.raises(ValueError):
+        SnowflakeConnectionPool(None, min_size=3, max_size=2)
+
+
+def test_connections_are_reused_and_bounded(fake_hook):
+    pool = SnowflakeConnectionPool(fake_hook(), max_size=2, health_check=False)
+    first, second = pool.acquire(), pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire(timeout=0.05)
+    pool.release(first)
+    assert pool.acquire(timeout=0.05) is first
+    assert (pool.stats.created, pool.stats.hits, pool.stats.waits) == (2, 1, 1)
+    pool.release(second)
+    pool.close()
+
+
+def test_workers_are_lowered_to_the_pool_size(fake_hook, release_properties, deployer):
+    properties = release_properties(parallel_workers=4, connection_pool={'max_size': 3})
+    assert deployer(fake_hook(), properties).parallel_workers == 2
+
+
+def test_min_size_connections_are_opened_with_the_pool(fake_hook):
+    hook = fake_hook()
+    pool = SnowflakeConnectionPool(hook, min_size=2, max_size=3, health_check=False)
+    assert len(hook.connections) == pool.stats.created == 2
+    assert pool.acquire() in hook.connections and pool.stats.hits == 1
+    pool.close()
+
+
+def test_idle_connections_are_closed_without_another_release(fake_hook):
+    hook = fake_hook()
+    pool = SnowflakeConnectionPool(hook, min_size=1, max_size=3, idle_timeout=0.05, health_check=False)
+    borrowed = [pool.acquire() for _ in range(3)]
+    for conn in borrowed:
+        pool.release(conn)
+    time.sleep(0.3)
+    # nothing is borrowed or returned, the connections above min_size are closed once idle for idle_timeout
+    assert [conn.is_closed() for conn in hook.connections].count(True) == pool.stats.closed == 2
+    pool.close()
+
+
+@pytest.mark.parametrize('statement, changed', [
+    ('USE SCHEMA PUBLIC', True),
+    ('use role SYSADMIN', True),
+    ("ALTER SESSION SET QUERY_TAG = 'release'", True),
+    ('CREATE TABLE t (id int)', False),
+])
+def test_a_connection_whose_session_was_changed_is_not_reused(fake_hook, statement, changed):
+    hook = fake_hook()
+    pool = SnowflakeConnectionPool(hook, max_size=2, health_check=False)
+    operator = SnowflakeOperator(conn=pool.acquire(), target_database=TARGET_DATABASE,
+                                 history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE')
+    operator.use_database(TARGET_DATABASE)
+    operator._execute_statements([statement], [], changeset='c1')
+    assert operator.session_changed == changed
+    pool.release(operator.conn, session_changed=operator.session_changed)
+    assert operator.conn.is_closed() == changed
+    assert (pool.acquire() is operator.conn) != changed
+    pool.close()
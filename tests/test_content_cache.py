@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import logging
+import os
+
+import pytest
+
+from conftest import HISTORY_TABLE, history
+from operators.content_cache import CACHE_VERSION, ContentCache, content_checksum
+
+
+@pytest.fixture
+def cached_file(tmp_path):
+    path = tmp_path / 'change.sql'
+    path.write_text('SELECT 1;\n')
+    cache = ContentCache(cache_file=tmp_path / 'content_cache.json')
+    cache.update(path, id='c0', checksum=content_checksum(path.read_bytes()))
+    return cache, path
+
+
+def test_content_checksum_is_blake2b_of_the_utf8_content():
+    expected = hashlib.blake2b('SELECT \'café\';'.encode('utf-8'), digest_size=16).hexdigest()
+    assert content_checksum('SELECT \'café\';') == content_checksum('SELECT \'café\';'.encode('utf-8')) == expected
+    assert content_checksum('SELECT 1;') != content_checksum('SELECT 2;')
+
+
+def test_an_unchanged_file_is_a_hit(cached_file):
+    cache, path = cached_file
+    assert cache.lookup(path) == {'id': 'c0', 'checksum': content_checksum('SELECT 1;\n')}
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+@pytest.mark.parametrize('change', [
+    lambda path: path.write_text('SELECT 10;\n'),
+    # the same size, only the modification time changes
+    lambda path: os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 1_000_000)),
+    lambda path: path.unlink(),
+], ids=['size', 'mtime', 'deleted'])
+def test_a_changed_file_is_a_miss(cached_file, change):
+    cache, path = cached_file
+    change(path)
+    assert cache.lookup(path) is None
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_an_uncached_file_is_a_miss(cached_file, tmp_path):
+    cache, _ = cached_file
+    other = tmp_path / 'other.sql'
+    other.write_text('SELECT 1;\n')
+    assert cache.lookup(other) is None and cache.misses == 1
+
+
+def test_lookups_from_threads_are_all_counted(cached_file, tmp_path):
+    cache, path = cached_file
+    missing = tmp_path / 'missing.sql'
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda i: cache.lookup(path if i % 2 else missing), range(4000)))
+    assert (cache.hits, cache.misses) == (2000, 2000)
+
+
+def test_the_cache_is_saved_and_loaded(cached_file, tmp_path):
+    cache, path = cached_file
+    cache.save()
+    assert ContentCache(cache_file=cache.cache_file).lookup(path)['id'] == 'c0'
+    # a cache of another version or an unreadable file is ignored
+    cache.cache_file.write_text(cache.cache_file.read_text().replace(f'"version": {CACHE_VERSION}', '"version": 0'))
+    assert ContentCache(cache_file=cache.cache_file).lookup(path) is None
+    cache.cache_file.write_text('{')
+    assert ContentCache(cache_file=cache.cache_file).lookup(path) is None
+
+
+@pytest.mark.parametrize('cached', [True, False], ids=['cached', 'edited'])
+@pytest.mark.parametrize('checksum_mismatch', ['warn', 'fail'])
+def test_a_released_change_edited_after_its_release(fake_hook, release_properties, deployer, tmp_path, caplog,
+                                                    checksum_mismatch, cached):
+    hook = fake_hook()
+    properties = release_properties(change_logs=1, files=2, checksum_mismatch=checksum_mismatch,
+                                    content_cache_file=str(tmp_path / 'content_cache.json'))
+    assert not deployer(hook, properties).run_release().failed
+    if cached:
+        # the file is unchanged since it was cached, the checksum recorded in the history differs
+        hook.backend.execute(f"UPDATE {HISTORY_TABLE} SET checksum = 'edited' WHERE id = 'change-0-0'")
+    else:
+        sql_file = Path(properties['root_sql_directory'], '0', 'change_0.sql')
+        sql_file.write_text(sql_file.read_text() + '\n-- edited\n')
+    release = deployer(hook, properties)
+    with caplog.at_level(logging.WARNING):
+        if checksum_mismatch == 'fail':
+            with pytest.raises(ValueError, match='was edited after it was released'):
+                release.run_release()
+        else:
+            report = release.run_release()
+            assert not report.succeeded and not report.failed
+    assert checksum_mismatch == 'fail' or 'Change change-0-0 in 0/change_0.sql was edited' in caplog.text
+    assert history(hook.backend) == {'change-0-0': 'success', 'change-0-1': 'success'}
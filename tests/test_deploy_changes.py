@@ -0,0 +1,100 @@
+from pathlib import Path
+
+import pytest
+
+from benchmarks.synthetic_release import change_id
+from conftest import TARGET_DATABASE, history
+from core import deploy_changes
+
+
+def tables(backend):
+    """
+    :return: rows of the tables released to the target database, by table
+    """
+    rows = backend.execute(f"SELECT table_schema, table_name, table_type FROM {TARGET_DATABASE}.INFORMATION_SCHEMA."
+                           f"TABLES WHERE table_schema <> 'INFORMATION_SCHEMA'")
+    names = [name for schema, name, _ in rows if schema == 'PUBLIC']
+    return {name: sorted(backend.execute(f'SELECT * FROM {TARGET_DATABASE}.PUBLIC.{name}')) for name in names}
+
+
+@pytest.mark.parametrize('mode', ['threads', 'async'])
+def test_a_failure_halts_the_release(fake_hook, release_properties, deployer, mode):
+    deploy_changes.halt_release_on_fail = True
+    hook = fake_hook(failures=[r'^INSERT INTO bench_0_1 '])
+    release = deployer(hook, release_properties(change_logs=2, files=3, execution_mode=mode))
+    report = release.run_release()
+    assert [node.id for node in report.failed] == [change_id(0, 1)]
+    assert history(hook.backend) == {change_id(0, 0): 'success', change_id(0, 1): 'failed'}
+    assert 1 in release.change_log_status.values()
+
+
+@pytest.mark.parametrize('mode', ['threads', 'async'])
+def test_streamed_and_in_memory_releases_are_the_same(fake_hook, release_properties, deployer, mode):
+    results = []
+    for threshold in (64, 1e-9):
+        hook = fake_hook()
+        release = deployer(hook, release_properties(change_logs=2, files=3, statements=3, execution_mode=mode,
+                                                    streaming_threshold_mb=threshold))
+        assert not release.run_release().failed
+        results.append((tables(hook.backend), history(hook.backend), release.statement_stats.statements_executed,
+                        release.statement_stats.streamed_files))
+    (in_memory, in_memory_history, in_memory_statements, not_streamed), \
+        (streamed, streamed_history, streamed_statements, streamed_files) = results
+    assert in_memory == streamed and len(in_memory) == 6
+    assert in_memory_history == streamed_history
+    assert in_memory_statements == streamed_statements == 6 * 4
+    assert (not_streamed, streamed_files) == (0, 6)
+
+
+@pytest.mark.parametrize('mode', ['threads', 'async'])
+def test_a_rerun_resumes_at_the_failed_statement(fake_hook, release_properties, deployer, tmp_path, mode):
+    properties = release_properties(change_logs=1, files=2, statements=3, execution_mode=mode,
+                                    release_journal_directory=str(tmp_path / 'journal'))
+    deploy_changes.halt_release_on_fail = False
+    failed = fake_hook(failures=[r'^INSERT INTO bench_0_1 .*VALUES \(2,'])
+    assert [node.id for node in deployer(failed, properties).run_release().failed] == [change_id(0, 1)]
+
+    rerun = fake_hook(backend=failed.backend, record=True)
+    assert not deployer(rerun, properties).run_release().failed
+    executed = [sql for conn in rerun.connections for sql in conn.executed_sql if 'bench_0_1' in sql]
+    # the CREATE TABLE and the first two INSERTs of the failed changeset are not executed again
+    assert executed == ["INSERT INTO bench_0_1 (id, label) VALUES (2, 'row 2');"]
+    assert sorted(failed.backend.execute('SELECT id FROM TEST.PUBLIC.bench_0_1')) == [(0,), (1,), (2,)]
+    assert history(failed.backend) == {change_id(0, 0): 'success', change_id(0, 1): 'success'}
+
+
+def test_changesets_sharing_an_id_fail_before_anything_runs(fake_hook, release_properties, deployer):
+    properties = release_properties(change_logs=2, files=2)
+    duplicate = Path(properties['root_sql_directory'], '1', 'change_1.sql')
+    duplicate.write_text(duplicate.read_text().replace(change_id(1, 1), change_id(0, 1)))
+    hook = fake_hook(record=True)
+    with pytest.raises(ValueError, match='ids must be unique'):
+        deployer(hook, properties).run_release()
+    assert not any('bench_' in sql for conn in hook.connections for sql in conn.executed_sql)
+
+
+@pytest.mark.parametrize('header', ['--liquibase formatted sql\n', '--changeset bench\n'])
+def test_a_changeset_without_an_id_fails_before_anything_runs(fake_hook, release_properties, deployer, header):
+    properties = release_properties(change_logs=2, files=2)
+    change_file = Path(properties['root_sql_directory'], '1', 'change_0.sql')
+    change_file.write_text(header + 'CREATE TABLE bench_no_id (id int);\n')
+    hook = fake_hook(record=True)
+    with pytest.raises(ValueError, match='1/change_0.sql in changelog_1.xml has no --changeset line with an id'):
+        deployer(hook, properties).run_release()
+    assert not any('bench_' in sql for conn in hook.connections for sql in conn.executed_sql)
+
+
+def test_an_async_release_restores_the_session_after_a_change_using_a_schema(fake_hook, release_properties,
+                                                                              deployer):
+    properties = release_properties(change_logs=1, files=3, execution_mode='async')
+    change_file = Path(properties['root_sql_directory'], '0', 'change_1.sql')
+    change_file.write_text(change_file.read_text().replace('CREATE TABLE', 'USE SCHEMA PUBLIC;\nCREATE TABLE', 1))
+    hook = fake_hook(record=True)
+    assert not deployer(hook, properties).run_release().failed
+    executed = [sql.strip().rstrip(';') for conn in hook.connections for sql in conn.executed_sql]
+    changed = executed.index('USE SCHEMA PUBLIC')
+    restored = executed.index(f'USE DATABASE {TARGET_DATABASE}', changed)
+    assert changed < restored < next(i for i, sql in enumerate(executed) if sql.startswith('CREATE TABLE bench_0_2'))
+    # the connection is closed instead of returned to the pool, a role or warehouse would not be restored
+    assert all(conn.is_closed() for conn in hook.connections if 'USE SCHEMA PUBLIC' in conn.executed_sql)
+    assert set(history(hook.backend).values()) == {'success'}
@@ -0,0 +1,96 @@
+import logging
+
+import pytest
+
+from core import fan_out
+from core.fan_out import FanOutDeployment, FanOutReport, resolve_targets
+
+TENANTS = ['TENANT_A', 'TENANT_B', 'TENANT_C']
+
+
+@pytest.fixture
+def tenants(fake_hook):
+    hook = fake_hook(record=True)
+    for database in TENANTS + ['OTHER']:
+        hook.backend.execute(f'CREATE DATABASE {database}')
+    return hook
+
+
+def tenant_history(hook, database):
+    return dict(hook.backend.execute(f'SELECT id, status FROM {database}.HISTORY_SCHEMA.HISTORY_TABLE'))
+
+
+@pytest.mark.parametrize('targets, expected', [
+    (['tenant_*'], TENANTS),
+    (['TENANT_B', 'TENANT_?', 'OTHER'], ['TENANT_B', 'TENANT_A', 'TENANT_C', 'OTHER']),
+    (['TENANT_[AC]', 'TENANT_A'], ['TENANT_A', 'TENANT_C']),
+    (['MISSING_*', 'TENANT_C'], ['TENANT_C']),
+])
+def test_resolve_targets(tenants, targets, expected, caplog):
+    with caplog.at_level(logging.WARNING):
+        assert resolve_targets(targets, tenants.get_conn()) == expected
+    assert ('No databases match MISSING_*' in caplog.text) == ('MISSING_*' in targets)
+
+
+def test_database_names_are_resolved_without_a_connection():
+    assert resolve_targets(['b', 'a', 'b']) == ['b', 'a']
+
+
+@pytest.mark.parametrize('mode', ['threads', 'async'])
+def test_every_target_is_released(tenants, release_properties, mode):
+    properties = release_properties(change_logs=2, files=2, execution_mode=mode)
+    report = FanOutDeployment(['TENANT_*'], cloning=False, properties=properties, max_concurrency=2,
+                              hook=tenants).run()
+    assert report.ok and list(report.results) == TENANTS
+    assert report.change_logs == ['changelog_0.xml', 'changelog_1.xml']
+    for database in TENANTS:
+        result = report.results[database]
+        assert (result.status, result.succeeded, result.change_logs) == \
+            ('success', 4, {'changelog_0.xml': 0, 'changelog_1.xml': 0})
+        assert set(tenant_history(tenants, database).values()) == {'success'}
+    assert 'OTHER' not in report.results
+
+
+@pytest.mark.parametrize('fail_fast, statuses', [(True, ['failed', 'cancelled', 'cancelled']),
+                                                 (False, ['failed', 'success', 'success'])])
+def test_fail_fast_cancels_the_targets_not_started(tenants, release_properties, fail_fast, statuses):
+    # the first change creates a table the first target already has, its release fails
+    tenants.backend.execute('CREATE TABLE TENANT_A.PUBLIC.bench_0_0 (id int)')
+    properties = release_properties(change_logs=1, files=2)
+    report = FanOutDeployment(TENANTS, cloning=False, properties=properties, max_concurrency=1, fail_fast=fail_fast,
+                              hook=tenants).run()
+    assert [report.results[database].status for database in TENANTS] == statuses
+    assert report.results['TENANT_A'].change_logs == {'changelog_0.xml': 1} and not report.ok
+    assert report.matrix().splitlines()[1].split()[:2] == ['TENANT_A', 'failed']
+
+
+def test_the_matrix_shows_each_target_by_change_log():
+    report = FanOutReport(['TENANT_A', 'TENANT_LONG_NAME'])
+    report.change_logs = ['changelog_0.xml', 'changelog_1.xml']
+    ok, failed = report.results.values()
+    ok.status, ok.succeeded, ok.change_logs = 'success', 4, {'changelog_0.xml': 0, 'changelog_1.xml': 0}
+    failed.status, failed.failed, failed.change_logs = 'failed', 1, {'changelog_0.xml': 1}
+    failed.error = 'ProgrammingError: boom'
+    header, first, second = report.matrix().splitlines()
+    assert header.split() == ['database', 'status', 'ok', 'failed', 'skipped', 'seconds', 'changelog_0.xml',
+                              'changelog_1.xml']
+    assert first.split() == ['TENANT_A', 'success', '4', '0', '0', '0.00', 'ok', 'ok']
+    assert second.split() == ['TENANT_LONG_NAME', 'failed', '0', '1', '0', '0.00', 'FAILED', '-', 'ProgrammingError:',
+                              'boom']
+    # the change log cells line up under their change log
+    assert first.index(' ok ') + 1 == second.index('FAILED') == header.index('changelog_0.xml')
+
+
+def test_the_shared_change_files_are_read_before_the_targets_start(tenants, release_properties, monkeypatch):
+    shared = []
+    release_target = FanOutDeployment._release_target
+
+    def recording_release_target(self, result, parsed_release, content_cache):
+        shared.append([(change_file._header_lines is not None, change_file.checksum is not None)
+                       for change_files in parsed_release.values() for change_file in change_files])
+        return release_target(self, result, parsed_release, content_cache)
+
+    monkeypatch.setattr(fan_out.FanOutDeployment, '_release_target', recording_release_target)
+    properties = release_properties(change_logs=2, files=3)
+    assert FanOutDeployment(TENANTS, cloning=False, properties=properties, hook=tenants).run().ok
+    assert len(shared) == 3 and all(read == [(True, True)] * 6 for read in shared)
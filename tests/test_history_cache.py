@@ -0,0 +1,151 @@
+import datetime
+import re
+
+import pytest
+from snowflake.connector.errors import ProgrammingError
+
+from benchmarks.synthetic_release import seed_history
+from conftest import HISTORY_TABLE, TARGET_DATABASE
+from operators.history_cache import HistoryCache
+from operators.snowflake_operator import SnowflakeOperator
+from operators.sql_templates import get_rendered_template
+
+RELEASED = datetime.datetime(2024, 6, 1, 12)
+OVERLAP = datetime.timedelta(hours=24)
+
+
+def insert(backend, id, date_released, status='success'):
+    backend.execute(get_rendered_template('insert_into_release_log_history_table.j2', history_table=HISTORY_TABLE),
+                    (id, 'test', f'{id}.sql', date_released, 'a.xml', None, None, None, 1, status, None))
+
+
+@pytest.fixture
+def synced(fake_hook, tmp_path):
+    """
+    Fake account whose history table holds three released changes, synced once into a history cache
+    """
+    hook = fake_hook(record=True)
+    seed_history(hook.backend, TARGET_DATABASE, 'HISTORY_SCHEMA', 'HISTORY_TABLE', rows=0)
+    for i in range(3):
+        insert(hook.backend, f'c{i}', RELEASED + datetime.timedelta(minutes=i))
+
+    def sync():
+        conn = hook.get_conn()
+        operator = SnowflakeOperator(conn=conn, target_database=TARGET_DATABASE, history_schema='HISTORY_SCHEMA',
+                                     history_table='HISTORY_TABLE', history_cache_directory=str(tmp_path),
+                                     history_cache_overlap=OVERLAP)
+        change_history = operator.get_database_change_history()
+        fetches = [sql for sql in conn.executed_sql if re.match(r'\s*SELECT\s+id,', sql, re.IGNORECASE)]
+        return change_history, fetches
+
+    sync()
+    cache = HistoryCache(tmp_path, HISTORY_TABLE, overlap=OVERLAP)
+    return hook, sync, cache
+
+
+def test_the_cache_records_the_server_state(synced):
+    _, _, cache = synced
+    rows, state = cache.load()
+    assert sorted(row[0] for row in rows) == ['c0', 'c1', 'c2']
+    assert state == (3, RELEASED + datetime.timedelta(minutes=2))
+
+
+def test_an_unchanged_history_table_is_not_fetched(synced):
+    _, sync, cache = synced
+    change_history, fetches = sync()
+    assert fetches == []
+    assert sorted(record.id for record in change_history) == ['c0', 'c1', 'c2']
+
+
+def test_new_rows_and_rows_in_the_overlap_window_are_synced(synced):
+    hook, sync, cache = synced
+    insert(hook.backend, 'new', RELEASED + datetime.timedelta(hours=1))
+    # written late by a client whose clock is behind, within the overlap window
+    insert(hook.backend, 'late', RELEASED - datetime.timedelta(hours=2))
+    # a failed change is not released and not cached
+    insert(hook.backend, 'failed', RELEASED + datetime.timedelta(hours=2), status='failed')
+    change_history, fetches = sync()
+    assert len(fetches) == 1 and '>=' in fetches[0]
+    assert change_history.is_released('new') and change_history.is_released('late')
+    assert 'failed' not in change_history
+    rows, state = cache.load()
+    assert sorted(row[0] for row in rows) == ['c0', 'c1', 'c2', 'late', 'new']
+    assert state == (5, RELEASED + datetime.timedelta(hours=1))
+
+
+def test_a_row_written_before_the_overlap_window_resyncs(synced):
+    hook, sync, cache = synced
+    insert(hook.backend, 'new', RELEASED + datetime.timedelta(hours=1))
+    insert(hook.backend, 'old', RELEASED - OVERLAP - datetime.timedelta(hours=1))
+    change_history, fetches = sync()
+    # the incremental fetch misses the old row, the full fetch finds it
+    assert len(fetches) == 2 and '>=' not in fetches[1]
+    assert change_history.is_released('old') and change_history.is_released('new')
+    assert cache.load()[1] == (5, RELEASED + datetime.timedelta(hours=1))
+
+
+@pytest.mark.parametrize('replace', [
+    # truncated
+    [f'DELETE FROM {HISTORY_TABLE}'],
+    # restored to before the last release
+    [f"DELETE FROM {HISTORY_TABLE} WHERE id = 'c2'"],
+    # swapped with a table holding as many rows, released earlier
+    [f'DELETE FROM {HISTORY_TABLE}'] + [f"INSERT INTO {HISTORY_TABLE} (id, author, filename, date_released, status) "
+                                        f"VALUES ('other{i}', 'test', 'other.sql', '2024-01-01 00:00:00', 'success')"
+                                        for i in range(3)],
+])
+def test_a_truncated_restored_or_swapped_table_rebuilds_the_cache(synced, replace):
+    hook, sync, cache = synced
+    for sql in replace:
+        hook.backend.execute(sql)
+    expected = sorted(id for id, in hook.backend.execute(f'SELECT id FROM {HISTORY_TABLE}'))
+    change_history, fetches = sync()
+    assert len(fetches) == 1 and '>=' not in fetches[0]
+    assert sorted(record.id for record in change_history) == expected
+    assert sorted(row[0] for row in cache.load()[0]) == expected
+
+
+@pytest.mark.parametrize('cached_state, state, replaced', [
+    ((3, RELEASED), (3, RELEASED), False),
+    ((3, RELEASED), (4, RELEASED + OVERLAP), False),
+    ((3, RELEASED), (2, RELEASED + OVERLAP), True),
+    ((3, RELEASED), (3, RELEASED - OVERLAP), True),
+    ((3, RELEASED), (0, None), True),
+    ((0, None), (1, RELEASED), False),
+])
+def test_is_replaced(cached_state, state, replaced):
+    assert HistoryCache.is_replaced(cached_state, state) == replaced
+
+
+def test_a_cache_of_another_table_or_rows_file_size_is_invalid(synced, tmp_path):
+    _, _, cache = synced
+    assert HistoryCache(tmp_path, HISTORY_TABLE, watermark_column='deployment_id').load() is None
+    with open(cache.rows_file, 'a') as f:
+        f.write('\n')
+    assert cache.load() is None
+
+
+def test_the_history_table_is_validated_when_the_cache_is_current(synced):
+    hook, sync, _ = synced
+    # a history table created before checksums were recorded, holding the rows cached
+    columns = 'id, author, filename, date_released, change_log, jira_number, release_number, comments, ' \
+              'deployment_id, status'
+    rows = hook.backend.execute(f'SELECT {columns} FROM {HISTORY_TABLE}')
+    hook.backend.execute(f'DROP TABLE {HISTORY_TABLE}')
+    hook.backend.execute(f'CREATE TABLE {HISTORY_TABLE} (id varchar, author varchar, filename varchar, '
+                         f'date_released timestamp_ntz, change_log varchar, jira_number varchar, '
+                         f'release_number varchar, comments varchar, deployment_id number, status varchar)')
+    for row in rows:
+        hook.backend.execute(f'INSERT INTO {HISTORY_TABLE} ({columns}) VALUES ({", ".join("?" * len(row))})', row)
+    change_history, fetches = sync()
+    assert fetches == [] and len(change_history) == 3
+    assert hook.backend.execute(f'SELECT checksum FROM {HISTORY_TABLE}') == [(None,)] * 3
+
+
+def test_an_error_validating_the_history_table_is_raised(fake_hook, tmp_path):
+    hook = fake_hook(failures=[r'INFORMATION_SCHEMA\.TABLES'])
+    operator = SnowflakeOperator(conn=hook.get_conn(), target_database=TARGET_DATABASE,
+                                 history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE')
+    with pytest.raises(ProgrammingError, match='SQL compilation error'):
+        operator.get_database_change_history()
+    assert not hook.backend.table_exists(HISTORY_TABLE)
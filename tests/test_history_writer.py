@@ -0,0 +1,111 @@
+import datetime
+import time
+
+import pytest
+
+from benchmarks.synthetic_release import seed_history
+from conftest import TARGET_DATABASE, history
+from operators.history_writer import INSERT_TEMPLATE, STATUS_TEMPLATE, HistoryWriter, status_chunks
+from operators.snowflake_operator import SnowflakeOperator
+
+
+class RecordingWriter(HistoryWriter):
+    """
+    HistoryWriter recording the statements it writes instead of running them
+    """
+    def __init__(self, batch_size=3, flush_interval=None):
+        self.written = []
+        super().__init__(execute=lambda sql, params: self.written.append((sql, list(params))),
+                         executemany=lambda sql, rows: self.written.append((sql, list(rows))),
+                         render=lambda template, **kwargs: (template, kwargs.get('rows')),
+                         history_table='TEST.HISTORY_SCHEMA.HISTORY_TABLE', batch_size=batch_size,
+                         flush_interval=flush_interval)
+
+    def inserted_ids(self):
+        return [[row[0] for row in rows] for (template, _), rows in self.written if template == INSERT_TEMPLATE]
+
+
+def test_flushes_when_the_batch_is_full():
+    writer = RecordingWriter(batch_size=3)
+    for i in range(2):
+        writer.track(id=f'c{i}', change_log='a.xml', status='pending')
+    assert writer.written == [] and len(writer) == 2
+    writer.track(id='c2', change_log='a.xml', status='pending')
+    assert writer.inserted_ids() == [['c0', 'c1', 'c2']] and len(writer) == 0
+
+
+def test_flushes_when_the_change_log_changes():
+    writer = RecordingWriter(batch_size=10)
+    writer.track(id='c0', change_log='a.xml', status='pending')
+    writer.track(id='c1', change_log='a.xml', status='pending')
+    writer.track(id='c2', change_log='b.xml', status='pending')
+    assert writer.inserted_ids() == [['c0', 'c1']]
+    writer.flush()
+    assert writer.inserted_ids() == [['c0', 'c1'], ['c2']]
+
+
+def test_flushes_at_the_next_change_once_a_record_waited_flush_interval():
+    writer = RecordingWriter(batch_size=10, flush_interval=0.05)
+    writer.track(id='c0', change_log='a.xml', status='pending')
+    writer.set_status('c0', 'success')
+    assert writer.written == []
+    time.sleep(0.06)
+    writer.track(id='c1', change_log='a.xml', status='pending')
+    assert writer.inserted_ids() == [['c0', 'c1']]
+    # the interval starts again with the next record buffered
+    writer.set_status('c1', 'success')
+    assert len(writer.written) == 1
+
+
+@pytest.mark.parametrize('record, message', [
+    ({'filename': 'b.sql'}, 'has no id'),
+    ({'id': 'c0', 'filename': 'b.sql'}, 'has the id c0 of another change'),
+])
+def test_a_record_without_a_unique_id_is_rejected(record, message):
+    writer = RecordingWriter(batch_size=1)
+    writer.track(id='c0', filename='a.sql', change_log='a.xml', status='pending')
+    # the first record was already written, its id is still known
+    assert writer.inserted_ids() == [['c0']]
+    with pytest.raises(ValueError, match=message):
+        writer.track(change_log='a.xml', status='pending', **record)
+    assert writer.inserted_ids() == [['c0']]
+
+
+def test_status_of_an_unwritten_change_is_inserted_with_it():
+    writer = RecordingWriter(batch_size=10)
+    writer.track(id='c0', change_log='a.xml', status='pending')
+    writer.set_status('c0', 'success')
+    writer.flush()
+    ((_, rows),) = writer.written
+    assert rows[0][0] == 'c0' and rows[0][-2] == 'success'
+
+
+def test_status_changes_are_merged_in_power_of_two_chunks():
+    writer = RecordingWriter(batch_size=50)
+    for i in range(37):
+        writer.set_status(f'c{i}', 'failed')
+    writer.flush()
+    assert [(template, rows, len(params)) for (template, rows), params in writer.written] == \
+        [(STATUS_TEMPLATE, 32, 64), (STATUS_TEMPLATE, 4, 8), (STATUS_TEMPLATE, 1, 2)]
+    assert [params[0] for _, params in writer.written] == ['c0', 'c32', 'c36']
+
+
+def test_status_chunks():
+    assert status_chunks(0, 50) == []
+    assert status_chunks(50, 50) == [32, 16, 2]
+    assert status_chunks(70, 50) == [32, 32, 4, 2]
+    assert status_chunks(3, 1) == [1, 1, 1]
+
+
+def test_closing_the_operator_writes_the_buffered_records(fake_hook):
+    hook = fake_hook()
+    seed_history(hook.backend, TARGET_DATABASE, 'HISTORY_SCHEMA', 'HISTORY_TABLE', rows=0,
+                 released=[('c0', 'a.xml')])
+    operator = SnowflakeOperator(conn=hook.get_conn(), target_database=TARGET_DATABASE,
+                                 history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE', history_batch_size=10)
+    operator.history_writer.track(id='c1', author='test', filename='c1.sql', date_released=datetime.datetime.now(),
+                                  change_log='a.xml', status='success')
+    operator.set_change_status('failed', 'c0')
+    assert history(hook.backend) == {'c0': 'success'}
+    operator.close()
+    assert history(hook.backend) == {'c0': 'failed', 'c1': 'success'}
@@ -0,0 +1,127 @@
+from pathlib import Path
+import json
+import time
+
+import pytest
+
+from operators.instrumentation import NOOP_SPAN, Instrumentation, instrumentation
+
+
+class ListSink:
+    def __init__(self):
+        self.spans = []
+        self.closed = False
+
+    def emit(self, span):
+        self.spans.append(span)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def recording():
+    sink = ListSink()
+    recorder = Instrumentation()
+    recorder.configure(enabled=True, sinks=[sink], top_n=2)
+    return recorder, sink
+
+
+def test_a_disabled_instrumentation_records_nothing():
+    recorder = Instrumentation()
+    assert recorder.span('parse', file='a.sql') is NOOP_SPAN
+    with recorder.span('parse') as span:
+        span.set(changeset='c1')
+    recorder.record('statement', 0.0, 1.0)
+    assert recorder.slowest_changesets() == [] and recorder.summary() == 'No changesets recorded'
+
+
+def test_spans_are_timed_and_nested(recording):
+    recorder, sink = recording
+    with recorder.span('changeset', changeset='c1') as outer:
+        with recorder.span('statement', position=1) as inner:
+            time.sleep(0.02)
+            inner.set(rows=3)
+        recorder.record('statement', 10.0, 10.5, position=2)
+    statement, recorded, changeset = sink.spans
+    assert (statement, changeset) == (inner, outer)
+    assert statement.parent_id == recorded.parent_id == changeset.span_id and changeset.parent_id is None
+    assert 0.02 <= statement.duration <= changeset.duration
+    assert recorded.duration == 0.5 and statement.attributes == {'position': 1, 'rows': 3}
+
+
+def test_a_failed_operation_records_its_error(recording):
+    recorder, sink = recording
+    with pytest.raises(ValueError):
+        with recorder.span('parse', file='a.sql'):
+            raise ValueError('no id')
+    assert sink.spans[0].error == 'ValueError: no id'
+
+
+def test_the_summary_lists_the_slowest_changesets(recording):
+    recorder, _ = recording
+    for changeset, seconds, status in [('fast', 0.1, 'success'), ('slow', 3.0, 'failed'), ('medium', 1.0, 'success')]:
+        recorder.record('changeset', 100.0, 100.0 + seconds, changeset=changeset, statements=2, status=status,
+                        database='TEST')
+    recorder.record('statement', 100.0, 200.0, changeset='slow')
+    assert [span.attributes['changeset'] for span in recorder.slowest_changesets()] == ['slow', 'medium']
+    lines = recorder.summary().splitlines()
+    assert len(lines) == 3 and lines[0].split() == ['#', 'seconds', 'statements', 'status', 'database', 'changeset']
+    assert lines[1].split() == ['1', '3.000', '2', 'failed', 'TEST', 'slow']
+    assert lines[2].split() == ['2', '1.000', '2', 'ok', 'TEST', 'medium']
+    assert len(recorder.slowest_changesets(5)) == 3
+
+
+def test_the_file_sinks(tmp_path):
+    recorder = Instrumentation()
+    recorder.configure(enabled=True, sinks=['jsonl', 'prometheus', 'otel'], directory=str(tmp_path))
+    with recorder.span('changeset', changeset='c1'):
+        with recorder.span('statement', query_id='q1'):
+            pass
+    with pytest.raises(ValueError):
+        with recorder.span('statement', query_id='q2'):
+            raise ValueError('failed')
+    recorder.close()
+
+    spans = [json.loads(line) for line in Path(tmp_path, 'spans.jsonl').read_text().splitlines()]
+    assert [(span['name'], span.get('query_id'), span['error']) for span in spans] == \
+        [('statement', 'q1', None), ('changeset', None, None), ('statement', 'q2', 'ValueError: failed')]
+    assert spans[0]['parent_id'] == spans[1]['span_id'] and spans[0]['duration'] >= 0
+
+    metrics = Path(tmp_path, 'release_tool.prom').read_text().splitlines()
+    assert 'release_tool_span_seconds_count{operation="statement"} 2' in metrics
+    assert 'release_tool_span_seconds_count{operation="changeset"} 1' in metrics
+    assert 'release_tool_span_errors_total{operation="statement"} 1' in metrics
+    assert 'release_tool_span_errors_total{operation="changeset"} 0' in metrics
+
+    records = [json.loads(line) for line in Path(tmp_path, 'otel_spans.jsonl').read_text().splitlines()]
+    statement, changeset, failed = (record['span'] for record in records)
+    assert len({record['traceId'] for record in (statement, changeset, failed)}) == 1
+    assert statement['parentSpanId'] == changeset['spanId'] and changeset['parentSpanId'] == ''
+    assert statement['endTimeUnixNano'] >= statement['startTimeUnixNano']
+    assert {'key': 'query_id', 'value': {'stringValue': 'q1'}} in statement['attributes']
+    assert failed['status'] == {'code': 'STATUS_CODE_ERROR', 'message': 'ValueError: failed'}
+
+
+def test_reset_forgets_the_previous_run(recording):
+    recorder, sink = recording
+    recorder.record('changeset', 0.0, 1.0, changeset='c1')
+    recorder.close()
+    # kept for the summary of the run until reset
+    assert len(recorder.slowest_changesets()) == 1 and sink.closed
+    recorder.reset()
+    assert not recorder.enabled and recorder.slowest_changesets() == []
+    recorder.configure(enabled=True)
+    with recorder.span('parse') as span:
+        pass
+    assert span.span_id == 1
+
+
+def test_a_release_leaves_the_global_instrumentation_reset(fake_hook, release_properties, deployer, tmp_path):
+    properties = release_properties(change_logs=1, files=2, instrumentation={'enabled': True, 'sinks': ['jsonl'],
+                                                                            'directory': str(tmp_path / 'metrics')})
+    for _ in range(2):
+        deployer(fake_hook(), properties).run_release()
+        assert not instrumentation.enabled and instrumentation.slowest_changesets() == []
+    spans = [json.loads(line) for line in Path(tmp_path, 'metrics', 'spans.jsonl').read_text().splitlines()]
+    assert sum(span['name'] == 'changeset' for span in spans) == 4
@@ -0,0 +1,102 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from operators import manifest_reader
+from operators.content_cache import ContentCache, content_checksum
+from operators.manifest_reader import ChangeFile, LoadFile, iter_change_files, iter_manifest
+
+MANIFEST = '''<?xml version="1.0" encoding="UTF-8"?>
+<databaseChangeLog>
+  <include file="a.sql"/>
+  <property name="ignored"><include file="nested.sql"/></property>
+  <include file="seed/countries.csv" type="load" table="REF.COUNTRIES" id="seed" author="test" skip_header="1"/>
+  <include file="b.sql"/>
+</databaseChangeLog>
+'''
+
+SQL = '\ufeff--liquibase formatted sql\n\n--changeset test:c1 context:dev\n--comment: a change\n' \
+      'CREATE TABLE t (id int);\nINSERT INTO t VALUES (1);\n'
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    path = tmp_path / 'changelog.xml'
+    path.write_text(MANIFEST)
+    return path
+
+
+def test_iter_manifest_yields_the_includes_under_the_root(manifest):
+    includes = list(iter_manifest(manifest))
+    assert includes == ['a.sql', {'file': 'seed/countries.csv', 'type': 'load', 'table': 'REF.COUNTRIES', 'id': 'seed',
+                                  'author': 'test', 'skip_header': '1'}, 'b.sql']
+
+
+def test_handled_elements_are_dropped_from_the_root(manifest, monkeypatch):
+    roots = []
+    iterparse = ET.iterparse
+
+    def recording_iterparse(source, events):
+        for event, item in iterparse(source, events):
+            if not roots:
+                roots.append(item)
+            yield event, item
+            if event == 'end' and item.tag == 'include' and item is not roots[0]:
+                # the root only ever holds the element being parsed
+                assert len(roots[0]) <= 2
+
+    monkeypatch.setattr(manifest_reader.ET, 'iterparse', recording_iterparse)
+    assert len(list(iter_manifest(manifest))) == 3
+    assert len(roots[0]) == 0
+
+
+def test_an_unchanged_manifest_is_not_parsed_again(manifest, monkeypatch):
+    content_cache = ContentCache()
+    expected = list(iter_manifest(manifest, content_cache=content_cache))
+    monkeypatch.setattr(manifest_reader, '_iter_xml', lambda xmlfile: pytest.fail('the manifest was parsed'))
+    assert list(iter_manifest(manifest, content_cache=content_cache)) == expected
+    assert content_cache.hits == 1
+
+
+def test_iter_change_files_makes_sql_and_load_files(manifest, tmp_path):
+    change_files = list(iter_change_files(manifest, tmp_path))
+    assert [type(change_file) for change_file in change_files] == [ChangeFile, LoadFile, ChangeFile]
+    assert [change_file.path for change_file in change_files] == [tmp_path / 'a.sql', tmp_path / 'seed/countries.csv',
+                                                                 tmp_path / 'b.sql']
+    load_file = change_files[1]
+    assert (load_file.table, load_file.format, load_file.options) == ('REF.COUNTRIES', 'csv', {'skip_header': '1'})
+    assert (load_file.changeset.id, load_file.changeset.author) == ('seed', 'test')
+
+
+@pytest.fixture
+def change_file(tmp_path):
+    path = tmp_path / 'change.sql'
+    path.write_bytes(SQL.encode('utf-8'))
+    return ChangeFile('change.sql', path)
+
+
+def test_the_header_is_parsed_and_the_body_follows_it(change_file):
+    assert [line.strip() for line in change_file.header_lines] == ['--liquibase formatted sql', '',
+                                                                   '--changeset test:c1 context:dev',
+                                                                   '--comment: a change']
+    assert (change_file.changeset.id, change_file.changeset.author, change_file.changeset.context) == \
+        ('c1', 'test', 'dev')
+    assert change_file.read_sql() == 'CREATE TABLE t (id int);\nINSERT INTO t VALUES (1);\n'
+    with change_file.open_sql() as f:
+        assert f.read() == change_file.read_sql()
+
+
+@pytest.mark.parametrize('first', ['read_sql', 'compute_checksum'])
+def test_the_checksum_is_of_the_whole_file(change_file, first):
+    getattr(change_file, first)()
+    # the byte order mark and the header are hashed with the body
+    assert change_file.checksum == change_file.compute_checksum() == content_checksum(SQL)
+    assert change_file.size == len(SQL.encode('utf-8'))
+
+
+def test_a_file_holding_only_a_header(tmp_path):
+    path = tmp_path / 'empty.sql'
+    path.write_text('--changeset test:c2\n')
+    change_file = ChangeFile('empty.sql', path)
+    assert change_file.read_sql() == ''
+    assert change_file.changeset.id == 'c2' and change_file.checksum == content_checksum('--changeset test:c2\n')
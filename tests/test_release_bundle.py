@@ -0,0 +1,92 @@
+from pathlib import Path
+import json
+
+import pytest
+
+from operators import release_bundle
+from operators.manifest_reader import ChangeFile
+from operators.release_bundle import BUNDLE_HEADER, BUNDLE_MAGIC, BUNDLE_VERSION, BundledChangeFile, ReleaseBundle, \
+    write_bundle
+
+CREDENTIALS = {'user': 'RELEASE_USER', 'password': 'secret-password', 'private_key': '/keys/rsa_key.p8',
+               'private_key_passphrase': 'secret-passphrase', 'account': 'xy12345', 'role': 'RELEASE_ROLE',
+               'authenticator': 'snowflake_jwt', 'token': 'secret-token'}
+
+
+def read_index(bundle_file):
+    with open(bundle_file, 'rb') as f:
+        magic, version, index_length = BUNDLE_HEADER.unpack(f.read(BUNDLE_HEADER.size))
+        return magic, version, json.loads(f.read(index_length))
+
+
+def test_a_bundle_reads_back_the_release_it_was_written_from(release_properties, tmp_path):
+    properties = release_properties(change_logs=2, files=3, parallel_workers=4)
+    bundle_file = tmp_path / 'bundle' / 'release.bundle'
+    assert write_bundle(properties, bundle_file) == 6
+    assert not list(bundle_file.parent.glob('*.tmp'))
+
+    magic, version, index = read_index(bundle_file)
+    assert (magic, version) == (BUNDLE_MAGIC, BUNDLE_VERSION)
+    assert [change_log['name'] for change_log in index['change_logs']] == ['changelog_0.xml', 'changelog_1.xml']
+    assert index['properties']['parallel_workers'] == 4
+
+    expected = release_bundle.read_release(properties)
+    bundle = ReleaseBundle(bundle_file)
+    try:
+        assert bundle.properties == release_bundle.bundled_properties(properties)
+        release = bundle.read_release()
+        assert list(release) == list(expected)
+        for change_files, expected_files in zip(release.values(), expected.values()):
+            for change_file, source in zip(change_files, expected_files, strict=True):
+                assert isinstance(change_file, BundledChangeFile) and isinstance(source, ChangeFile)
+                assert (change_file.file, change_file.changeset, change_file.checksum) == \
+                    (source.file, source.changeset, source.compute_checksum())
+                # the body follows the header of the source file
+                assert change_file.read_sql() == source.read_sql()
+                assert change_file.size == len(source.read_sql().encode('utf-8'))
+                with change_file.open_sql() as sql:
+                    assert sql.read() == source.read_sql()
+    finally:
+        bundle.close()
+
+
+def test_a_release_is_read_from_the_bundle_set_in_the_properties(release_properties, tmp_path, monkeypatch):
+    properties = release_properties(change_logs=1, files=2)
+    bundle_file = tmp_path / 'release.bundle'
+    write_bundle(properties, bundle_file)
+    monkeypatch.setattr(release_bundle, '_read_manifests', lambda *args: pytest.fail('the manifests were read'))
+    release = release_bundle.read_release(dict(properties, release_bundle=str(bundle_file)))
+    assert [change_file.changeset.id for change_file in release['changelog_0.xml']] == ['change-0-0', 'change-0-1']
+
+
+def test_credentials_are_never_bundled(release_properties, tmp_path):
+    properties = release_properties(change_logs=1, files=1, **CREDENTIALS)
+    bundle_file = tmp_path / 'release.bundle'
+    write_bundle(properties, bundle_file)
+    _, _, index = read_index(bundle_file)
+    assert not set(CREDENTIALS) & set(index['properties'])
+    content = bundle_file.read_bytes()
+    for value in CREDENTIALS.values():
+        assert value.encode('utf-8') not in content
+
+
+def test_credentials_in_an_older_bundle_are_not_read_back(tmp_path):
+    index = json.dumps({'version': BUNDLE_VERSION, 'properties': dict(CREDENTIALS, history_table='HISTORY_TABLE'),
+                        'change_logs': []}).encode('utf-8')
+    bundle_file = tmp_path / 'old.bundle'
+    bundle_file.write_bytes(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(index)) + index)
+    bundle = ReleaseBundle(bundle_file)
+    try:
+        assert bundle.properties == {'history_table': 'HISTORY_TABLE'}
+    finally:
+        bundle.close()
+
+
+@pytest.mark.parametrize('content, error', [(b'not a bundle', 'is not a release bundle'),
+                                            (BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION + 1, 2) + b'{}',
+                                             f'version {BUNDLE_VERSION + 1} release bundle')])
+def test_a_file_that_is_not_a_bundle_is_rejected(tmp_path, content, error):
+    bundle_file = Path(tmp_path, 'release.bundle')
+    bundle_file.write_bytes(content)
+    with pytest.raises(ValueError, match=error):
+        ReleaseBundle(bundle_file)
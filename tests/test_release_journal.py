@@ -0,0 +1,71 @@
+from operators.release_journal import ReleaseJournal
+
+STATEMENTS = ['USE SCHEMA PUBLIC', 'CREATE TABLE t (id int)', 'INSERT INTO t VALUES (1)', 'INSERT INTO t VALUES (2)']
+TRANSACTION = ['CREATE TABLE t (id int)', 'BEGIN', 'INSERT INTO t VALUES (1)', 'INSERT INTO t VALUES (2)', 'COMMIT',
+               'INSERT INTO t VALUES (3)']
+
+
+def journal_of(directory, statements, completed, changeset='c1'):
+    """
+    Journals the first completed statements of a changeset and reopens the journal, as a rerun does
+    """
+    journal = ReleaseJournal(directory, 'TEST')
+    for position, statement in enumerate(statements[:completed], start=1):
+        journal.statement(changeset, position, statement)
+    journal.close()
+    return ReleaseJournal(directory, 'TEST')
+
+
+def resume(journal, statements, changeset='c1'):
+    position, session_statements, remaining = journal.resume(changeset, iter(statements))
+    return position, session_statements, list(remaining)
+
+
+def test_resumes_after_the_completed_statements(tmp_path):
+    journal = journal_of(tmp_path, STATEMENTS, completed=3)
+    assert resume(journal, STATEMENTS) == (3, ['USE SCHEMA PUBLIC'], STATEMENTS[3:])
+
+
+def test_a_changeset_without_records_starts_at_the_first_statement(tmp_path):
+    journal = journal_of(tmp_path, STATEMENTS, completed=3)
+    assert resume(journal, STATEMENTS, changeset='c2') == (0, [], STATEMENTS)
+
+
+def test_an_edited_statement_is_executed_again_with_the_ones_after_it(tmp_path):
+    journal = journal_of(tmp_path, STATEMENTS, completed=3)
+    edited = STATEMENTS[:2] + ['INSERT INTO t VALUES (10)', STATEMENTS[3]]
+    assert resume(journal, edited) == (2, ['USE SCHEMA PUBLIC'], edited[2:])
+
+
+def test_a_transaction_that_did_not_commit_is_executed_again(tmp_path):
+    # the release stopped after the first INSERT of the transaction, it was rolled back
+    journal = journal_of(tmp_path, TRANSACTION, completed=3)
+    assert resume(journal, TRANSACTION) == (1, [], TRANSACTION[1:])
+
+
+def test_a_committed_transaction_is_not_executed_again(tmp_path):
+    journal = journal_of(tmp_path, TRANSACTION, completed=5)
+    assert resume(journal, TRANSACTION) == (5, [], TRANSACTION[5:])
+
+
+def test_a_partly_written_record_is_discarded(tmp_path):
+    journal = journal_of(tmp_path, STATEMENTS, completed=2)
+    journal.close()
+    with open(journal.journal_file, 'a') as f:
+        f.write('{"event": "statement", "changeset": "c1", "posi')
+    assert resume(ReleaseJournal(tmp_path, 'TEST'), STATEMENTS)[0] == 2
+    assert journal.journal_file.read_text().endswith('\n')
+
+
+def test_released_changesets_are_compacted_away(tmp_path):
+    journal = journal_of(tmp_path, STATEMENTS, completed=4)
+    journal.statement('c2', 1, STATEMENTS[0])
+    journal.released('c1')
+    journal.compact()
+    journal.close()
+    reopened = ReleaseJournal(tmp_path, 'TEST')
+    assert len(reopened) == 1
+    assert resume(reopened, STATEMENTS)[0] == 0
+    reopened.released('c2')
+    reopened.compact()
+    assert not reopened.journal_file.exists()
@@ -0,0 +1,161 @@
+from pathlib import Path
+
+import pytest
+from snowflake.connector.errors import ProgrammingError
+
+from conftest import history
+from operators.retry_policy import LOCK, OVERLOAD, SESSION, RetryPolicy, RetryStats, classify_error, is_idempotent, \
+    transaction_open
+
+
+def error(errno, msg=None):
+    return ProgrammingError(msg=msg or f'error {errno}', errno=errno)
+
+
+def policy(max_attempts=3):
+    return RetryPolicy(max_attempts=max_attempts, base_delay=0, max_delay=0, seed=0, stats=RetryStats())
+
+
+def failing(errors):
+    """
+    Operation raising the errors in turn, then returning the number of attempts
+    """
+    attempts = []
+
+    def operation(attempt):
+        attempts.append(attempt)
+        if len(attempts) <= len(errors):
+            raise errors[len(attempts) - 1]
+        return len(attempts)
+    return operation
+
+
+@pytest.mark.parametrize('statement, idempotent', [
+    ('SELECT * FROM t', True),
+    ('  with x AS (SELECT 1) SELECT * FROM x', True),
+    ('CREATE OR REPLACE TABLE t (id int)', True),
+    ('CREATE TABLE IF NOT EXISTS t (id int)', True),
+    ('CREATE TRANSIENT TABLE IF NOT EXISTS t (id int)', True),
+    ('DROP TABLE IF EXISTS t', True),
+    ('ALTER TABLE t ADD COLUMN IF NOT EXISTS c int', True),
+    ('COPY INTO t FROM @%t', True),
+    ('CREATE TABLE t (id int)', False),
+    ('INSERT INTO t VALUES (1)', False),
+    ('DROP TABLE t', False),
+    ('UPDATE t SET id = 2', False),
+    ('SELECTED_TABLE_INSERT', False),
+])
+def test_is_idempotent(statement, idempotent):
+    assert is_idempotent(statement) == idempotent
+
+
+@pytest.mark.parametrize('errno, error_class', [(625, LOCK), (390114, SESSION), (2003, None)])
+def test_classify_error(errno, error_class):
+    assert classify_error(error(errno)) == error_class
+
+
+@pytest.mark.parametrize('msg, error_class', [
+    ('Statement reached its queued timeout in the warehouse queue and was canceled', OVERLOAD),
+    # a statement that ran out its statement timeout runs as long again
+    ('Statement reached its statement or warehouse timeout of 60 second(s) and was canceled.', None),
+])
+def test_only_a_queued_timeout_is_overload(msg, error_class):
+    assert classify_error(error(630, msg)) == error_class
+    assert classify_error(ProgrammingError(msg=msg, errno=630, sqlstate='57014')) == error_class
+
+
+def test_a_deadlock_is_classified_by_its_sqlstate():
+    assert classify_error(ProgrammingError(msg='Transaction aborted', errno=1, sqlstate='40001')) == LOCK
+
+
+@pytest.mark.parametrize('statements, open_after', [
+    (['BEGIN'], True),
+    (['START TRANSACTION', 'INSERT INTO t VALUES (1)'], True),
+    (['BEGIN TRANSACTION', 'INSERT INTO t VALUES (1)', 'COMMIT'], False),
+    (['BEGIN', 'ROLLBACK'], False),
+    (['INSERT INTO t VALUES (1)'], False),
+])
+def test_transaction_open(statements, open_after):
+    open_transaction = False
+    for statement in statements:
+        open_transaction = transaction_open(statement, open_transaction)
+    assert open_transaction == open_after
+
+
+def test_transient_errors_are_retried_until_the_statement_succeeds():
+    retry = policy()
+    assert retry.call(failing([error(625), error(625)]), statement='INSERT INTO t VALUES (1)') == 3
+    assert (retry.stats.retries, retry.stats.lock, retry.stats.recovered) == (2, 2, 1)
+
+
+def test_retries_give_up_after_max_attempts():
+    retry = policy(max_attempts=2)
+    with pytest.raises(ProgrammingError):
+        retry.call(failing([error(625), error(625)]))
+    assert (retry.stats.retries, retry.stats.exhausted) == (1, 1)
+
+
+def test_other_errors_are_not_retried():
+    retry = policy()
+    with pytest.raises(ProgrammingError):
+        retry.call(failing([error(2003)]))
+    assert retry.stats.retries == 0
+
+
+@pytest.mark.parametrize('statement, retried', [('SELECT 1', True), ('INSERT INTO t VALUES (1)', False)])
+def test_a_lost_session_is_only_retried_for_idempotent_statements(statement, retried):
+    retry = policy()
+    if retried:
+        assert retry.call(failing([error(390114)]), statement=statement) == 2
+    else:
+        with pytest.raises(ProgrammingError):
+            retry.call(failing([error(390114)]), statement=statement)
+    assert (retry.stats.recovered, retry.stats.not_retried) == ((1, 0) if retried else (0, 1))
+
+
+@pytest.mark.parametrize('errno', [625, 390114])
+def test_a_statement_of_an_open_transaction_is_not_retried(errno):
+    retry = policy()
+    with pytest.raises(ProgrammingError):
+        retry.call(failing([error(errno)]), statement='SELECT 1', in_transaction=True)
+    assert (retry.stats.retries, retry.stats.not_retried) == (0, 1)
+
+
+@pytest.mark.parametrize('mode', ['threads', 'async'])
+def test_a_transaction_is_not_retried_from_its_failed_statement(fake_hook, release_properties, deployer, mode):
+    # the second insert of the transaction waits too long for a lock, retrying it alone would commit it without
+    # the first insert of the transaction
+    hook = fake_hook(record=True, transient_errors=[[r"^INSERT INTO bench_0_0 .*VALUES \(1,", 625, 1]])
+    properties = release_properties(change_logs=1, files=2, execution_mode=mode, retry={'base_delay': 0})
+    sql_file = Path(properties['root_sql_directory'], '0', 'change_0.sql')
+    header, body = sql_file.read_text().split('CREATE TABLE', 1)
+    sql_file.write_text(header + 'CREATE TABLE' + body.replace('INSERT', 'BEGIN;\nINSERT', 1) + 'COMMIT;\n')
+    release = deployer(hook, properties)
+    report = release.run_release()
+    assert [node.id for node in report.failed] == ['change-0-0']
+    assert (release.retry_stats.retries, release.retry_stats.not_retried) == (0, 1)
+    executed = [sql for conn in hook.connections for sql in conn.executed_sql]
+    assert len([sql for sql in executed if sql.startswith('INSERT INTO bench_0_0')]) == 2
+    assert not any(sql.startswith('COMMIT') for sql in executed)
+
+
+@pytest.mark.parametrize('mode', ['threads', 'async'])
+def test_a_lock_wait_outside_a_transaction_is_retried(fake_hook, release_properties, deployer, mode):
+    hook = fake_hook(transient_errors=[[r"^INSERT INTO bench_0_0 .*VALUES \(1,", 625, 1]])
+    properties = release_properties(change_logs=1, files=2, execution_mode=mode, retry={'base_delay': 0})
+    release = deployer(hook, properties)
+    assert not release.run_release().failed
+    assert (release.retry_stats.retries, release.retry_stats.recovered) == (1, 1)
+
+
+def test_a_lost_history_insert_is_not_written_twice(fake_hook, release_properties, deployer):
+    # the first history insert runs and its response is lost, the retry only inserts the records not written
+    hook = fake_hook(transient_errors=[[r'^INSERT INTO \S+HISTORY_TABLE', 250003, 1, True]])
+    properties = release_properties(change_logs=2, files=3, history_batch_size=2)
+    release = deployer(hook, properties)
+    report = release.run_release()
+    assert not report.failed and release.retry_stats.recovered == 1
+    rows = hook.backend.execute('SELECT id FROM TEST.HISTORY_SCHEMA.HISTORY_TABLE')
+    assert len(rows) == len(set(rows)) == 6
+    assert set(history(hook.backend).values()) == {'success'}
+
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from core.scheduler import ChangeSetNode, ChangeSetScheduler, build_change_set_graph
+
+
+def nodes_of(*changes):
+    """
+    :param changes: (id, depends) pairs in manifest order, depends None for a changeset without --depends:
+    """
+    return [ChangeSetNode(id, 'changelog.xml', None, {'id': id, 'depends': depends}) for id, depends in changes]
+
+
+def ids(nodes):
+    return [node.id for node in nodes]
+
+
+def test_graph_without_headers_runs_in_manifest_order():
+    a, b, c = build_change_set_graph(nodes_of(('a', None), ('b', None), ('c', None)))
+    assert (a.depends, b.depends, c.depends) == ([], [a], [b])
+    assert c.pending == 1
+
+
+def test_graph_links_listed_dependencies_once():
+    a, b, c = build_change_set_graph(nodes_of(('a', ()), ('b', ()), ('c', ('a', 'b', 'a'))))
+    assert (a.depends, b.depends, c.depends) == ([], [], [a, b])
+    assert c.pending == 2
+
+
+@pytest.mark.parametrize('changes, message', [
+    ((('a', ('b',)), ('b', ())), 'listed after it'),
+    ((('a', ()), ('b', ()), ('a', ())), 'ids must be unique'),
+    ((('a', ('a',)),), 'listed as itself'),
+    ((('a', ()), ('b', ('unknown',))), 'neither part of this release nor released'),
+])
+def test_graph_rejects_broken_dependencies(changes, message):
+    with pytest.raises(ValueError, match=message):
+        build_change_set_graph(nodes_of(*changes), is_released=lambda id: False)
+
+
+def test_graph_accepts_released_dependencies():
+    (a,) = build_change_set_graph(nodes_of(('a', ('released',))), is_released=lambda id: id == 'released')
+    assert a.depends == [] and a.pending == 0
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_failure_halts_the_release(max_workers):
+    nodes = build_change_set_graph(nodes_of(('a', None), ('b', None), ('c', None), ('d', None)))
+    report = ChangeSetScheduler(max_workers=max_workers, halt_on_fail=True).run(nodes, lambda node: node.id != 'b')
+    assert (ids(report.succeeded), ids(report.failed), ids(report.skipped)) == (['a'], ['b'], ['c', 'd'])
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_failure_skips_only_dependants_without_halting(max_workers):
+    nodes = build_change_set_graph(nodes_of(('a', ()), ('b', ('a',)), ('c', ()), ('d', ('c',))))
+    report = ChangeSetScheduler(max_workers=max_workers, halt_on_fail=False).run(nodes, lambda node: node.id != 'a')
+    assert ids(report.failed) == ['a']
+    assert sorted(ids(report.succeeded)) == ['c', 'd']
+    assert ids(report.skipped) == ['b']
+
+
+def test_halt_waits_for_changesets_in_flight_and_starts_no_more():
+    nodes = build_change_set_graph(nodes_of(*((id, ()) for id in 'abcdef')))
+    started, release_b = [], threading.Event()
+
+    def deploy(node):
+        started.append(node.id)
+        if node.id == 'a':
+            return False
+        # b was started with a and is still running when a fails
+        return release_b.wait(5) if node.id == 'b' else True
+
+    scheduler = ChangeSetScheduler(max_workers=2, halt_on_fail=True)
+    timer = threading.Timer(0.2, release_b.set)
+    timer.start()
+    try:
+        report = scheduler.run(nodes, deploy)
+    finally:
+        timer.cancel()
+    assert sorted(started) == ['a', 'b']
+    assert (ids(report.succeeded), ids(report.failed)) == (['b'], ['a'])
+    assert ids(report.skipped) == ['c', 'd', 'e', 'f']
@@ -0,0 +1,75 @@
+import datetime
+import re
+
+import pytest
+
+from conftest import HISTORY_TABLE, TARGET_DATABASE
+from operators.sql_templates import SQL_DIRECTORY, StatementRegistry, get_rendered_template, statements
+
+IDENTIFIERS = {'database': TARGET_DATABASE, 'history_schema': 'HISTORY_SCHEMA', 'history_table': HISTORY_TABLE,
+               'watermark_column': 'date_released', 'table': 'REF.COUNTRIES', 'stage': '~/release/seed',
+               'format': 'CSV', 'purge': 'FALSE', 'source': '/tmp/seed/countries.csv', 'parallel': 4,
+               'source_compression': 'AUTO_DETECT'}
+# templates taking values, with the number of bind parameters for the variables given
+BOUND = {
+    'insert_into_release_log_history_table.j2': ({}, 11),
+    'select_history_records.j2': ({'rows': 3}, 3),
+    'update_status.j2': ({'rows': 3}, 6),
+    'select_release_history.j2': ({'incremental': True}, 1),
+}
+
+
+def test_every_template_is_registered():
+    assert set(statements.templates) == {path.name for path in SQL_DIRECTORY.glob('*.j2')}
+
+
+@pytest.mark.parametrize('template', sorted(path.name for path in SQL_DIRECTORY.glob('*.j2')))
+def test_every_template_renders(template):
+    variables = dict(IDENTIFIERS, **BOUND.get(template, ({}, 0))[0])
+    sql = statements.render(template, **variables)
+    assert sql.strip() and '{' not in sql and '}' not in sql
+    # the identifiers used are rendered, nothing is left empty
+    assert not re.search(r'\s(FROM|INTO|TABLE|EXISTS)\s*(\n|$)', sql, re.IGNORECASE)
+
+
+@pytest.mark.parametrize('template, variables, binds', [(template, variables, binds)
+                                                        for template, (variables, binds) in BOUND.items()])
+def test_values_are_bound_with_qmark_parameters(template, variables, binds):
+    sql = get_rendered_template(template, history_table=HISTORY_TABLE, watermark_column='date_released', **variables)
+    assert sql.count('?') == binds
+    # no value is ever quoted into the statement
+    assert "'" not in sql.replace("'success'", '')
+
+
+def test_a_full_history_fetch_takes_no_parameter():
+    assert '?' not in get_rendered_template('select_release_history.j2', history_table=HISTORY_TABLE,
+                                            watermark_column='date_released', incremental=False)
+
+
+def test_bound_values_are_stored_as_given(fake_hook):
+    hook = fake_hook()
+    hook.backend.execute(get_rendered_template('create_release_log_history_table.j2', database=TARGET_DATABASE,
+                                               history_schema='HISTORY_SCHEMA', history_table='HISTORY_TABLE'))
+    values = ("it's; DROP TABLE x; --", 'o\'brien', 'a/b.sql', datetime.datetime(2024, 1, 1), 'c.xml', None, None,
+              '{{ history_table }}', 1, 'success', None)
+    hook.backend.execute(get_rendered_template('insert_into_release_log_history_table.j2',
+                                               history_table=HISTORY_TABLE), values)
+    assert hook.backend.execute(f'SELECT * FROM {HISTORY_TABLE}') == [values]
+
+
+def test_statements_are_rendered_once():
+    statements.statement.cache_clear()
+    first = get_rendered_template('select_history_state.j2', history_table=HISTORY_TABLE,
+                                  watermark_column='date_released')
+    second = get_rendered_template('select_history_state.j2', history_table=HISTORY_TABLE,
+                                   watermark_column='date_released')
+    assert first is second and first == first.strip()
+    assert statements.statement.cache_info().hits == 1
+
+
+def test_compiled_templates_are_cached_on_disk(tmp_path):
+    registry = StatementRegistry(bytecode_cache_directory=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == len(registry.templates)
+    assert StatementRegistry(bytecode_cache_directory=str(tmp_path)).render(
+        'select_database_objects.j2', database=TARGET_DATABASE) == \
+        registry.render('select_database_objects.j2', database=TARGET_DATABASE)
@@ -0,0 +1,75 @@
+from pathlib import Path
+import os
+import statistics
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.synthetic_release import write_release
+
+ROOT = Path(__file__).resolve().parent.parent
+# import time budget of each offline command, interpreter startup excluded. STARTUP_BUDGET_MS raises it on slow
+# machines
+BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', 100))
+REPEAT = 3
+# the offline commands never connect to Snowflake or render SQL
+FORBIDDEN_MODULES = ('snowflake', 'cryptography', 'jinja2')
+
+
+def import_times(stderr: str):
+    """
+    Parses the -X importtime report
+    :return: dictionary of top level package to cumulative microseconds, set of every imported module
+    """
+    cumulative = {}
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        cumulative_us, name = int(parts[1]), parts[2]
+        module = name.strip()
+        modules.add(module)
+        # top level imports have one space before the name, nested imports two more per level
+        if len(name) - len(name.lstrip()) == 1:
+            cumulative[module] = cumulative_us
+    return cumulative, modules
+
+
+@pytest.fixture(scope='module')
+def interpreter_modules():
+    """
+    Modules every interpreter imports at startup (site, encodings, ...), not counted against the budget
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'pass'], capture_output=True, text=True)
+    return import_times(completed.stderr)[1]
+
+
+@pytest.fixture(scope='module')
+def properties_file(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('startup')
+    properties = write_release(directory, change_logs=5, files=20)
+    properties.update({'history_schema': 'HISTORY_SCHEMA', 'history_table': 'HISTORY_TABLE',
+                       'history_cache_directory': str(Path(directory, 'history_cache'))})
+    properties_file = Path(directory, 'properties.yaml')
+    properties_file.write_text(''.join(f'{name}: {value}\n' for name, value in properties.items()))
+    return str(properties_file)
+
+
+@pytest.mark.parametrize('command', [['--help'], ['lint'], ['plan', '-t', 'BENCH']], ids=lambda command: command[0])
+def test_offline_commands_start_fast(command, properties_file, interpreter_modules):
+    totals = []
+    for _ in range(REPEAT):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', 'deploy.py', '-p', properties_file] + command,
+                                   cwd=str(ROOT), capture_output=True, text=True)
+        assert completed.returncode == 0, completed.stdout + completed.stderr
+        cumulative, modules = import_times(completed.stderr)
+        cumulative = {module: us for module, us in cumulative.items() if module not in interpreter_modules}
+        totals.append(sum(cumulative.values()) / 1000)
+
+    forbidden = sorted(module for module in modules if module.split('.')[0] in FORBIDDEN_MODULES)
+    assert forbidden == []
+    slowest = ', '.join(f'{module} {us / 1000:.1f}ms' for module, us in
+                        sorted(cumulative.items(), key=lambda item: -item[1])[:5])
+    assert statistics.median(totals) <= BUDGET_MS, f'imports over the budget, slowest: {slowest}'
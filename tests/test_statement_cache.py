@@ -0,0 +1,41 @@
+import io
+
+import pytest
+
+from operators.statement_cache import StatementCache, StatementStats, stream_statements
+
+SQL = [
+    'CREATE TABLE t (id int);\nINSERT INTO t VALUES (1);\n',
+    "INSERT INTO t VALUES ('a;b');\n-- a comment; with a semicolon\nINSERT INTO t VALUES ('c');",
+    "/* block;\ncomment */ CREATE VIEW v AS SELECT 1 AS x;\nSELECT 'it''s';\n",
+    'CREATE FUNCTION f() RETURNS int LANGUAGE javascript AS $$\n  return 1;\n$$;\nSELECT f();\n',
+    "INSERT INTO t VALUES ('café');\r\nINSERT INTO t VALUES ('日本');\r\n",
+    'SELECT 1',
+    '',
+]
+
+
+def streamed(sql, stats):
+    return tuple(stream_statements(lambda: io.StringIO(sql), stats))
+
+
+@pytest.mark.parametrize('sql', SQL)
+def test_streamed_and_in_memory_splits_are_the_same(sql):
+    stats = StatementStats()
+    assert streamed(sql, stats) == StatementCache().split(sql, stats=stats)
+    assert (stats.streamed_files, stats.cache_misses) == (1, 1)
+
+
+def test_a_file_is_split_once_per_checksum():
+    cache, stats = StatementCache(), StatementStats()
+    first = cache.split(SQL[0], checksum='abc', stats=stats)
+    assert cache.split('ignored, the checksum is cached', checksum='abc', stats=stats) is first
+    assert (stats.cache_misses, stats.cache_hits) == (1, 1)
+
+
+def test_release_stats_add_to_their_parent():
+    parent = StatementStats()
+    first, second = StatementStats(parent=parent), StatementStats(parent=parent)
+    first.add(statements_executed=2)
+    second.add(statements_executed=3)
+    assert (first.statements_executed, second.statements_executed, parent.statements_executed) == (2, 3, 5)